@@ -32,11 +32,17 @@
 
 # https://stackoverflow.com/questions/1112618/import-python-package-from-local-directory-into-interpreter
 # https://stackoverflow.com/questions/14500183/in-python-can-i-call-the-main-of-an-imported-module
+import os
 import sys
 from pathlib import Path
 
 module_dir = Path(__file__).resolve().parent
 sys.path.append(str(module_dir))
+if "_ARGCOMPLETE" in os.environ:
+    # Try to answer tab-completion requests using the cached completion index before importing all of cheribuild.
+    from pycheribuild.completion import complete_from_index  # noqa: E402
+
+    complete_from_index()  # only returns if the full command line parser is needed
 # noinspection PyPep8
 from pycheribuild.__main__ import main  # "__main__" case  # noqa: E402
 
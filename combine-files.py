@@ -123,6 +123,9 @@ def check_all_files_used(directory: Path):
 add_filtered_file(script_dir / "colour.py")
 add_filtered_file(script_dir / "utils.py")
 add_filtered_file(script_dir / "mtree.py")
+add_filtered_file(script_dir / "timing.py")
+add_filtered_file(script_dir / "target_index.py")
+add_filtered_file(script_dir / "completion.py")
 add_filtered_file(script_dir / "config/loader.py")
 add_filtered_file(script_dir / "config/target_info.py")
 add_filtered_file(script_dir / "config/chericonfig.py")
@@ -38,7 +38,9 @@ from collections import OrderedDict
 
 # noinspection PyUnresolvedReferences
 from pathlib import Path
+from typing import Optional
 
+from .completion import CompletionIndex
 from .config.defaultconfig import CheribuildAction, DefaultCheribuildConfigLoader, DefaultCheriConfig
 
 # First thing we need to do is set up the config loader (before importing anything else!)
@@ -46,16 +48,10 @@ from .config.defaultconfig import CheribuildAction, DefaultCheribuildConfigLoade
 # https://stackoverflow.com/questions/3536620/how-to-change-a-module-variable-from-another-module
 from .config.loader import ConfigOptionBase, MyJsonEncoder
 from .processutils import get_program_version, print_command, run_and_kill_children_on_exit, run_command
-
-# make sure all projects are loaded so that target_manager gets populated
-# noinspection PyUnresolvedReferences
-from .projects import *  # noqa: F401,F403
-
-# noinspection PyUnresolvedReferences
-from .projects.cross import *  # noqa: F401,F403
 from .projects.repository import GitRepository
 from .projects.simple_project import SimpleProject
-from .targets import Target, target_manager
+from .target_index import TargetIndex
+from .targets import DependencyGraph, Target, target_manager
 from .utils import (
     AnsiColour,
     coloured,
@@ -64,9 +60,13 @@ from .utils import (
     init_global_config,
     query_yes_no,
     status_update,
+    warning_message,
 )
 
 DIRS_TO_CHECK_FOR_UPDATES: "list[Path]" = [Path(__file__).parent.parent]
+# These options need the options of all targets, so we have to import all projects.
+OPTIONS_REQUIRING_ALL_TARGETS = ("-h", "--help", "--help-all", "--help-hidden", "--dump-configuration",
+                                 "--get-config-option")
 
 
 def update_check(config: DefaultCheriConfig) -> None:
@@ -138,6 +138,38 @@ def get_config_option_value(option: ConfigOptionBase, config: DefaultCheriConfig
     return option.__get__(config, type(config))
 
 
+def load_target_index(config_loader: DefaultCheribuildConfigLoader) -> "Optional[TargetIndex]":
+    # The index can't be used for the combined single-file cheribuild.py and when completing arguments only the
+    # options matching the current prefix are registered, so we can't generate a new one either.
+    if not __package__ or config_loader.is_completing_arguments:
+        return None
+    return TargetIndex.load()
+
+
+def write_target_indices(config_loader: DefaultCheribuildConfigLoader) -> None:
+    # Note: this must only be called after registering the options of all targets.
+    try:
+        target_manager.create_target_index(config_loader.options.values()).save()
+        # The completion index depends on the same source files, so it also needs to be regenerated.
+        completion_targets = sorted(target_manager.non_deprecated_target_names(None))
+        config_loader.create_completion_index(completion_targets).save()
+    except OSError as e:
+        if not config_loader.is_completing_arguments:  # Don't print anything while completing
+            warning_message("Could not write target index:", e)
+
+
+def needs_all_targets(args: "list[str]") -> bool:
+    for arg in args:
+        if arg == "__run_everything__":
+            return True
+        option = arg.split("=", 1)[0]
+        # Also handle abbreviated option names (e.g. --dump-config)
+        if option.startswith("-") and option not in ("-", "--") and \
+                any(o.startswith(option) for o in OPTIONS_REQUIRING_ALL_TARGETS):
+            return True
+    return False
+
+
 def real_main() -> None:
     # avoid weird errors with macos terminal:
     ensure_fd_is_blocking(sys.stdin.fileno())
@@ -145,6 +177,21 @@ def real_main() -> None:
     ensure_fd_is_blocking(sys.stderr.fileno())
 
     config_loader = DefaultCheribuildConfigLoader()
+    # If cheribuild.py could not use the completion index because it is missing or out of date, register all options
+    # instead of just the ones matching the current prefix and regenerate it.
+    completion_index_outdated = bool(__package__) and config_loader.is_completing_arguments and \
+        not CompletionIndex.is_up_to_date()
+    if completion_index_outdated:
+        config_loader.register_all_options_when_completing()
+    # Unless all targets are needed, only import the projects for the targets that are used. This relies on an index
+    # of all targets that is regenerated whenever the list of targets could have changed.
+    target_index = load_target_index(config_loader)
+    if target_index is not None and not needs_all_targets(sys.argv[1:]):
+        target_manager.use_target_index(target_index)
+        target_manager.load_targets_referenced_by(sys.argv[1:])
+        config_loader.is_declared_target_option = target_manager.is_declared_target_option
+    else:
+        target_manager.load_all_targets()
     # Don't suggest deprecated names when tab-completing
     if config_loader.is_completing_arguments:
         all_target_names = list(sorted(target_manager.non_deprecated_target_names(None)))
@@ -157,6 +204,9 @@ def real_main() -> None:
     del all_target_names
     SimpleProject._config_loader = config_loader
     target_manager.register_command_line_options()
+    if completion_index_outdated or (target_index is None and not config_loader.is_completing_arguments and
+                                     __package__):
+        write_target_indices(config_loader)
     # load them from JSON/cmd line
     cheri_config.load()
     if not cheri_config.allow_running_as_root:
@@ -286,11 +336,11 @@ def real_main() -> None:
         if cheri_config.verbose:
             needed_by = {k.name: [] for k in chosen_targets}
             direct_deps = dict()
+            dependency_graph = DependencyGraph.for_config(cheri_config)
             for target in chosen_targets:
-                # noinspection PyProtectedMember
-                direct_deps[target.name] = [t.name for t in target.project_class._direct_dependencies(
-                    cheri_config, include_sdk_dependencies=True, include_toolchain_dependencies=True,
-                    explicit_dependencies_only=False)]
+                direct_deps[target.name] = [t.name for t in dependency_graph.direct_dependencies(
+                    target.project_class, cheri_config, include_sdk_dependencies=True,
+                    include_toolchain_dependencies=True, explicit_dependencies_only=False)]
                 for dep in direct_deps[target.name]:
                     needed_by[dep].append(target.name)
             for target in chosen_targets:
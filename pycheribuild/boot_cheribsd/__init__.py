@@ -34,7 +34,9 @@
 # device.
 #
 import argparse
+import atexit
 import datetime
+import hashlib
 import os
 import random
 import re
@@ -183,6 +185,23 @@ class CheriBSDMatchedErrorOutput(CheriBSDCommandFailed):
     pass
 
 
+# Cleanup actions that are run when main() returns. We can't rely on atexit alone since the libc++ test shards are
+# multiprocessing.Process children, and those exit via os._exit() without running atexit handlers.
+_EXIT_HOOKS: "list[Callable[[], typing.Any]]" = []
+
+
+def _run_exit_hooks() -> None:
+    while _EXIT_HOOKS:
+        hook = _EXIT_HOOKS.pop()
+        try:
+            hook()
+        except Exception as e:
+            warn("Cleanup action ", hook, " failed: ", e)
+
+
+atexit.register(_run_exit_hooks)
+
+
 class SmbMount(object):
     def __init__(self, hostdir: str, readonly: bool, in_target: str):
         self.readonly = readonly
@@ -287,10 +306,79 @@ class CheriBSDInstance(CheriBSDSpawnMixin, pexpect.spawn):
         self.sendchunksize = 100  # sleep after 100 sent chars
 
 
+class SSHControlMaster(object):
+    """
+    A multiplexed SSH connection to a QEMU guest. The master connection is started the first time it is needed and
+    all later ssh and scp invocations are sent over it, so the key exchange and authentication (which can take several
+    seconds on an emulated CPU) are only performed once per QEMU instance. If the master cannot be started, the
+    clients transparently fall back to opening their own connection. Failed attempts are retried with an exponential
+    backoff (sshd might not be up yet) and after MAX_START_ATTEMPTS failures the master is not started again.
+    """
+    MAX_START_ATTEMPTS = 3
+
+    def __init__(self, instance: "QemuCheriBSDInstance"):
+        self.instance = instance
+        self.running = False
+        self._control_dir: Optional[Path] = None
+        self._failed_attempts = 0
+        self._next_attempt = 0.0
+
+    @property
+    def control_path(self) -> Path:
+        if self._control_dir is None:
+            # Use a private directory in $TMPDIR: UNIX socket paths are limited to ~100 characters and we don't want
+            # to share the socket with other instances that happen to reuse the same port.
+            self._control_dir = Path(tempfile.mkdtemp(prefix="cheribsd-ssh-"))
+            _EXIT_HOOKS.append(self.stop)
+        return self._control_dir / "master"
+
+    def client_options(self) -> "list[str]":
+        # Clients must never become the master themselves since the backgrounded master process would keep their
+        # stdout/stderr pipes open.
+        return ["-o", "ControlPath=" + str(self.control_path), "-o", "ControlMaster=no"]
+
+    def start(self) -> bool:
+        if self.running or PRETEND:
+            return self.running
+        if self._failed_attempts >= self.MAX_START_ATTEMPTS or time.monotonic() < self._next_attempt:
+            return False
+        command = self.instance.ssh_command([], extra_ssh_args=["-N", "-f", "-o", "ControlMaster=yes",
+                                                                "-o", "ControlPath=" + str(self.control_path)],
+                                            use_controlmaster=False)
+        starttime = datetime.datetime.now()
+        # -f backgrounds ssh once authentication has completed, so this returns as soon as the master is usable.
+        result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL, check=False)
+        if result.returncode != 0:
+            self._failed_attempts += 1
+            self._next_attempt = time.monotonic() + 5 * 2 ** self._failed_attempts
+            if self._failed_attempts >= self.MAX_START_ATTEMPTS:
+                warn("Could not start SSH control master connection (exit code ", result.returncode,
+                     "), using separate connections from now on")
+            else:
+                warn("Could not start SSH control master connection (exit code ", result.returncode,
+                     "), will retry in ", int(self._next_attempt - time.monotonic()), " seconds")
+            return False
+        self.running = True
+        info("Started SSH control master ", self.control_path, " after ", datetime.datetime.now() - starttime)
+        return True
+
+    def stop(self) -> None:
+        if self.running:
+            subprocess.run(["ssh", "-o", "ControlPath=" + str(self.control_path), "-O", "exit", "localhost"],
+                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+            self.running = False
+        if self._control_dir is not None:
+            shutil.rmtree(str(self._control_dir), ignore_errors=True)
+            self._control_dir = None
+
+
 class QemuCheriBSDInstance(CheriBSDInstance):
     EXIT_ON_KERNEL_PANIC = True
     smb_dirs: "list[SmbMount]" = None
     flush_interval = None
+    boot_snapshot: "Optional[BootSnapshot]" = None
+    ssh_master: "Optional[SSHControlMaster]" = None
 
     def __init__(self, qemu_config: QemuOptions, *args, ssh_port: Optional[int],
                  ssh_pubkey: Optional[Path], **kwargs):
@@ -305,6 +393,7 @@ class QemuCheriBSDInstance(CheriBSDInstance):
         self.ssh_user = "root"
         self.smb_dirs = []
         self.smb_failed = False
+        self.ssh_master = SSHControlMaster(self)
 
     @property
     def ssh_private_key(self):
@@ -314,26 +403,19 @@ class QemuCheriBSDInstance(CheriBSDInstance):
         assert self._ssh_private_key != self.ssh_public_key, (self._ssh_private_key, "!=", self.ssh_public_key)
         return self._ssh_private_key
 
-    @staticmethod
-    def _ssh_options(use_controlmaster: bool):
+    def _ssh_options(self, use_controlmaster: bool) -> "list[str]":
         result = ["-o", "UserKnownHostsFile=/dev/null",
                   "-o", "StrictHostKeyChecking=no",
                   "-o", "NoHostAuthenticationForLocalhost=yes",
-                  # "-o", "ConnectTimeout=20",
+                  "-o", "ConnectTimeout=30",
                   # "-o", "ConnectionAttempts=2",
                   ]
-        if use_controlmaster:
-            # XXX: always use controlmaster for faster connections?
-            controlmaster_dir = Path.home() / ".ssh/controlmasters"
-            controlmaster_dir.mkdir(exist_ok=True)
-            result += ["-o", "ControlPath={control_dir}/%r@%h:%p".format(control_dir=controlmaster_dir),
-                       "-o", "ControlMaster=auto",
-                       # Keep socket open for 10 min (600) or indefinitely (yes)
-                       "-o", "ControlPersist=600"]
+        if use_controlmaster and self.ssh_master.start():
+            result += self.ssh_master.client_options()
         return result
 
-    def run_command_via_ssh(self, command: "list[str]", *, stdout=None, stderr=None, check=True, verbose=False,
-                            use_controlmaster=False, **kwargs) -> "subprocess.CompletedProcess[bytes]":
+    def ssh_command(self, command: "list[str]", *, extra_ssh_args: "Optional[list[str]]" = None, verbose=False,
+                    use_controlmaster=True) -> "list[str]":
         assert self.ssh_port is not None
         ssh_command = ["ssh", "{user}@{host}".format(user=self.ssh_user, host="localhost"),
                        "-p", str(self.ssh_port),
@@ -341,11 +423,24 @@ class QemuCheriBSDInstance(CheriBSDInstance):
         if verbose:
             ssh_command.append("-v")
         ssh_command.extend(self._ssh_options(use_controlmaster=use_controlmaster))
-        ssh_command.append("--")
-        ssh_command.extend(command)
+        if extra_ssh_args:
+            ssh_command.extend(extra_ssh_args)
+        if command:
+            ssh_command.append("--")
+            ssh_command.extend(command)
+        return ssh_command
+
+    def run_command_via_ssh(self, command: "list[str]", *, stdout=None, stderr=None, check=True, verbose=False,
+                            use_controlmaster=True, **kwargs) -> "subprocess.CompletedProcess[bytes]":
+        ssh_command = self.ssh_command(command, verbose=verbose, use_controlmaster=use_controlmaster)
         print_cmd(ssh_command, **kwargs)
         return subprocess.run(ssh_command, stdout=stdout, stderr=stderr, check=check, **kwargs)
 
+    def run_commands_via_ssh(self, commands: "list[str]", **kwargs) -> "subprocess.CompletedProcess[bytes]":
+        """Run a sequence of shell commands in a single SSH session, stopping at the first one that fails."""
+        script = "\n".join(commands) + "\n"
+        return self.run_command_via_ssh(["sh", "-e", "-s"], input=script.encode("utf-8"), **kwargs)
+
     def check_ssh_connection(self, prefix="SSH connection:"):
         connection_test_start = datetime.datetime.utcnow()
         result = self.run_command_via_ssh(["echo", "connection successful"], check=True, stdout=subprocess.PIPE,
@@ -359,26 +454,58 @@ class QemuCheriBSDInstance(CheriBSDInstance):
             success(prefix, " successful after ", connection_time, " seconds")
             return True
 
-    def scp_from_guest(self, qemu_dir: str, local_dir: Path):
+    def scp_command(self) -> "list[str]":
         assert self.ssh_port is not None
-        command = ["scp", "-P", str(self.ssh_port), "-i", str(self.ssh_private_key)]
-        command.extend(self._ssh_options(use_controlmaster=False))
-        command.append("{user}@{host}:{remote_dir}".format(user=self.ssh_user, host="localhost", remote_dir=qemu_dir))
+        return ["scp", "-P", str(self.ssh_port), "-i", str(self.ssh_private_key),
+                *self._ssh_options(use_controlmaster=True)]
+
+    def _guest_path(self, qemu_path: str) -> str:
+        return "{user}@{host}:{path}".format(user=self.ssh_user, host="localhost", path=qemu_path)
+
+    def scp_from_guest(self, qemu_dir: str, local_dir: Path):
+        command = self.scp_command()
+        command.append(self._guest_path(qemu_dir))
         if not local_dir.parent.exists():
             failure("Parent dir does't exist: ", local_dir, exit=False)
         command.append(str(local_dir))
         run_host_command(command)
 
     def scp_to_guest(self, local_path: Path, qemu_path: str):
-        assert self.ssh_port is not None
-        command = ["scp", "-P", str(self.ssh_port), "-i", str(self.ssh_private_key)]
-        command.extend(self._ssh_options(use_controlmaster=False))
-        command.append(str(local_path))
-        if not local_path.exists():
-            failure("Path does't exist: ", local_path, exit=False)
-        command.append("{user}@{host}:{remote_dir}".format(user=self.ssh_user, host="localhost", remote_dir=qemu_path))
+        self.scp_files_to_guest([local_path], qemu_path)
+
+    def scp_files_to_guest(self, local_paths: "list[Path]", qemu_path: str):
+        """Copy all of local_paths with a single scp invocation (qemu_path must be a directory if there are several)"""
+        command = self.scp_command()
+        for local_path in local_paths:
+            if not local_path.exists():
+                failure("Path does't exist: ", local_path, exit=False)
+            command.append(str(local_path))
+        command.append(self._guest_path(qemu_path))
         run_host_command(command)
 
+    def extract_archive_in_guest(self, archive: Path, qemu_dir: str) -> None:
+        """
+        Stream the contents of a .tar.xz archive into tar running in the guest without extracting it on the host.
+        The archive is decompressed on the host since xz in an emulated guest is much slower than the network.
+        """
+        starttime = datetime.datetime.now()
+        decompress_cmd = ["xz", "--decompress", "--stdout", str(archive)]
+        tar_cmd = ["tar", "-xf", "-", "-C", qemu_dir]
+        if PRETEND:
+            print_cmd(decompress_cmd + ["|", "ssh", "..."] + tar_cmd)
+            return
+        decompress = subprocess.Popen(decompress_cmd, stdout=subprocess.PIPE)
+        try:
+            self.run_command_via_ssh(tar_cmd, stdin=decompress.stdout)
+        finally:
+            decompress.stdout.close()
+            if decompress.wait() != 0:
+                failure("Failed to decompress ", archive, exit=True)
+        duration = (datetime.datetime.now() - starttime).total_seconds()
+        size_mb = archive.stat().st_size / 1024 / 1024
+        success("Transferred ", archive.name, " (", round(size_mb, 1), " MiB compressed) in ", round(duration, 1),
+                " seconds (", round(size_mb / max(duration, 0.001), 2), " MiB/s)")
+
 
 def info(*args, **kwargs):
     print(MESSAGE_PREFIX, "\033[0;34m", *args, "\033[0m", file=sys.stderr, sep="", flush=True, **kwargs)
@@ -744,12 +871,194 @@ def start_dhclient(qemu: CheriBSDSpawnMixin, network_iface: str):
     qemu.expect_prompt(timeout=30)
 
 
+def find_qemu_img(qemu_command: Optional[Path]) -> Optional[Path]:
+    # Prefer the qemu-img that was installed alongside the QEMU binary.
+    qemu_img = Path(qemu_command).parent / "qemu-img" if qemu_command else None
+    if qemu_img is None or not qemu_img.exists():
+        found_in_path = shutil.which("qemu-img")
+        qemu_img = Path(found_in_path) if found_in_path is not None else None
+    return qemu_img
+
+
+def default_disk_image_overlay_dir() -> Path:
+    # Use a tmpfs if possible so that the writes made by the guest never hit the host disk.
+    shm = Path("/dev/shm")
+    if shm.is_dir() and os.access(str(shm), os.W_OK):
+        return shm
+    return Path(tempfile.gettempdir())
+
+
+def create_qcow2_overlay(qemu_img: Path, base_image: Path, overlay: Path) -> None:
+    base_format = "raw"
+    if base_image.exists():
+        with base_image.open("rb") as f:
+            base_format = "qcow2" if f.read(4) == b"QFI\xfb" else "raw"
+    run_host_command([str(qemu_img), "create", "-q", "-f", "qcow2", "-F", base_format,
+                      "-b", str(base_image.absolute()), str(overlay)])
+
+
+def create_disk_image_overlay(qemu_img: Path, disk_image: Path, *, overlay_dir: Optional[Path], keep: bool,
+                              name_suffix: str = "") -> Path:
+    """
+    Create a copy-on-write qcow2 overlay that uses disk_image as the backing file. Unlike QEMU's -snapshot mode this
+    allows any number of QEMU instances (e.g. test shards) to share the same base image while keeping their writes
+    in a place we control. The overlay is deleted on exit unless keep is set.
+    """
+    if overlay_dir is None:
+        overlay_dir = default_disk_image_overlay_dir()
+    overlay_dir.mkdir(parents=True, exist_ok=True)
+    fd, overlay_path = tempfile.mkstemp(dir=str(overlay_dir), prefix=disk_image.stem + name_suffix + "-",
+                                        suffix=".qcow2")
+    os.close(fd)
+    overlay = Path(overlay_path)
+    create_qcow2_overlay(qemu_img, disk_image, overlay)
+    if keep:
+        _EXIT_HOOKS.append(lambda: info("Keeping disk image overlay ", overlay, " (backing file: ", disk_image, ")"))
+    else:
+        def remove_overlay():
+            if overlay.exists():
+                overlay.unlink()
+
+        _EXIT_HOOKS.append(remove_overlay)
+    info("Writing disk image changes to overlay ", overlay)
+    return overlay
+
+
+class BootSnapshot(object):
+    """
+    A saved VM state of a booted and logged-in CheriBSD instance that has already been set up for SSH and the common
+    test setup steps. Snapshots are stored in a cache directory and keyed by a fingerprint of the QEMU command line
+    and the kernel, disk image and QEMU binaries, so later test runs can skip the (multi-minute) boot and login.
+
+    QEMU's savevm/-loadvm can only use internal snapshots of the top-most image, so it would require a private copy of
+    the whole snapshot image for every run. Instead, the VM state is written to a separate file using migration and
+    restored with -incoming. The disk writes made before saving are kept in a qcow2 layer on top of the disk image,
+    and each run only creates a new (empty) qcow2 overlay on top of that layer.
+    """
+    # Bump this when the commands run before saving the snapshot change.
+    SETUP_VERSION = 2
+    MAX_AGE = datetime.timedelta(days=7)
+
+    def __init__(self, cache_dir: Path, qemu_img: Path, fingerprint: str, disk_image: Optional[Path]):
+        self.cache_dir = cache_dir
+        self.qemu_img = qemu_img
+        self.disk_image = disk_image
+        # The VM state and the matching disk layer are published together by renaming a temporary directory, so
+        # concurrent savers (e.g. libc++ test shards on a cold cache) can never produce a mismatched pair.
+        self.path = cache_dir / ("boot-" + fingerprint[:32])
+        self.vmstate = self.path / "vmstate"
+        # The disk writes made before saving the VM state (not needed when booting an MFS root kernel).
+        self.disk_layer = self.path / "disk.qcow2" if disk_image is not None else None
+        # The writable overlay used by the current QEMU instance (deleted on exit).
+        self.run_image: Optional[Path] = None
+        self.restoring = self.vmstate.exists() and (self.disk_layer is None or self.disk_layer.exists())
+
+    @staticmethod
+    def fingerprint(qemu_args: "list[str]", *files: "Optional[Path]", extra: "list[str]") -> str:
+        h = hashlib.sha256(str(BootSnapshot.SETUP_VERSION).encode())
+        for arg in qemu_args + extra:
+            h.update(arg.encode("utf-8") + b"\0")
+        for file in files:
+            if file is not None and file.is_file():
+                st = file.stat()
+                h.update("{}\0{}\0{}\0".format(file.absolute(), st.st_size, st.st_mtime_ns).encode("utf-8"))
+        return h.hexdigest()
+
+    def _remove_run_image(self) -> None:
+        if self.run_image is not None and self.run_image.exists():
+            self.run_image.unlink()
+
+    def prepare(self) -> None:
+        if self.restoring:
+            info("Restoring boot snapshot ", self.path)
+            os.utime(str(self.path))  # Mark as recently used
+        if self.disk_image is None:
+            return
+        fd, run_image = tempfile.mkstemp(dir=str(self.cache_dir), prefix="run-", suffix=".qcow2")
+        os.close(fd)
+        self.run_image = Path(run_image)
+        _EXIT_HOOKS.append(self._remove_run_image)
+        create_qcow2_overlay(self.qemu_img, self.disk_layer if self.restoring else self.disk_image, self.run_image)
+
+    def qemu_args(self) -> "list[str]":
+        if self.restoring:
+            return ["-incoming", "exec:cat " + shlex.quote(str(self.vmstate))]
+        return []
+
+    @staticmethod
+    def _monitor_command(qemu: QemuCheriBSDInstance, command: str, timeout: int = 60) -> str:
+        qemu.sendline(command)
+        qemu.expect_exact(["(qemu) "], timeout=timeout)
+        if "Error" in qemu.before:
+            failure("QEMU monitor command '", command, "' failed: ", qemu.before, exit=True)
+        return qemu.before
+
+    def _wait_for_migration(self, qemu: QemuCheriBSDInstance, timeout: datetime.timedelta) -> None:
+        deadline = datetime.datetime.now() + timeout
+        while True:
+            status = self._monitor_command(qemu, "info migrate")
+            if "Migration status: completed" in status:
+                return
+            if "Migration status: failed" in status or "Migration status: cancelled" in status:
+                failure("Saving the VM state failed: ", status, exit=True)
+            if datetime.datetime.now() > deadline:
+                failure("Timed out saving the VM state: ", status, exit=True)
+            time.sleep(0.5)
+
+    def restore(self, qemu: QemuCheriBSDInstance) -> None:
+        qemu.sendline("")
+        qemu.expect_prompt(timeout=60)
+        # The guest clock stopped when the snapshot was taken.
+        qemu.run("date -u -f %s " + str(int(time.time())))
+        success("===> restored boot snapshot")
+
+    def save(self, qemu: QemuCheriBSDInstance) -> None:
+        starttime = datetime.datetime.now()
+        tmp_dir = self.path.with_name(self.path.name + "." + str(os.getpid()) + ".tmp")
+        shutil.rmtree(str(tmp_dir), ignore_errors=True)
+        tmp_dir.mkdir()
+        # Switch the stdio multiplexer from the serial console to the QEMU monitor (-nographic uses CTRL+A,c).
+        qemu.send("\x01c")
+        qemu.expect_exact(["(qemu) "], timeout=60)
+        # Once the migration has completed the VM is paused and all disk writes have been flushed.
+        self._monitor_command(qemu, 'migrate -d "exec:cat > ' + shlex.quote(str(tmp_dir / self.vmstate.name)) + '"')
+        self._wait_for_migration(qemu, timeout=datetime.timedelta(minutes=10))
+        if self.disk_layer is not None:
+            assert self.run_image is not None
+            # The overlay only contains the writes made during boot and the test setup, so this copy is cheap.
+            shutil.copyfile(str(self.run_image), str(tmp_dir / self.disk_layer.name))
+        try:
+            # Renaming a directory fails if the target exists, so the first saver wins and the published snapshot
+            # is never modified afterwards.
+            os.rename(str(tmp_dir), str(self.path))
+            published = True
+        except OSError:
+            shutil.rmtree(str(tmp_dir), ignore_errors=True)
+            published = False
+        self._monitor_command(qemu, "cont")
+        qemu.send("\x01c")
+        qemu.sendline("")
+        qemu.expect_prompt(timeout=60)
+        if published:
+            success("===> saved boot snapshot ", self.path, " (took ", datetime.datetime.now() - starttime, ")")
+        else:
+            info("Not saving boot snapshot since ", self.path, " was created concurrently")
+        # Remove snapshots that have not been used for a while (e.g. for old kernels or disk images).
+        for old in self.cache_dir.glob("boot-*"):
+            if old != self.path and datetime.datetime.now() - \
+                    datetime.datetime.fromtimestamp(old.stat().st_mtime) > self.MAX_AGE:
+                info("Removing old boot snapshot ", old)
+                shutil.rmtree(str(old), ignore_errors=True)
+
+
 def boot_cheribsd(qemu_options: QemuOptions, qemu_command: Optional[Path], kernel_image: Path,
                   disk_image: Optional[Path], ssh_port: Optional[int],
                   ssh_pubkey: Optional[Path], *, write_disk_image_changes: bool,
                   smp_args: "list[str]", smb_dirs: "Optional[list[SmbMount]]" = None, kernel_init_only=False,
                   trap_on_unrepresentable=False, skip_ssh_setup=False, bios_path: "Optional[Path]" = None,
-                  boot_alternate_kernel_dir: "Optional[Path]" = None) -> QemuCheriBSDInstance:
+                  boot_alternate_kernel_dir: "Optional[Path]" = None,
+                  boot_snapshot_cache: "Optional[Path]" = None,
+                  disk_image_format: str = "raw") -> QemuCheriBSDInstance:
     user_network_args = ""
     if smb_dirs is None:
         smb_dirs = []
@@ -772,14 +1081,37 @@ def boot_cheribsd(qemu_options: QemuOptions, qemu_command: Optional[Path], kerne
         bios_args = riscv_bios_arguments(qemu_options.xtarget, None)
     else:
         bios_args = []
-    qemu_args = qemu_options.get_commandline(qemu_command=qemu_command, kernel_file=kernel_image, disk_image=disk_image,
-                                             bios_args=bios_args, user_network_args=user_network_args,
-                                             write_disk_image_changes=write_disk_image_changes,
-                                             add_network_device=True,
-                                             trap_on_unrepresentable=trap_on_unrepresentable,  # For debugging
-                                             add_virtio_rng=True  # faster entropy gathering
-                                             )
-    qemu_args.extend(smp_args)
+    def get_qemu_args(network_args: str, image: Optional[Path], image_format: str, write_changes: bool):
+        return qemu_options.get_commandline(qemu_command=qemu_command, kernel_file=kernel_image, disk_image=image,
+                                            disk_image_format=image_format, bios_args=bios_args,
+                                            user_network_args=network_args, write_disk_image_changes=write_changes,
+                                            add_network_device=True,
+                                            trap_on_unrepresentable=trap_on_unrepresentable,  # For debugging
+                                            add_virtio_rng=True  # faster entropy gathering
+                                            ) + smp_args
+
+    boot_snapshot = None
+    if boot_snapshot_cache is not None:
+        qemu_img = find_qemu_img(qemu_command)
+        if qemu_img is None:
+            warn("Cannot find qemu-img, not using a boot snapshot")
+        else:
+            boot_snapshot_cache.mkdir(parents=True, exist_ok=True)
+            # SSH port and SMB directories only affect the host side of the network, so they are not part of the
+            # fingerprint (but the contents of the authorized_keys file are).
+            fingerprint = BootSnapshot.fingerprint(
+                get_qemu_args("", disk_image, disk_image_format, False), qemu_command, kernel_image, disk_image,
+                bios_path,
+                extra=[str(skip_ssh_setup), str(boot_alternate_kernel_dir),
+                       ssh_pubkey.read_text(encoding="utf-8") if ssh_pubkey is not None else ""])
+            boot_snapshot = BootSnapshot(boot_snapshot_cache, qemu_img, fingerprint, disk_image)
+            boot_snapshot.prepare()
+    if boot_snapshot is not None:
+        # All writes go to the private overlay, so we don't need -snapshot.
+        qemu_args = get_qemu_args(user_network_args, boot_snapshot.run_image, "qcow2", True)
+        qemu_args.extend(boot_snapshot.qemu_args())
+    else:
+        qemu_args = get_qemu_args(user_network_args, disk_image, disk_image_format, write_disk_image_changes)
     kernel_commandline = []
     if kernel_init_only:
         kernel_commandline.append("init_path=/sbin/startup-benchmark.sh")
@@ -805,14 +1137,18 @@ def boot_cheribsd(qemu_options: QemuOptions, qemu_command: Optional[Path], kerne
                      encoding="utf-8", echo=False, timeout=60)
     # child.logfile=sys.stdout.buffer
     child.smb_dirs = smb_dirs
+    child.boot_snapshot = boot_snapshot
     if QEMU_LOGFILE:
         child.logfile = QEMU_LOGFILE.open("w")
     else:
         child.logfile_read = sys.stdout
 
-    boot_and_login(child, starttime=qemu_starttime, kernel_init_only=kernel_init_only,
-                   network_iface=qemu_options.network_interface_name(),
-                   boot_alternate_kernel_dir=boot_alternate_kernel_dir)
+    if boot_snapshot is not None and boot_snapshot.restoring:
+        boot_snapshot.restore(child)
+    else:
+        boot_and_login(child, starttime=qemu_starttime, kernel_init_only=kernel_init_only,
+                       network_iface=qemu_options.network_interface_name(),
+                       boot_alternate_kernel_dir=boot_alternate_kernel_dir)
     return child
 
 
@@ -928,13 +1264,25 @@ def boot_and_login(child: CheriBSDSpawnMixin, *, starttime, kernel_init_only=Fal
     return
 
 
+def _do_common_test_setup(qemu: QemuCheriBSDInstance) -> None:
+    # Note: these steps don't depend on the test script arguments, so they are included in the boot snapshot.
+    # Enable userspace CHERI exception logging to aid debugging
+    qemu.run("sysctl machdep.log_user_cheri_exceptions=1 || sysctl machdep.log_cheri_exceptions=1")
+    # ensure that /usr/local exists and if not create it as a tmpfs (happens in the minimal image)
+    # However, don't do it on the full image since otherwise we would install kyua to the tmpfs on /usr/local
+    # We can differentiate the two by checking if /boot/kernel/kernel exists since it will be missing in the minimal
+    # image
+    qemu.run(
+        "if [ ! -e /boot/kernel/kernel ]; then mkdir -p /usr/local && mount -t tmpfs -o size=300m tmpfs /usr/local; fi")
+    # Or this: if [ "$(ls -A $DIR)" ]; then echo "Not Empty"; else echo "Empty"; fi
+    qemu.run("if [ ! -e /opt ]; then mkdir -p /opt && mount -t tmpfs -o size=500m tmpfs /opt; fi")
+
+
 def _do_test_setup(qemu: QemuCheriBSDInstance, args: argparse.Namespace, test_archives: "list[Path]",
                    test_ld_preload_files: "list[Path]",
                    test_setup_function: "Optional[Callable[[CheriBSDInstance, argparse.Namespace], None]]" = None):
     smb_dirs = qemu.smb_dirs
     setup_tests_starttime = datetime.datetime.now()
-    # Enable userspace CHERI exception logging to aid debugging
-    qemu.run("sysctl machdep.log_user_cheri_exceptions=1 || sysctl machdep.log_cheri_exceptions=1")
     if args.enable_coredumps:
         for smb_dir in smb_dirs:
             # If we are mounting /build or /test-results then set kern.corefile to point there:
@@ -948,23 +1296,13 @@ def _do_test_setup(qemu: QemuCheriBSDInstance, args: argparse.Namespace, test_ar
     else:
         # If not, disable coredumps, otherwise we get no space left on device errors
         qemu.run("sysctl kern.coredump=0")
-    # ensure that /usr/local exists and if not create it as a tmpfs (happens in the minimal image)
-    # However, don't do it on the full image since otherwise we would install kyua to the tmpfs on /usr/local
-    # We can differentiate the two by checking if /boot/kernel/kernel exists since it will be missing in the minimal
-    # image
-    qemu.run(
-        "if [ ! -e /boot/kernel/kernel ]; then mkdir -p /usr/local && mount -t tmpfs -o size=300m tmpfs /usr/local; fi")
-    # Or this: if [ "$(ls -A $DIR)" ]; then echo "Not Empty"; else echo "Empty"; fi
-    qemu.run("if [ ! -e /opt ]; then mkdir -p /opt && mount -t tmpfs -o size=500m tmpfs /opt; fi")
     qemu.run("df -ih")
     info("\nWill transfer the following archives: ", test_archives)
 
     def do_scp(src, dst="/"):
         # CVE-2018-20685 -> Can no longer use '.' See
         # https://superuser.com/questions/1403473/scp-error-unexpected-filename
-        scp_cmd = ["scp", "-B", "-r", "-P", str(qemu.ssh_port), "-o", "StrictHostKeyChecking=no",
-                   "-o", "UserKnownHostsFile=/dev/null",
-                   "-i", str(qemu.ssh_private_key), str(src), "root@localhost:" + dst]
+        scp_cmd = qemu.scp_command() + ["-B", "-r", str(src), "root@localhost:" + dst]
         # use script for a fake tty to get progress output from scp
         if sys.platform.startswith("linux"):
             scp_cmd = ["script", "--quiet", "--return", "--command", " ".join(scp_cmd), "/dev/null"]
@@ -973,6 +1311,8 @@ def _do_test_setup(qemu: QemuCheriBSDInstance, args: argparse.Namespace, test_ar
     for archive in test_archives:
         if smb_dirs:
             run_host_command(["tar", "xf", str(archive), "-C", str(smb_dirs[0].hostdir)])
+        elif args.stream_test_archives:
+            qemu.extract_archive_in_guest(archive, "/")
         else:
             # Extract to temporary directory and scp over
             with tempfile.TemporaryDirectory(dir=os.getcwd(), prefix="test_files_") as tmp:
@@ -1132,6 +1472,9 @@ def get_argument_parser() -> argparse.ArgumentParser:
                         dest="smb_mount_directories", type=parse_smb_mount, default=[])
     parser.add_argument("--test-archive", "-t", action="append", nargs=1)
     parser.add_argument("--test-command", "-c")
+    parser.add_argument("--stream-test-archives", action="store_true",
+                        help="Pipe the test archives into tar running in the guest over SSH instead of extracting them "
+                             "on the host and copying the files with scp (requires tar in the guest)")
     parser.add_argument('--test-ld-preload', action="append", nargs=1, metavar='LIB',
                         help="Copy LIB to the guest and LD_PRELOAD it before running tests")
     parser.add_argument('--extra-library-path', action="append", dest="extra_library_paths", metavar="DIR",
@@ -1157,6 +1500,18 @@ def get_argument_parser() -> argparse.ArgumentParser:
     parser.add_argument("--alternate-kernel-rootfs-path", type=Path, default=None,
                         help="Path relative to the disk image pointing to the directory " +
                              "containing the alternate kernel to run and related kernel modules")
+    parser.add_argument("--boot-snapshot-cache", type=Path, default=None, metavar="DIR",
+                        help="Save a QEMU snapshot of the booted and logged in instance in DIR and restore it instead "
+                             "of booting if the kernel, disk image and QEMU command line have not changed")
+    parser.add_argument("--disk-image-overlay", action="store_true", default=False,
+                        help="Write changes to the disk image to a copy-on-write qcow2 overlay instead of using QEMU's "
+                             "-snapshot mode. This allows parallel test shards to share the same base image.")
+    parser.add_argument("--no-disk-image-overlay", action="store_false", dest="disk_image_overlay")
+    parser.add_argument("--disk-image-overlay-dir", type=Path, default=None, metavar="DIR",
+                        help="Directory for the disk image overlay (default: /dev/shm if available)")
+    parser.add_argument("--keep-disk-image-overlay", action="store_true",
+                        help="Don't delete the disk image overlay on exit (implies --disk-image-overlay). Useful for "
+                             "inspecting the state of the disk image after a failed test run.")
 
     # Ensure that we don't get a race when running multiple shards:
     # If we extract the disk image at the same time we might spawn QEMU just between when the
@@ -1291,24 +1646,52 @@ def _main(test_function: "Optional[Callable[[CheriBSDInstance, argparse.Namespac
         diskimg = maybe_decompress(Path(args.disk_image), force_decompression, keep_archive=keep_compressed_images,
                                    args=args, what="disk image")
 
+    boot_snapshot_cache = None
+    will_run_tests = bool(test_archives or args.test_command or test_function) and not args.test_kernel_init_only
+    if args.boot_snapshot_cache is not None:
+        if not will_run_tests or args.write_disk_image_changes or PRETEND:
+            info("Not using a boot snapshot since we are not running tests on an immutable disk image")
+        else:
+            boot_snapshot_cache = args.boot_snapshot_cache.absolute()
+    disk_image_format = "raw"
+    write_disk_image_changes = args.write_disk_image_changes
+    if (args.disk_image_overlay or args.keep_disk_image_overlay) and diskimg is not None:
+        qemu_img = find_qemu_img(args.qemu_cmd)
+        if write_disk_image_changes or boot_snapshot_cache is not None:
+            info("Not creating a disk image overlay since changes are written to the disk image or boot snapshot")
+        elif qemu_img is None:
+            warn("Cannot find qemu-img, falling back to -snapshot instead of a disk image overlay")
+        else:
+            shard = getattr(args, "internal_shard", None)
+            diskimg = create_disk_image_overlay(qemu_img, diskimg, overlay_dir=args.disk_image_overlay_dir,
+                                                keep=args.keep_disk_image_overlay,
+                                                name_suffix="-shard" + str(shard) if shard else "")
+            disk_image_format = "qcow2"
+            # All writes go to the overlay, so -snapshot is not needed.
+            write_disk_image_changes = True
     boot_starttime = datetime.datetime.now()
     qemu = boot_cheribsd(qemu_options, qemu_command=args.qemu_cmd, kernel_image=kernel, disk_image=diskimg,
                          ssh_port=args.ssh_port, ssh_pubkey=Path(args.ssh_key) if args.ssh_key is not None else None,
                          smb_dirs=args.smb_mount_directories, kernel_init_only=args.test_kernel_init_only,
                          smp_args=["-smp", str(args.qemu_smp)] if args.qemu_smp else [],
                          trap_on_unrepresentable=args.trap_on_unrepresentable, skip_ssh_setup=args.skip_ssh_setup,
-                         bios_path=args.bios, write_disk_image_changes=args.write_disk_image_changes,
-                         boot_alternate_kernel_dir=args.alternate_kernel_rootfs_path)
+                         bios_path=args.bios, write_disk_image_changes=write_disk_image_changes,
+                         boot_alternate_kernel_dir=args.alternate_kernel_rootfs_path,
+                         boot_snapshot_cache=boot_snapshot_cache, disk_image_format=disk_image_format)
     success("Booting CheriBSD took: ", datetime.datetime.now() - boot_starttime)
 
     tests_okay = True
-    if (test_archives or args.test_command or test_function) and not args.test_kernel_init_only:
+    if will_run_tests:
         # noinspection PyBroadException
         try:
-            if not args.skip_ssh_setup:
-                setup_ssh_starttime = datetime.datetime.now()
-                setup_ssh_for_root_login(qemu)
-                info("Setting up SSH took: ", datetime.datetime.now() - setup_ssh_starttime)
+            if qemu.boot_snapshot is None or not qemu.boot_snapshot.restoring:
+                if not args.skip_ssh_setup:
+                    setup_ssh_starttime = datetime.datetime.now()
+                    setup_ssh_for_root_login(qemu)
+                    info("Setting up SSH took: ", datetime.datetime.now() - setup_ssh_starttime)
+                _do_common_test_setup(qemu)
+                if qemu.boot_snapshot is not None:
+                    qemu.boot_snapshot.save(qemu)
             tests_okay = runtests(qemu, args, test_archives=test_archives, test_function=test_function,
                                   test_setup_function=test_setup_function, test_ld_preload_files=test_ld_preload_files)
         except CheriBSDCommandFailed as e:
@@ -1350,11 +1733,14 @@ def main(test_function: "Optional[Callable[[CheriBSDInstance, argparse.Namespace
          argparse_setup_callback: "Optional[Callable[[argparse.ArgumentParser], None]]" = None,
          argparse_adjust_args_callback: "Optional[Callable[[argparse.Namespace], None]]" = None):
     # Some programs (such as QEMU) can mess up the TTY state if they don't exit cleanly
-    with keep_terminal_sane():
-        run_and_kill_children_on_exit(
-            lambda: _main(test_function=test_function, test_setup_function=test_setup_function,
-                          argparse_setup_callback=argparse_setup_callback,
-                          argparse_adjust_args_callback=argparse_adjust_args_callback))
+    try:
+        with keep_terminal_sane():
+            run_and_kill_children_on_exit(
+                lambda: _main(test_function=test_function, test_setup_function=test_setup_function,
+                              argparse_setup_callback=argparse_setup_callback,
+                              argparse_adjust_args_callback=argparse_adjust_args_callback))
+    finally:
+        _run_exit_hooks()
 
 
 if __name__ == "__main__":
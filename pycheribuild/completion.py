@@ -0,0 +1,202 @@
+#
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+# Note: This module is imported by cheribuild.py before anything else when tab-completing, so it must not import any of
+# the other cheribuild modules (other than target_index.py) to keep completion fast.
+import json
+import os
+import sys
+import typing
+from pathlib import Path
+from typing import Optional
+
+from .target_index import TargetIndex
+
+__all__ = ["CompletionIndex", "complete_from_index", "set_benchmark_environment"]  # no-combine
+
+
+def set_benchmark_environment() -> None:
+    # Used by tests/benchmark_argcomplete.sh
+    os.environ["_ARGCOMPLETE_IFS"] = "\n"
+    # os.environ["COMP_LINE"] = "cheribuild.py " # return all targets
+    if "COMP_LINE" not in os.environ:
+        # return all options starting with --sq
+        os.environ["COMP_LINE"] = "cheribuild.py foo --enable-hybrid-for-purecap-rootfs-targets --sq"
+    os.environ["COMP_POINT"] = str(len(os.environ["COMP_LINE"]))
+
+
+class CompletionIndex(object):
+    """
+    The visible target names and all command line options (including the ones for every target) of cheribuild.py.
+    This allows answering most tab-completion requests without importing the projects and creating an argparse parser
+    with tens of thousands of options, which takes multiple seconds.
+    """
+    FORMAT_VERSION = 1
+    # Flags stored for each option string:
+    TAKES_VALUE = 1
+    REPEATABLE = 2
+
+    def __init__(self, targets: "list[str]", options: "dict[str, int]") -> None:
+        self.targets = targets
+        # Options are grouped by the part before the "/" (i.e. the target name, "" for the global options). Groups are
+        # stored as separate lines in the index file and only parsed if they can match the word that is being completed.
+        groups: "dict[str, dict[str, int]]" = {}
+        for option, flags in options.items():
+            groups.setdefault(self._group_name(option), {})[option] = flags
+        self._groups: "dict[str, typing.Union[str, dict[str, int]]]" = dict(groups)
+
+    @staticmethod
+    def _group_name(option: str) -> str:
+        return option[2:].partition("/")[0] if "/" in option else ""
+
+    def _group(self, group: str) -> "dict[str, int]":
+        options = self._groups.get(group, {})
+        if isinstance(options, str):
+            options = json.loads(options)
+            self._groups[group] = options
+        return options
+
+    @property
+    def options(self) -> "dict[str, int]":
+        result: "dict[str, int]" = {}
+        for group in self._groups:
+            result.update(self._group(group))
+        return result
+
+    @staticmethod
+    def default_path() -> Path:
+        return TargetIndex.cache_file_path("completion-index")
+
+    @staticmethod
+    def _header() -> str:
+        return json.dumps({"version": CompletionIndex.FORMAT_VERSION, "fingerprint": TargetIndex.source_fingerprint()})
+
+    # The first line of the file contains the version and source fingerprint, so that we can check whether it is up to
+    # date without parsing the whole index.
+    @classmethod
+    def is_up_to_date(cls, path: "Optional[Path]" = None) -> bool:
+        try:
+            with (path or cls.default_path()).open("r", encoding="utf-8") as f:
+                return f.readline().rstrip("\n") == cls._header()
+        except OSError:
+            return False
+
+    @classmethod
+    def load(cls, path: "Optional[Path]" = None) -> "Optional[CompletionIndex]":
+        try:
+            with (path or cls.default_path()).open("r", encoding="utf-8") as f:
+                if f.readline().rstrip("\n") != cls._header():
+                    return None
+                result = cls(json.loads(f.readline()), {})
+                for line in f:
+                    group, _, options = line.rstrip("\n").partition("\t")
+                    result._groups[group] = options
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def save(self, path: "Optional[Path]" = None) -> None:
+        lines = [self._header(), json.dumps(self.targets, separators=(",", ":"))]
+        for group in sorted(self._groups):
+            lines.append(group + "\t" + json.dumps(self._group(group), separators=(",", ":")))
+        TargetIndex.write_cache_file(path or self.default_path(), "\n".join(lines) + "\n")
+
+    def completions(self, words: "list[str]", prefix: str) -> "Optional[list[str]]":
+        """
+        :param words: the words before the one that is being completed (excluding the program name)
+        :param prefix: the partial word that is being completed
+        :return: the matching target names and options or None if the full argparse parser is needed (e.g. when
+        completing the value of an option).
+        """
+        if words and words[-1].startswith("-"):
+            flags = self._group(self._group_name(words[-1])).get(words[-1])
+            if flags is None or flags & self.TAKES_VALUE:
+                return None  # value for an option (or an abbreviated option name)
+        if not prefix.startswith("-"):
+            return [t for t in self.targets if t.startswith(prefix)]
+        # Like argcomplete, don't suggest options that have already been used unless they can be repeated
+        used = set(words)
+        result = []
+        for group in self._groups:
+            group_prefix = "--" + group + "/" if group else ""
+            if group_prefix.startswith(prefix) or prefix.startswith(group_prefix):
+                result.extend(o for o, flags in self._group(group).items() if o.startswith(prefix) and (
+                    o not in used or flags & self.REPEATABLE))
+        return result
+
+
+def _quote_completions(completions: "list[str]") -> "list[str]":
+    # Same escaping as argcomplete for unquoted words in bash.
+    for char in "\\();<>|&!`$*?[]{} \t\n\"'":
+        completions = [c.replace(char, "\\" + char) for c in completions]
+    # If the completion hook doesn't handle it, we have to add the space after a unique completion.
+    if os.getenv("_ARGCOMPLETE_SUPPRESS_SPACE") != "1" and len(completions) == 1 and completions[0][-1] not in "=/:":
+        completions[0] += " "
+    return completions
+
+
+def complete_from_index() -> None:
+    """
+    Answer an argcomplete tab-completion request using the completion index. This returns if the request can't be
+    handled using the index (if it does not exist or is out of date, or for words containing quotes and option values),
+    in which case the normal argcomplete code path should be used. Otherwise, this function exits the process.
+    """
+    # _ARGCOMPLETE is the index of the first argument in COMP_LINE (e.g. 2 for "python3 cheribuild.py ...").
+    first_arg = os.getenv("_ARGCOMPLETE", "")
+    if not first_arg.isdigit() or os.getenv("_ARGCOMPLETE_SHELL", "bash") != "bash" or "_ARGCOMPLETE_DFS" in os.environ:
+        return
+    benchmarking = "_ARGCOMPLETE_BENCHMARK" in os.environ
+    if benchmarking:
+        set_benchmark_environment()
+    comp_line = os.getenv("COMP_LINE")
+    comp_point = os.getenv("COMP_POINT", "")
+    if comp_line is None or not comp_point.isdigit():
+        return
+    line = comp_line[:int(comp_point)]
+    # Let argcomplete handle shell quoting, --option=value and bash COMP_WORDBREAKS characters.
+    if any(c in line for c in "\"'\\=:$`"):
+        return
+    words = line.split()
+    prefix = words.pop() if words and not line[-1].isspace() else ""
+    index = CompletionIndex.load()
+    if index is None:
+        return
+    completions = index.completions(words[int(first_arg):], prefix)
+    if completions is None:
+        return
+    output: "typing.TextIO"
+    try:
+        if benchmarking:
+            output = open(os.getenv("_ARGCOMPLETE_OUTPUT_PATH", os.devnull), "w")
+        elif "_ARGCOMPLETE_STDOUT_FILENAME" in os.environ:
+            output = open(os.environ["_ARGCOMPLETE_STDOUT_FILENAME"], "w")
+        else:
+            output = os.fdopen(8, "w")  # the bash completion hook reads the result from fd 8
+    except OSError:
+        return
+    output.write(os.getenv("_ARGCOMPLETE_IFS", "\013").join(_quote_completions(completions)))
+    output.flush()
+    if benchmarking:
+        sys.exit(0)  # ensure that cprofile data is written
+    os._exit(0)
@@ -27,7 +27,6 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
-import collections
 import getpass
 import grp
 import os
@@ -50,6 +49,9 @@ from ..utils import (
     warning_message,
 )
 
+if typing.TYPE_CHECKING:  # no-combine
+    from ..targets import DependencyGraph  # no-combine
+
 
 class BuildType(Enum):
     DEFAULT = "Default"
@@ -145,7 +147,8 @@ class CheriConfig(ConfigBase):
     def __init__(self, loader, action_class) -> None:
         super().__init__(pretend=DoNotUseInIfStmt(), verbose=DoNotUseInIfStmt(), quiet=DoNotUseInIfStmt(),
                          force=DoNotUseInIfStmt())
-        self._cached_deps = collections.defaultdict(dict)
+        # Memoized dependency closures, created on first use by DependencyGraph.for_config()
+        self._dependency_graph = None  # type: Optional[DependencyGraph]
 
         assert isinstance(loader, ConfigLoaderBase)
         loader._cheri_config = self
@@ -287,6 +290,12 @@ class CheriConfig(ConfigBase):
                                                      help="Only run the configure step (skip build and install)")
         self.skip_install = loader.add_bool_option("skip-install", help="Skip the install step (only do the build)")
         self.skip_build = loader.add_bool_option("skip-build", help="Skip the build step (only do the install)")
+        self.skip_unchanged_builds = loader.add_bool_option(
+            "skip-unchanged-builds",
+            help="Record a fingerprint of the source revision (including uncommitted changes), the build options, the "
+                 "compiler and the dependencies in the build directory and skip the configure/build/install steps if "
+                 "none of these have changed since the last successful build. Currently only supported for CMake "
+                 "and Meson projects whose configure arguments are known before the configure step.")
         self.skip_sdk = loader.add_bool_option(
             "skip-sdk", group=loader.dependencies_group,
             help="When building with --include-dependencies ignore the SDK dependencies. Saves a lot of time "
@@ -313,6 +322,15 @@ class CheriConfig(ConfigBase):
         self.only_dependencies = loader.add_bool_option("only-dependencies",
                                                         help="Only build dependencies of targets, "
                                                              "not the targets themselves")
+        self.parallel_targets = loader.add_option(
+            "parallel-targets", type=int, default=1, metavar="N", group=loader.dependencies_group,
+            help="Execute up to N independent targets concurrently (e.g. qemu and llvm-native). Targets are only "
+                 "started once all of their dependencies have been built and the --make-jobs budget is shared "
+                 "between the targets that are currently running. Has no effect with --pretend.")
+        self.timing_trace = loader.add_optional_path_option(
+            "timing-trace", metavar="JSON",
+            help="Record wall time, CPU time and peak memory usage of every target, build step and command and write "
+                 "them to the given file in Chrome trace event format (can be viewed with https://ui.perfetto.dev)")
         self.start_with = None  # type: Optional[str]
         self.start_after = None  # type: Optional[str]
         self.make_without_nice = None  # type: Optional[bool]
@@ -393,6 +411,10 @@ class CheriConfig(ConfigBase):
                                                                            "paths set up.")
         self.test_ld_preload = loader.add_optional_path_option("test-ld-preload", group=loader.tests_group,
                                                                help="Preload the given library before running tests")
+        self.test_boot_snapshot_cache = loader.add_optional_path_option(
+            "test-boot-snapshot-cache", group=loader.tests_group, metavar="DIR",
+            help="Directory for QEMU snapshots of booted CheriBSD instances that are used to skip the boot and login "
+                 "when running tests again with the same kernel, disk image and QEMU binary.")
 
         self.benchmark_fpga_extra_args = loader.add_commandline_only_option(
             "benchmark-fpga-extra-args", group=loader.benchmark_group, type=list, metavar="ARGS",
@@ -431,6 +453,23 @@ class CheriConfig(ConfigBase):
             "shallow-clone", default=True,
             help="Perform a shallow `git clone` when cloning new projects. This can save a lot of time for large"
                  "repositories such as FreeBSD or LLVM. Use `git fetch --unshallow` to convert to a non-shallow clone")
+        self.fetch_concurrently = loader.add_bool_option(
+            "fetch-concurrently", default=True,
+            help="Run `git fetch` for the existing checkouts of all selected targets concurrently before building "
+                 "instead of fetching each repository in the update step of the target.")
+        self.partial_clone = loader.add_bool_option(
+            "partial-clone", default=False,
+            help="Perform a partial (blobless) `git clone --filter=blob:none` when cloning new projects. Unlike "
+                 "--shallow-clone this keeps the full commit history (which is needed to check whether updates are "
+                 "required and to switch branches) and only downloads file contents when they are checked out. "
+                 "Takes precedence over --shallow-clone.")
+        self.git_reference_mirror = loader.add_optional_path_option(
+            "git-reference-mirror", metavar="DIR",
+            help="Path to a bare git repository (created if missing) that mirrors the objects of all repositories "
+                 "cloned by cheribuild. New clones use it as a reference repository (git alternates), so that forks "
+                 "such as CheriBSD/FreeBSD or the LLVM variants share their objects instead of downloading and storing "
+                 "them once per checkout. Note: checkouts created this way must not outlive the mirror. This option "
+                 "takes precedence over --shallow-clone and --partial-clone.")
 
         self.fpga_custom_env_setup_script = loader.add_optional_path_option(
             "beri-fpga-env-setup-script", group=loader.path_group,
@@ -456,7 +495,8 @@ class CheriConfig(ConfigBase):
                                          "test suites on the remote board instead of QEMU.")
 
         self.targets: "Optional[list[str]]" = None
-        self.__optional_properties = ["internet_connection_last_checked_at", "start_after", "start_with"]
+        self.__optional_properties = ["internet_connection_last_checked_at", "start_after", "start_with",
+                                      "_dependency_graph"]
 
     def load(self) -> None:
         self.loader.load()
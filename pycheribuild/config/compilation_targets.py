@@ -474,7 +474,7 @@ class FreeBSDTargetInfo(_ClangBasedTargetInfo):
             use_benchmark_config_option = inspect.getattr_static(self.config, "use_minimal_benchmark_kernel")
             assert isinstance(use_benchmark_config_option, ConfigOptionBase)
             want_benchmark_kernel = use_benchmark_kernel_value or (
-                    use_benchmark_kernel_by_default and use_benchmark_config_option.is_default_value)
+                    use_benchmark_kernel_by_default and use_benchmark_config_option.is_default_value(self.config))
             kernel_path = self._get_mfs_root_kernel(ConfigPlatform.QEMU, want_benchmark_kernel)
             if (kernel_path is None or not kernel_path.exists()) and is_jenkins_build():
                 jenkins_kernel_path = self.config.cheribsd_image_root / "kernel.xz"
@@ -523,6 +523,8 @@ class FreeBSDTargetInfo(_ClangBasedTargetInfo):
             cmd.append("--test-environment-only")
         if self.config.trap_on_unrepresentable:
             cmd.append("--trap-on-unrepresentable")
+        if self.config.test_boot_snapshot_cache and not has_test_extra_arg_override("--boot-snapshot-cache"):
+            cmd.extend(["--boot-snapshot-cache", self.config.test_boot_snapshot_cache])
         if self.config.test_ld_preload:
             cmd.append("--test-ld-preload=" + str(self.config.test_ld_preload))
             if xtarget.is_cheri_purecap() and not rootfs_xtarget.is_cheri_purecap():
@@ -78,7 +78,16 @@ class ConfigLoaderBase(ABC):
         self.__option_cls: "type[ConfigOptionBase]" = option_cls
         self.__command_line_only_options_cls: "type[ConfigOptionBase]" = command_line_only_options_cls
         self.unknown_config_option_is_error = False
+        # Set if not all projects have been loaded: returns True if a config file key is a valid option of one of the
+        # targets that have not been loaded yet (see TargetManager.use_target_index()).
+        self.is_declared_target_option: "Optional[Callable[[str], bool]]" = None
         self.completion_excludes = []
+        # Loaded option values and whether they are the default value, indexed by (option name, id(config),
+        # id(instance)). The config and instance objects are also stored in the value to ensure that their ids can't be
+        # reused before the next reset().
+        self._resolved_values: "dict[tuple[str, int, int], tuple[ConfigBase, object, typing.Any, bool]]" = {}
+        # Number of times an option value had to be loaded (i.e. was not cached), useful to check that it stays low.
+        self.option_resolution_count = 0
         # Add argparse groups
         self.action_group = self.add_argument_group("Actions to be performed")
         self.dependencies_group = self.add_argument_group("Selecting which dependencies are built")
@@ -149,8 +158,22 @@ class ConfigLoaderBase(ABC):
         self.load()
 
     def reset(self) -> None:
-        for option in self.options.values():
-            option._cached = None
+        self._resolved_values.clear()
+
+    def _resolve_option(self, option: "ConfigOptionBase[T]", config: ConfigBase, instance: "Optional[object]",
+                        owner: type) -> T:
+        key = (option.name, id(config), id(instance))
+        cached = self._resolved_values.get(key)
+        if cached is not None:
+            return cached[2]
+        result, is_default = option._load_option_and_is_default(config, instance)
+        self._resolved_values[key] = (config, instance, result, is_default)
+        return result
+
+    def _is_default_value(self, option: "ConfigOptionBase", config: ConfigBase, instance: "Optional[object]") -> bool:
+        cached = self._resolved_values.get((option.name, id(config), id(instance)))
+        assert cached is not None, "Must load value before calling is_default_value()"
+        return cached[3]
 
     def debug_msg(self, *args, sep=" ", **kwargs) -> None:
         pass
@@ -182,16 +205,20 @@ class ConfigOptionBase(typing.Generic[T]):
         self.shortname = shortname
         self.default = default
         self.value_type = value_type
-        self._cached: "Optional[T]" = None
         self._loader = _loader
         # if none it means the global CheriConfig is the class containing this option
         self._owning_class = _owning_class
         self._fallback_names = _fallback_names  # for targets such as gdb-mips, etc
         self.alias_names = _legacy_alias_names  # for targets such as gdb-mips, etc
-        self._is_default_value = False
 
     def load_option(self, config: "ConfigBase", instance: "Optional[object]", _: type,
                     return_none_if_default=False) -> T:
+        return self._load_option_and_is_default(config, instance, return_none_if_default=return_none_if_default)[0]
+
+    def _load_option_and_is_default(self, config: "ConfigBase", instance: "Optional[object]",
+                                    return_none_if_default=False) -> "tuple[Optional[T], bool]":
+        self._loader.option_resolution_count += 1
+        is_default = False
         result = self._load_option_impl(config, self.full_option_name)
         # fall back from --qtbase-mips/foo to --qtbase/foo
         # Try aliases first:
@@ -214,11 +241,12 @@ class ConfigOptionBase(typing.Generic[T]):
 
         if result is None:  # If no option is set fall back to the default
             if return_none_if_default:
-                return None  # Used in jenkins to avoid updating install directory for explicit options on commandline
+                # Used in jenkins to avoid updating install directory for explicit options on commandline
+                return None, True
             result = self._get_default_value(config, instance)
             if result is not None:
                 result = _LoadedConfigValue(result, None)
-            self._is_default_value = True
+            is_default = True
         # Now convert it to the right type
         try:
             result = self._convert_type(result)
@@ -226,7 +254,7 @@ class ConfigOptionBase(typing.Generic[T]):
             fatal_error("Invalid value for option '", self.full_option_name,
                         "': could not convert '", result, "': ", str(e), sep="", pretend=config.pretend)
             sys.exit()
-        return result
+        return result, is_default
 
     def _load_option_impl(self, config: "ConfigBase", target_option_name) -> "Optional[_LoadedConfigValue]":
         # target_option_name may not be the same as self.full_option_name if we are loading the fallback value
@@ -239,10 +267,13 @@ class ConfigOptionBase(typing.Generic[T]):
     def full_option_name(self) -> str:
         return self.name
 
-    @property
-    def is_default_value(self) -> bool:
-        assert self._cached is not None, "Must load value before calling is_default_value()"
-        return self._is_default_value
+    def is_default_value(self, instance: "Optional[object]") -> bool:
+        """
+        :return: whether the value that was loaded for instance (the object that the option was accessed on) is the
+        default value.
+        """
+        # noinspection PyProtectedMember
+        return self._loader._is_default_value(self, self._loader._cheri_config, instance)
 
     def __get__(self, instance, owner) -> T:
         assert instance is not None or not callable(self.default), \
@@ -253,10 +284,8 @@ class ConfigOptionBase(typing.Generic[T]):
         # if instance is None:
         #     return self
         assert not self._owning_class or issubclass(owner, self._owning_class)
-        if self._cached is None:
-            # noinspection PyProtectedMember
-            self._cached = self.load_option(self._loader._cheri_config, instance, owner)
-        return self._cached
+        # noinspection PyProtectedMember
+        return self._loader._resolve_option(self, self._loader._cheri_config, instance, owner)
 
     def _get_default_value(self, config: "ConfigBase", instance: "Optional[object]" = None) -> _LoadedConfigValue:
         if callable(self.default):
@@ -296,7 +325,7 @@ class ConfigOptionBase(typing.Generic[T]):
         return result
 
     def __repr__(self) -> str:
-        return "<{}({}) type={} cached={}>".format(self.__class__.__name__, self.name, self.value_type, self._cached)
+        return "<{}({}) type={} default={}>".format(self.__class__.__name__, self.name, self.value_type, self.default)
 
 
 class DefaultValueOnlyConfigOption(ConfigOptionBase[T]):
@@ -64,13 +64,13 @@ class DefaultCheribuildConfigLoader(JsonAndCommandLineConfigLoader):
     def finalize_options(self, available_targets: list, **kwargs) -> None:
         target_option = self._parser.add_argument("targets", metavar="TARGET", nargs=argparse.ZERO_OR_MORE,
                                                   help="The targets to build")
+        # Note: also used for the completion index, so this is set even if we are not completing.
+        # if OSInfo.IS_FREEBSD: # FIXME: for some reason this won't work
+        self.completion_excludes = ["-t", "--skip-dependencies"]
+        if sys.platform.startswith("freebsd"):
+            self.completion_excludes += ["--freebsd-builder-copy-only", "--freebsd-builder-hostname",
+                                         "--freebsd-builder-output-path"]
         if argcomplete and self.is_completing_arguments:
-            # if OSInfo.IS_FREEBSD: # FIXME: for some reason this won't work
-            self.completion_excludes = ["-t", "--skip-dependencies"]
-            if sys.platform.startswith("freebsd"):
-                self.completion_excludes += ["--freebsd-builder-copy-only", "--freebsd-builder-hostname",
-                                             "--freebsd-builder-output-path"]
-
             visible_targets = available_targets.copy()
             visible_targets.remove("__run_everything__")
             target_completer = argcomplete.completers.ChoicesCompleter(visible_targets)
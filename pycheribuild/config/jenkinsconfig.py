@@ -149,8 +149,16 @@ class JenkinsConfig(CheriConfig):
             help="Override the path to the Morello SDK (default is $WORKSPACE/morello-sdk)")
         self.extract_compiler_only = loader.add_commandline_only_bool_option(
             "extract-compiler-only", help="Don't attempt to extract a sysroot")
+        self.tarball_compression = loader.add_commandline_only_option(
+            "tarball-compression", default="xz", choices=("xz", "zstd"),
+            help="The compression program used for --create-tarball")
+        self.tarball_compression_threads = loader.add_commandline_only_option(
+            "tarball-compression-threads", type=int,
+            default=ComputedDefaultValue(lambda conf, _: conf.make_jobs, "same as --make-jobs"),
+            help="Number of threads used to compress the tarball")
         self.tarball_name = loader.add_commandline_only_option(
-            "tarball-name", default=lambda conf, cls: conf.targets[0] + "-" + conf.cpu + ".tar.xz")
+            "tarball-name", default=lambda conf, cls: conf.targets[0] + "-" + conf.cpu + (
+                ".tar.zst" if conf.tarball_compression == "zstd" else ".tar.xz"))
 
         self.default_output_path = "tarball"
         default_output = ComputedDefaultValue(lambda c, _: c.workspace / c.default_output_path,
@@ -47,6 +47,7 @@ from pathlib import Path
 from .computed_default_value import ComputedDefaultValue
 from .config_loader_base import ConfigLoaderBase, ConfigOptionBase, DefaultValueOnlyConfigOption, _LoadedConfigValue
 from ..colour import AnsiColour, coloured
+from ..completion import CompletionIndex, set_benchmark_environment
 from ..utils import ConfigBase, error_message, fatal_error, status_update, warning_message
 
 T = typing.TypeVar('T')
@@ -126,12 +127,7 @@ class NoOpHelpFormatter(argparse.HelpFormatter):
 
 def get_argcomplete_prefix() -> str:
     if "_ARGCOMPLETE_BENCHMARK" in os.environ:
-        os.environ["_ARGCOMPLETE_IFS"] = "\n"
-        # os.environ["COMP_LINE"] = "cheribuild.py " # return all targets
-        if "COMP_LINE" not in os.environ:
-            # return all options starting with --sq
-            os.environ["COMP_LINE"] = "cheribuild.py foo --enable-hybrid-for-purecap-rootfs-targets --sq"
-        os.environ["COMP_POINT"] = str(len(os.environ["COMP_LINE"]))
+        set_benchmark_environment()
     assert argcomplete is not None
     comp_line = os.environ["COMP_LINE"]
     result = argcomplete.split_line(comp_line, int(os.environ["COMP_POINT"]))[1]
@@ -273,7 +269,11 @@ class CommandLineConfigOption(ConfigOptionBase[T]):
     def _load_from_commandline(self) -> "Optional[_LoadedConfigValue]":
         assert self._loader._parsed_args  # load() must have been called before using this object
         # FIXME: check the fallback name here
-        assert hasattr(self._loader._parsed_args, self.action.dest)
+        if not hasattr(self._loader._parsed_args, self.action.dest):
+            # Options of targets that are loaded on demand are registered after parsing the command line. Those
+            # targets were not referenced on the command line, so none of their options can have been set there.
+            assert self._loader.is_declared_target_option is not None, "Option added after parsing: " + self.name
+            return None
         result = getattr(self._loader._parsed_args, self.action.dest)  # from command line
         if result is None:
             return None
@@ -431,8 +431,13 @@ class CommandLineConfigLoader(ConfigLoaderBase):
         return super().add_option(name, shortname, default=default, type=type, group=group, help_hidden=help_hidden,
                                   **kwargs)
 
+    @property
+    def debug_output_enabled(self) -> bool:
+        # Can be used to avoid computing expensive debug_msg() arguments (e.g. JSON serialization) if they are unused.
+        return bool(self._parsed_args) and self._parsed_args.verbose is True
+
     def debug_msg(self, *args, sep=" ", **kwargs) -> None:
-        if self._parsed_args and self._parsed_args.verbose is True:
+        if self.debug_output_enabled:
             print(coloured(AnsiColour.cyan, *args, sep=sep), file=sys.stderr, **kwargs)
 
     def _load_command_line_args(self) -> None:
@@ -518,6 +523,26 @@ class CommandLineConfigLoader(ConfigLoaderBase):
     def load(self) -> None:
         self._load_command_line_args()
 
+    def register_all_options_when_completing(self) -> None:
+        # Needed to create the completion index, since normally only the options matching the current prefix are added.
+        self._argcomplete_prefix = None
+
+    def create_completion_index(self, targets: "list[str]") -> CompletionIndex:
+        assert self._argcomplete_prefix is None, "Some options were not registered"
+        options: "dict[str, int]" = {}
+        # noinspection PyProtectedMember
+        for action in self._parser._actions:
+            flags = 0
+            if action.nargs != 0:
+                flags |= CompletionIndex.TAKES_VALUE
+            # noinspection PyProtectedMember
+            if isinstance(action, (argparse._AppendAction, argparse._CountAction)):
+                flags |= CompletionIndex.REPEATABLE
+            for option_string in action.option_strings:
+                if option_string not in self.completion_excludes:
+                    options[option_string] = flags
+        return CompletionIndex(targets, options)
+
 
 class JsonAndCommandLineConfigLoader(CommandLineConfigLoader):
     def __init__(self, argparser_class: "type[argparse.ArgumentParser]" = argparse.ArgumentParser, *,
@@ -563,8 +588,9 @@ class JsonAndCommandLineConfigLoader(CommandLineConfigLoader):
             else:
                 result = json.loads("".join(json_lines),
                                     object_pairs_hook=lambda o: dict_raise_on_duplicates_and_store_src(o, config_path))
-            self.debug_msg("Parsed", config_path, "as",
-                           coloured(AnsiColour.cyan, json.dumps(result, cls=MyJsonEncoder)))
+            if self.debug_output_enabled:
+                self.debug_msg("Parsed", config_path, "as",
+                               coloured(AnsiColour.cyan, json.dumps(result, cls=MyJsonEncoder)))
             return result
 
     # Based on https://stackoverflow.com/a/7205107/894271
@@ -580,7 +606,7 @@ class JsonAndCommandLineConfigLoader(CommandLineConfigLoader):
                 if a[key].is_nested_dict() and b[key].is_nested_dict():
                     self.merge_dict_recursive(a[key].value, b[key].value, included_file, base_file, path + [str(key)])
                 elif a[key] != b[key]:
-                    if self._parsed_args:
+                    if self.debug_output_enabled:
                         self.debug_msg("Overriding '" + '.'.join(path + [str(key)]) + "' value", b[key], " from",
                                        included_file, "with value ", a[key], "from", base_file)
                 else:
@@ -605,7 +631,8 @@ class JsonAndCommandLineConfigLoader(CommandLineConfigLoader):
             del result["#include"]
             result = self.merge_dict_recursive(result, included_json, included_path, config_path)
             self.debug_msg(coloured(AnsiColour.cyan, "Merging JSON config file", included_path))
-            self.debug_msg("New result is", coloured(AnsiColour.cyan, json.dumps(result, cls=MyJsonEncoder)))
+            if self.debug_output_enabled:
+                self.debug_msg("New result is", coloured(AnsiColour.cyan, json.dumps(result, cls=MyJsonEncoder)))
 
         return result
 
@@ -685,6 +712,9 @@ class JsonAndCommandLineConfigLoader(CommandLineConfigLoader):
                         found_option = option  # fine
                         break
 
+        if found_option is None and self.is_declared_target_option is not None and \
+                self.is_declared_target_option(fullname):
+            return True
         if found_option is not None:
             # Found an option, now verify that it's not a command-line only option
             if not isinstance(found_option, JsonAndCommandLineConfigOption):
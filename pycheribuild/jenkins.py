@@ -33,7 +33,10 @@ import inspect
 import os
 import pprint
 import shutil
+import signal
+import subprocess
 import sys
+import time
 
 # noinspection PyUnresolvedReferences
 from pathlib import Path
@@ -41,7 +44,7 @@ from typing import Optional
 
 from .config.jenkinsconfig import JenkinsAction, JenkinsConfig
 from .config.loader import CommandLineConfigLoader, CommandLineConfigOption
-from .processutils import get_program_version, run_and_kill_children_on_exit, run_command
+from .processutils import commandline_to_str, get_program_version, run_and_kill_children_on_exit, run_command
 
 # make sure all projects are loaded so that target_manager gets populated
 # noinspection PyUnresolvedReferences
@@ -53,7 +56,16 @@ from .projects.cross.crosscompileproject import CrossCompileMixin
 from .projects.project import Project
 from .projects.simple_project import SimpleProject
 from .targets import SimpleTargetAlias, Target, target_manager
-from .utils import OSInfo, ThreadJoiner, fatal_error, init_global_config, status_update, warning_message
+from .utils import (
+    AnsiColour,
+    OSInfo,
+    ThreadJoiner,
+    coloured,
+    fatal_error,
+    init_global_config,
+    status_update,
+    warning_message,
+)
 
 EXTRACT_SDK_TARGET: str = "extract-sdk"
 RUN_EVERYTHING_TARGET: str = "__run_everything__"
@@ -304,56 +316,92 @@ def build_target(cheri_config, target: Target) -> None:
             target.run_tests(cheri_config)
 
 
-def create_tarball(cheri_config) -> None:
-    if True:  # Note: This if exists for now to avoid a large whitespace diff.
-        bsdtar_path = shutil.which("bsdtar")
-        tar_cmd = None
-        tar_flags = ["--invalid-flag"]
-        if bsdtar_path:
-            bsdtar_version = get_program_version(Path(bsdtar_path), regex=b"bsdtar\\s+(\\d+)\\.(\\d+)\\.?(\\d+)?",
-                                                 config=cheri_config)
-            if bsdtar_version > (3, 0, 0):
-                # Only newer versions support --uid/--gid
-                tar_cmd = bsdtar_path
-                tar_flags = ["--uid=0", "--gid=0", "--numeric-owner"]
-            if bsdtar_version > (3, 2, 0):
-                # Use parallel xz compression
-                tar_flags.append("--options=xz:threads=" + str(cheri_config.make_jobs))
-
-        if not tar_cmd and (shutil.which("gtar") or OSInfo.IS_LINUX):
-            # GNU tar
-            tar_cmd = "tar" if OSInfo.IS_LINUX else "gtar"
-            tar_flags = ["--owner=0", "--group=0", "--numeric-owner"]
-
-        # bsdtar too old and GNU tar not found
-        if not tar_cmd:
-            fatal_error("Could not find a usable version of the tar command", pretend=cheri_config.pretend)
-            return
-        status_update("Creating tarball", cheri_config.tarball_name)
-        # Strip all ELF files:
-        if cheri_config.strip_elf_files:
-            # TODO: we only accept one target name to infer the correct llvm-strip binary path
-            assert len(cheri_config.targets) == 1, "--create-tarball only accepts one target name"
-            target = target_manager.get_target_raw(cheri_config.targets[0])
-            Target.instantiating_targets_should_warn = False
-            project = target.get_or_create_project(None, cheri_config, caller=None)
-            strip_binaries(cheri_config, project, cheri_config.workspace / "tarball")
-        run_command(
-            [tar_cmd, "--create", "--xz"] + tar_flags + ["-f", cheri_config.tarball_name, "-C", "tarball", "."],
-            cwd=cheri_config.workspace)
-        run_command("du", "-sh", cheri_config.workspace / cheri_config.tarball_name)
+def create_tarball(cheri_config: JenkinsConfig) -> None:
+    bsdtar_path = shutil.which("bsdtar")
+    tar_cmd = None
+    tar_flags = ["--invalid-flag"]
+    if bsdtar_path:
+        bsdtar_version = get_program_version(Path(bsdtar_path), regex=b"bsdtar\\s+(\\d+)\\.(\\d+)\\.?(\\d+)?",
+                                             config=cheri_config)
+        if bsdtar_version > (3, 0, 0):
+            # Only newer versions support --uid/--gid
+            tar_cmd = bsdtar_path
+            tar_flags = ["--uid=0", "--gid=0", "--numeric-owner"]
+
+    if not tar_cmd and (shutil.which("gtar") or OSInfo.IS_LINUX):
+        # GNU tar
+        tar_cmd = "tar" if OSInfo.IS_LINUX else "gtar"
+        tar_flags = ["--owner=0", "--group=0", "--numeric-owner"]
+
+    # bsdtar too old and GNU tar not found
+    if not tar_cmd:
+        fatal_error("Could not find a usable version of the tar command", pretend=cheri_config.pretend)
+        return
+    # Instead of relying on the tar built-in compression (which is single-threaded for GNU tar and old bsdtar
+    # versions), we pipe the uncompressed archive into a multithreaded compressor.
+    threads = max(1, cheri_config.tarball_compression_threads)
+    if cheri_config.tarball_compression == "zstd":
+        compress_cmd = ["zstd", "-T" + str(threads), "-q", "-c"]
+    else:
+        compress_cmd = ["xz", "--threads=" + str(threads), "-c"]
+    if not shutil.which(compress_cmd[0]):
+        fatal_error("Could not find", compress_cmd[0], "command required for --tarball-compression",
+                    pretend=cheri_config.pretend)
+    status_update("Creating tarball", cheri_config.tarball_name)
+    timings = []
+    # Strip all ELF files:
+    if cheri_config.strip_elf_files:
+        # TODO: we only accept one target name to infer the correct llvm-strip binary path
+        assert len(cheri_config.targets) == 1, "--create-tarball only accepts one target name"
+        target = target_manager.get_target_raw(cheri_config.targets[0])
+        Target.instantiating_targets_should_warn = False
+        project = target.get_or_create_project(None, cheri_config, caller=None)
+        stage_start = time.time()
+        strip_binaries(cheri_config, project, cheri_config.output_root)
+        timings.append(("stripping ELF files", time.time() - stage_start))
+    # Archive the install directory directly (without creating a copy first)
+    tar_cmdline = [tar_cmd, "--create", *tar_flags, "-f", "-", "-C", cheri_config.output_root, "."]
+    stage_start = time.time()
+    _run_pipeline(tar_cmdline, compress_cmd, cheri_config.workspace / cheri_config.tarball_name, cheri_config)
+    timings.append(("archiving and compressing (" + compress_cmd[0] + ", " + str(threads) + " threads)",
+                    time.time() - stage_start))
+    run_command("du", "-sh", cheri_config.workspace / cheri_config.tarball_name)
+    for stage, duration in timings:
+        status_update("Tarball creation: {} took {:.2f} seconds".format(stage, duration))
+
+
+def _run_pipeline(producer: list, consumer: list, output_file: Path, config: JenkinsConfig) -> None:
+    """Runs producer | consumer > output_file (without going via the shell)"""
+    print(coloured(AnsiColour.yellow, commandline_to_str(producer), "|", commandline_to_str(consumer), ">",
+                   str(output_file)), flush=True)
+    if config.pretend:
+        return
+    producer = [str(x) for x in producer]
+    consumer = [str(x) for x in consumer]
+    with output_file.open("wb") as output:
+        producer_proc = subprocess.Popen(producer, stdout=subprocess.PIPE)
+        consumer_proc = subprocess.Popen(consumer, stdin=producer_proc.stdout, stdout=output)
+        # Close our copy of the pipe so that the producer receives SIGPIPE if the consumer exits early
+        producer_proc.stdout.close()
+        consumer_ret = consumer_proc.wait()
+        producer_ret = producer_proc.wait()
+    if producer_ret or consumer_ret:
+        output_file.unlink()
+        # If the consumer (compressor) failed the producer usually dies with SIGPIPE afterwards, so report the
+        # consumer error first and only mention the producer exit status as a secondary error.
+        if consumer_ret:
+            if producer_ret and producer_ret != -signal.SIGPIPE:
+                warning_message("`" + commandline_to_str(producer) + "` also failed with exit code", producer_ret)
+            raise subprocess.CalledProcessError(consumer_ret, consumer)
+        raise subprocess.CalledProcessError(producer_ret, producer)
 
 
 def strip_binaries(_: JenkinsConfig, project: SimpleProject, directory: Path) -> None:
     status_update("Tarball directory size before stripping ELF files:")
     run_command("du", "-sh", directory)
-    for root, dirs, filelist in os.walk(str(directory)):
-        for file in filelist:
-            # Try to shrink the size by stripping all elf binaries
-            filepath = Path(root, file)
-            if filepath.is_symlink():
-                continue
-            project.maybe_strip_elf_file(filepath)
+    # Try to shrink the size by stripping all elf binaries
+    project.strip_elf_files_in_place(Path(root, file) for root, dirs, filelist in os.walk(str(directory))
+                                     for file in filelist)
     status_update("Tarball directory size after stripping ELF files:")
     run_command("du", "-sh", directory)
 
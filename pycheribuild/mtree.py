@@ -29,8 +29,10 @@
 #
 
 import fnmatch
+import hashlib
 import io
 import os
+import pickle
 import shlex
 import stat
 import sys
@@ -42,7 +44,85 @@ from typing import Optional, Union
 from .utils import status_update, warning_message
 
 
+# Escape sequences emitted by strsvis(3) in VIS_CSTYLE mode, which mtree uses for special characters in path names.
+_VIS_CSTYLE_ESCAPES = {"s": " ", "t": "\t", "n": "\n", "r": "\r", "a": "\a", "b": "\b", "f": "\f", "v": "\v",
+                       "E": "\033"}
+_OCTAL_DIGITS = "01234567"
+_DOUBLE_QUOTE_ESCAPES = "\\\"$`\n"
+
+
+def _tokenize_mtree_line(line: str) -> "list[str]":
+    """
+    Split a line of an mtree(5) file into words. Almost all lines in a METALOG file don't contain any escape sequences
+    or quotes, so this is usually just str.split(). Otherwise, strsvis(3) escapes (e.g. \\s or \\040 for a space) and
+    the quotes added by shlex.quote() in MtreeEntry.__str__() are decoded.
+    """
+    if "\\" not in line and "'" not in line and '"' not in line:
+        return line.split()
+    words = []
+    current = []
+    in_word = False
+    i = 0
+    n = len(line)
+    while i < n:
+        c = line[i]
+        if c.isspace():
+            if in_word:
+                words.append("".join(current))
+                current = []
+                in_word = False
+            i += 1
+            continue
+        in_word = True
+        if c == "'":
+            end = line.find(c, i + 1)
+            if end < 0:
+                raise ValueError("No closing quotation")
+            current.append(line[i + 1:end])
+            i = end + 1
+        elif c == '"':
+            # Like a POSIX shell, only treat backslashes as escapes if they are followed by a special character.
+            i += 1
+            while True:
+                if i == n:
+                    raise ValueError("No closing quotation")
+                c = line[i]
+                if c == '"':
+                    i += 1
+                    break
+                if c == "\\" and i + 1 < n and line[i + 1] in _DOUBLE_QUOTE_ESCAPES:
+                    i += 1
+                    c = line[i]
+                current.append(c)
+                i += 1
+        elif c == "\\":
+            if i + 1 == n:
+                raise ValueError("No escaped character")
+            if line[i + 1] not in _OCTAL_DIGITS:
+                current.append(_VIS_CSTYLE_ESCAPES.get(line[i + 1], line[i + 1]))
+                i += 2
+                continue
+            # Non-ASCII characters are encoded as one octal escape per byte (e.g. \\303\\244 for an a-umlaut)
+            encoded = bytearray()
+            while i + 1 < n and line[i] == "\\" and line[i + 1] in _OCTAL_DIGITS:
+                end = i + 2
+                while end < min(n, i + 4) and line[end] in _OCTAL_DIGITS:
+                    end += 1
+                encoded.append(int(line[i + 1:end], 8) & 0xff)
+                i = end
+            current.append(encoded.decode("utf-8", errors="surrogateescape"))
+        else:
+            current.append(c)
+            i += 1
+    if in_word:
+        words.append("".join(current))
+    return words
+
+
 class MtreeEntry(object):
+    # A METALOG for a full CheriBSD world contains hundreds of thousands of entries, so avoid a per-instance __dict__.
+    __slots__ = ("path", "attributes")
+
     def __init__(self, path: str, attributes: "dict[str, str]"):
         self.path = path
         self.attributes = attributes
@@ -55,53 +135,161 @@ class MtreeEntry(object):
 
     @classmethod
     def parse(cls, line: str, contents_root: "Optional[Path]" = None) -> "MtreeEntry":
-        elements = shlex.split(line)
-        path = elements[0]
-        # Ensure that the path is normalized:
-        if path != ".":
-            # print("Before:", path)
-            assert path[:2] == "./"
-            path = path[:2] + os.path.normpath(path[2:])
-            # print("After:", path)
-        attr_dict = OrderedDict()  # keep them in insertion order
-        for k, v in map(lambda s: s.split(sep="=", maxsplit=1), elements[1:]):
+        return cls._from_words(_tokenize_mtree_line(line), contents_root, None)
+
+    @staticmethod
+    def _parse_attributes(words: "list[str]", contents_root: "Optional[Path]",
+                          result: "dict[str, str]") -> "dict[str, str]":
+        for word in words:
+            k, v = word.split("=", 1)
             # ignore some tags that makefs doesn't like
             # sometimes there will be time with nanoseconds in the manifest, makefs can't handle that
             # also the tags= key is not supported
-            if k in ("tags", "time"):
+            if k == "tags" or k == "time":
                 continue
-            # convert relative contents=keys to absolute ones
-            if contents_root and k == "contents":
-                if not os.path.isabs(v):
+            if k == "contents":
+                # convert relative contents=keys to absolute ones
+                if contents_root and not os.path.isabs(v):
                     v = str(contents_root / v)
-            attr_dict[k] = v
+                result["contents"] = v
+            else:
+                # Most keys and values (type=, uname=, gname=, mode=, etc.) are repeated for almost every entry, so
+                # intern them to reduce memory usage (this also makes the pickled cache file a lot smaller).
+                result[sys.intern(k)] = sys.intern(v)
+        return result
+
+    @classmethod
+    def _from_words(cls, words: "list[str]", contents_root: "Optional[Path]",
+                    defaults: "Optional[dict[str, str]]") -> "MtreeEntry":
+        path = words[0]
+        # Ensure that the path is normalized (but avoid calling normpath() for paths that are obviously normalized):
+        if path != ".":
+            assert path[:2] == "./", "Path does not start with ./: " + path
+            relpath = path[2:]
+            if "//" in relpath or "/." in relpath or relpath.startswith(".") or relpath.endswith("/"):
+                path = "./" + os.path.normpath(relpath)
+        # keep them in insertion order
+        attr_dict = cls._parse_attributes(words[1:], contents_root, dict(defaults) if defaults else {})
         return MtreeEntry(path, attr_dict)
-        # FIXME: use contents=
+
+    @staticmethod
+    def iter_entries(file: "Union[Path, typing.IO]", contents_root: "Optional[Path]" = None, *,
+                     only_type: "Optional[str]" = None) -> "typing.Iterator[MtreeEntry]":
+        """
+        Parse an mtree file one line at a time. This also handles the /set and /unset directives that mtree -c emits.
+        Lines that cannot be parsed are skipped with a warning.
+        :param only_type: if set, only return entries of this type (and avoid tokenizing all other lines)
+        """
+        if isinstance(file, Path):
+            with file.open("r", encoding="utf-8") as f:
+                yield from MtreeEntry.iter_entries(f, contents_root, only_type=only_type)
+            return
+        defaults: "dict[str, str]" = {}
+        type_attr = None if only_type is None else " type=" + only_type
+        for line in file:
+            line = line.strip()
+            if not line or line[0] == "#":
+                continue
+            if (type_attr is not None and type_attr not in line and line[0] != "/" and
+                    defaults.get("type") != only_type):
+                continue
+            try:
+                words = _tokenize_mtree_line(line)
+                if words[0] == "/set":
+                    MtreeEntry._parse_attributes(words[1:], contents_root, defaults)
+                    continue
+                elif words[0] == "/unset":
+                    for k in words[1:]:
+                        if k == "all":
+                            defaults.clear()
+                        else:
+                            defaults.pop(k, None)
+                    continue
+                entry = MtreeEntry._from_words(words, contents_root, defaults)
+            except Exception as e:
+                warning_message("Could not parse line", line, "in mtree file", file, ":", e)
+                continue
+            if only_type is None or entry.attributes.get("type") == only_type:
+                yield entry
 
     @classmethod
     def parse_all_dirs_in_mtree(cls, mtree_file: Path) -> "list[MtreeEntry]":
-        with mtree_file.open("r", encoding="utf-8") as f:
-            result = []
-            for line in f.readlines():
-                if " type=dir" in line:
-                    try:
-                        result.append(MtreeEntry.parse(line))
-                    except Exception as e:
-                        warning_message("Could not parse line", line, "in mtree file", mtree_file, e)
-            return result
+        return list(cls.iter_entries(mtree_file, only_type="dir"))
 
     def __str__(self) -> str:
         def escape(s):
             # mtree uses strsvis(3) (in VIS_CSTYLE format) to encode path names containing non-printable characters.
-            # Note: we only handle spaces here since we haven't seen any other special characters being use. If they do
-            # exist in practise we can just update this code to handle them too.
-            return s.replace(" ", "\\s")
+            # Note: we only handle backslashes and whitespace here since we haven't seen any other special characters
+            # being used. If they do exist in practise we can just update this code (and _tokenize_mtree_line) too.
+            return s.replace("\\", "\\\\").replace(" ", "\\s").replace("\t", "\\t").replace("\n", "\\n")
         return escape(self.path) + " " + " ".join(k + "=" + shlex.quote(v) for k, v in self.attributes.items())
 
     def __repr__(self) -> str:
         return "<MTREE entry: " + str(self) + ">"
 
 
+class _ParsedMtreeCache(object):
+    """Binary cache of the parsed entries of a (large) mtree file such as METALOG.world"""
+    FORMAT_VERSION = 2
+
+    def __init__(self, cache_dir: Path, mtree_file: Path, contents_root: "Optional[Path]"):
+        self.cache_file = cache_dir / (mtree_file.name + ".parsed-cache")
+        self.mtree_file = mtree_file
+        self.key = (self.FORMAT_VERSION, os.path.realpath(str(mtree_file)), str(contents_root))
+
+    def _file_hash(self) -> str:
+        h = hashlib.sha256()
+        with self.mtree_file.open("rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def load(self) -> "Optional[list[MtreeEntry]]":
+        try:
+            with self.cache_file.open("rb") as f:
+                header = pickle.load(f)
+                if header["key"] != self.key:
+                    return None
+                st = self.mtree_file.stat()
+                if header["size"] != st.st_size:
+                    return None
+                mtime_changed = header["mtime_ns"] != st.st_mtime_ns
+                # Only hash the file if the modification time changed (e.g. after a no-op installworld)
+                if mtime_changed and header["sha256"] != self._file_hash():
+                    return None
+                entries_data = f.read()
+            paths, attributes = pickle.loads(entries_data)
+        except Exception:
+            return None  # No cache yet, corrupted or created by an incompatible version
+        if mtime_changed:
+            # Update the modification time in the header so that the next load doesn't have to hash the file again.
+            header["mtime_ns"] = st.st_mtime_ns
+            self._write(header, entries_data)
+        return [MtreeEntry(path, attrs) for path, attrs in zip(paths, attributes)]
+
+    def save(self, entries: "list[MtreeEntry]") -> None:
+        try:
+            st = self.mtree_file.stat()
+            header = dict(key=self.key, size=st.st_size, mtime_ns=st.st_mtime_ns, sha256=self._file_hash())
+        except OSError as e:
+            warning_message("Could not write parsed mtree cache", self.cache_file, e)
+            return
+        # Store the entries in columnar form to avoid pickling one object per entry
+        self._write(header, pickle.dumps(([e.path for e in entries], [e.attributes for e in entries]),
+                                         protocol=pickle.HIGHEST_PROTOCOL))
+
+    def _write(self, header: dict, entries_data: bytes) -> None:
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.cache_file.with_name(self.cache_file.name + ".tmp." + str(os.getpid()))
+            with tmp_file.open("wb") as f:
+                pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.write(entries_data)
+            os.replace(str(tmp_file), str(self.cache_file))
+        except OSError as e:
+            warning_message("Could not write parsed mtree cache", self.cache_file, e)
+
+
 class MtreeFile(object):
     def __init__(self, *, verbose: bool, file: "Union[io.StringIO, Path, typing.IO, None]" = None,
                  contents_root: "Optional[Path]" = None):
@@ -110,34 +298,43 @@ class MtreeFile(object):
         if file:
             self.load(file, contents_root=contents_root, append=False)
 
-    def load(self, file: "Union[io.StringIO,Path,typing.IO]", *, append: bool, contents_root: "Optional[Path]" = None):
-        if isinstance(file, Path):
-            with file.open("r") as f:
-                self.load(f, contents_root=contents_root, append=append)
-                return
+    def load(self, file: "Union[io.StringIO,Path,typing.IO]", *, append: bool, contents_root: "Optional[Path]" = None,
+             cache_dir: "Optional[Path]" = None):
+        """
+        :param cache_dir: if set (and file is a Path), the parsed entries will be cached in this directory to avoid
+        re-parsing the file if it has not changed since the last call.
+        """
         if not append:
             self._mtree.clear()
         if "_TEST_SKIP_METALOG" in os.environ:
             status_update("Not parsing", file, "in test mode")
             return  # avoid parsing all metalog files in the basic sanity checks
-        for line in file.readlines():
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            try:
-                entry = MtreeEntry.parse(line, contents_root)
-                key = str(entry.path)
-                assert key == "." or os.path.normpath(key[2:]) == key[2:]
-                if key in self._mtree:
-                    # Currently the FreeBSD build system can produce duplicate directory entries in the mtree file
-                    # when installing in parallel. Ignore those duplicates by default since it makes the output
-                    # rather noisy. There are also a few duplicate files (mostly in /etc), so suppress it for all
-                    # duplicates (in non-verbose mode) until the build system has been fixed
-                    if self.verbose:  # TODO: or entry.attributes.get("type") != "dir"
-                        warning_message("Found duplicate definition for", entry.path)
-                self._mtree[key] = entry
-            except Exception as e:
-                warning_message("Could not parse line", line, "in mtree file", file, ":", e)
+        if isinstance(file, Path):
+            cache = _ParsedMtreeCache(cache_dir, file, contents_root) if cache_dir is not None else None
+            entries = cache.load() if cache is not None else None
+            if entries is None:
+                with file.open("r") as f:
+                    entries = self._parse_entries(f, contents_root)
+                if cache is not None:
+                    cache.save(entries)
+            elif self.verbose:
+                status_update("Using cached parse result for", file, "from", cache.cache_file)
+        else:
+            entries = self._parse_entries(file, contents_root)
+        for entry in entries:
+            key = entry.path
+            if key in self._mtree:
+                # Currently the FreeBSD build system can produce duplicate directory entries in the mtree file
+                # when installing in parallel. Ignore those duplicates by default since it makes the output
+                # rather noisy. There are also a few duplicate files (mostly in /etc), so suppress it for all
+                # duplicates (in non-verbose mode) until the build system has been fixed
+                if self.verbose:  # TODO: or entry.attributes.get("type") != "dir"
+                    warning_message("Found duplicate definition for", entry.path)
+            self._mtree[key] = entry
+
+    @staticmethod
+    def _parse_entries(file: "Union[io.StringIO,typing.IO]", contents_root: "Optional[Path]") -> "list[MtreeEntry]":
+        return list(MtreeEntry.iter_entries(file, contents_root))
 
     @staticmethod
     def _ensure_mtree_mode_fmt(mode: "Union[str, int]") -> str:
@@ -257,10 +454,24 @@ class MtreeFile(object):
             status_update("Adding dir", path, "to mtree", file=sys.stderr)
         self._mtree[mtree_path] = MtreeEntry(mtree_path, attribs)
 
+    def regular_files(self, contents_root: Path) -> "typing.Iterator[tuple[str, Path]]":
+        """
+        :return: the path in the mtree and the path of the file providing the contents for each regular file entry
+        (entries without a contents= key are resolved relative to contents_root).
+        """
+        for path, entry in self._mtree.items():
+            if entry.is_file():
+                contents = entry.attributes.get("contents")
+                yield path, Path(contents) if contents else contents_root / path
+
     def __contains__(self, item) -> bool:
         mtree_path = self._ensure_mtree_path_fmt(str(item))
         return mtree_path in self._mtree
 
+    def contains_normalized_path(self, path: str) -> bool:
+        """Faster version of __contains__ for paths that are already normalized (e.g. from os.scandir())"""
+        return ("./" + path) in self._mtree
+
     def exclude_matching(self, globs, exceptions=None, print_status=False) -> None:
         """Remove paths matching any pattern in globs (but not matching any in exceptions)"""
         if exceptions is None:
@@ -31,10 +31,12 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import atexit
 import contextlib
 import fcntl
 import functools
 import io
+import json
 import os
 import re
 import shlex
@@ -50,6 +52,7 @@ from subprocess import CompletedProcess
 from typing import Callable, Optional, Union
 
 from .colour import AnsiColour, coloured
+from .timing import build_timings
 from .utils import ConfigBase, OSInfo, Type_T, fatal_error, get_global_config, status_update, warning_message
 
 __all__ = ["print_command", "get_compiler_info", "CompilerInfo", "popen", "popen_handle_noexec",  # no-combine
@@ -418,7 +421,8 @@ def run_command(*args, capture_output=False, capture_error=False, input: "Union[
     stdout: bytes = b""
     stderr: bytes = b""
     # Some programs (such as QEMU) can mess up the TTY state if they don't exit cleanly
-    with keep_terminal_sane(give_tty_control, command=cmdline):
+    timing_phase = build_timings.phase(os.path.basename(cmdline[0]), "command", command=commandline_to_str(cmdline))
+    with timing_phase as timing_args, keep_terminal_sane(give_tty_control, command=cmdline):
         with popen_handle_noexec(cmdline, **kwargs) as process:
             exc = None
             try:
@@ -442,6 +446,7 @@ def run_command(*args, capture_output=False, capture_error=False, input: "Union[
                 exc = e
                 exc.__cause__ = e
             retcode = process.poll()
+            timing_args["exit_code"] = retcode
             if retcode != expected_exit_code and not allow_unexpected_returncode:
                 exc = _make_called_process_error(retcode, process.args, stdout=stdout, stderr=stderr, cwd=kwargs["cwd"])
             if exc is not None:
@@ -472,6 +477,112 @@ def commandline_to_str(args: "typing.Iterable[Union[str,Path]]") -> str:
     return " ".join((_quote(s) for s in args))
 
 
+class _CompilerProbeCache(object):
+    """
+    Persistent cache for the output of compiler invocations that only depend on the compiler binary and the arguments
+    (e.g. `clang -v` or checking whether a warning flag is supported). The results are stored in
+    <BUILD_ROOT>/compiler-probe-cache.json and are keyed by the invoked path (since e.g. clang and clang++ are the
+    same binary but behave differently). They are invalidated when the (resolved) compiler binary changes.
+    """
+    FORMAT_VERSION = 2
+
+    def __init__(self) -> None:
+        self._path: "Optional[Path]" = None
+        self._compilers: "dict[str, dict]" = {}
+        self._dirty = False
+        self._save_registered = False
+
+    @staticmethod
+    def cache_file(config: ConfigBase) -> "Optional[Path]":
+        build_root = getattr(config, "build_root", None)
+        return None if build_root is None else Path(build_root, "compiler-probe-cache.json")
+
+    def _read(self, path: Path) -> "dict[str, dict]":
+        try:
+            with path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.FORMAT_VERSION:
+                return data["compilers"]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass  # missing or corrupted cache file -> start with an empty cache
+        return {}
+
+    def _load(self, path: Path) -> None:
+        self.save()  # write any new results to the previous cache file first
+        self._path = path
+        self._compilers = self._read(path)
+
+    def save(self) -> None:
+        """Merges the new results into the cache file (this is called once at exit)."""
+        if not self._dirty or self._path is None or not self._path.parent.is_dir():
+            return
+        self._dirty = False
+        # Hold a lock while merging so that concurrent cheribuild instances don't drop each other's results.
+        lockfile = self._path.with_name(self._path.name + ".lock")
+        tmpfile = self._path.with_name(self._path.name + ".tmp." + str(os.getpid()))
+        try:
+            with lockfile.open("w") as lock:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+                compilers = self._read(self._path)
+                for key, entry in self._compilers.items():
+                    existing = compilers.get(key)
+                    if existing is not None and existing.get("identity") == entry["identity"]:
+                        existing["probes"].update(entry["probes"])
+                    else:
+                        compilers[key] = entry
+                with tmpfile.open("w", encoding="utf-8") as f:
+                    json.dump({"version": self.FORMAT_VERSION, "compilers": compilers}, f)
+                os.replace(str(tmpfile), str(self._path))
+        except OSError as e:
+            warning_message("Could not update compiler probe cache", self._path, "-", e)
+
+    def run(self, compiler: Path, *args: str, config: ConfigBase,
+            cache_nonzero_exit: bool = True) -> "CompletedProcess[bytes]":
+        cmdline = [str(compiler), *args]
+        compiler_realpath = compiler.resolve()
+        path = self.cache_file(config)
+        try:
+            stat = compiler_realpath.stat()
+        except OSError:
+            path = None
+        if path is None:
+            return run_command(cmdline, capture_output=True, capture_error=True, print_verbose_only=True,
+                               run_in_pretend_mode=True, allow_unexpected_returncode=True, stdin=subprocess.DEVNULL,
+                               config=config)
+        if path != self._path:
+            self._load(path)
+        identity = [str(compiler_realpath), stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size]
+        key = str(compiler.absolute())
+        entry = self._compilers.get(key)
+        if entry is None or entry.get("identity") != identity:
+            entry = {"identity": identity, "probes": {}}
+            self._compilers[key] = entry
+        probe_key = commandline_to_str(args)
+        cached = entry["probes"].get(probe_key)
+        if cached is not None:
+            return CompletedProcess(cmdline, cached["returncode"],
+                                    cached["stdout"].encode("utf-8", errors="surrogateescape"),
+                                    cached["stderr"].encode("utf-8", errors="surrogateescape"))
+        result = run_command(cmdline, capture_output=True, capture_error=True, print_verbose_only=True,
+                             run_in_pretend_mode=True, allow_unexpected_returncode=True, stdin=subprocess.DEVNULL,
+                             config=config)
+        if result.returncode == 0 or cache_nonzero_exit:
+            entry["probes"][probe_key] = {
+                "returncode": result.returncode,
+                "stdout": result.stdout.decode("utf-8", errors="surrogateescape"),
+                "stderr": result.stderr.decode("utf-8", errors="surrogateescape"),
+            }
+            if not config.pretend:
+                self._dirty = True
+                if not self._save_registered:
+                    atexit.register(self.save)
+                    self._save_registered = True
+        return result
+
+
+_compiler_probe_cache = _CompilerProbeCache()
+
+
 class CompilerInfo(object):
     def __init__(self, path: Path, compiler: str, version: "tuple[int, ...]", version_str: str, default_target: str,
                  *, config: ConfigBase):
@@ -494,15 +605,14 @@ class CompilerInfo(object):
                 return Path("/unknown/resource/dir")  # avoid failing in jenkins
             # Clang 5.0 added the -print-resource-dir flag
             if self.is_clang and self.version >= (5, 0):
-                resource_dir = run_command(self.path, "-print-resource-dir", config=self.config,
-                                           print_verbose_only=True, capture_output=True,
-                                           run_in_pretend_mode=True).stdout.decode("utf-8").strip()
+                resource_dir = _compiler_probe_cache.run(self.path, "-print-resource-dir", config=self.config,
+                                                         cache_nonzero_exit=False).stdout.decode("utf-8").strip()
                 assert resource_dir, "-print-resource-dir no longer works?"
                 self._resource_dir = Path(resource_dir)
             else:
                 # pretend to compile an existing source file and capture the -resource-dir output
-                cc1_cmd = run_command(self.path, "-###", "-xc", "-c", "/dev/null", config=self.config,
-                                      capture_error=True, print_verbose_only=True, run_in_pretend_mode=True)
+                cc1_cmd = _compiler_probe_cache.run(self.path, "-###", "-xc", "-c", "/dev/null", config=self.config,
+                                                    cache_nonzero_exit=False)
                 resource_dir_pat = re.compile(b'"-cc1".+"-resource-dir" "([^"]+)"')
                 self._resource_dir = Path(resource_dir_pat.search(cc1_cmd.stderr).group(1).decode("utf-8"))
         return self._resource_dir
@@ -513,9 +623,8 @@ class CompilerInfo(object):
             if not self.path.exists():
                 return [Path("/unknown/include/dir")]  # avoid failing in jenkins
             # pretend to compile an existing source file and capture the -resource-dir output
-            output = run_command(self.path, "-E", "-Wp,-v", "-xc", "/dev/null", config=self.config,
-                                 stdout=subprocess.DEVNULL, capture_error=True, print_verbose_only=True,
-                                 run_in_pretend_mode=True).stderr
+            output = _compiler_probe_cache.run(self.path, "-E", "-Wp,-v", "-xc", "/dev/null",
+                                               config=self.config, cache_nonzero_exit=False).stderr
             found_start = False
             include_dirs = []
             for line in io.BytesIO(output).readlines():
@@ -538,8 +647,7 @@ class CompilerInfo(object):
         try:
             if not self.path.exists():
                 return False  # avoid failing in jenkins
-            result = run_command(self.path, *other_args, flag, print_verbose_only=True, run_in_pretend_mode=True,
-                                 capture_error=True, allow_unexpected_returncode=True, config=self.config)
+            result = _compiler_probe_cache.run(self.path, *other_args, flag, config=self.config)
         except (subprocess.CalledProcessError, OSError) as e:
             warning_message("Failed to check for", flag, "support:", e)
             return False
@@ -662,13 +770,11 @@ def get_compiler_info(compiler: "Union[str, Path]", *, config: ConfigBase) -> Co
         try:
             # Use -v instead of --version to support both gcc and clang
             # Note: for clang-cpp/cpp we need to have stdin as devnull
-            version_cmd = run_command(compiler, "-v", capture_error=True, print_verbose_only=True,
-                                      run_in_pretend_mode=True, config=config,
-                                      stdin=subprocess.DEVNULL, capture_output=True)
-        except subprocess.CalledProcessError as e:
-            stderr = e.stderr if e.stderr else b"FAILED: " + str(e).encode("utf-8")
-            version_cmd = CompletedProcess(e.cmd, e.returncode, e.output, stderr)
-            executed_sucessfully = False
+            version_cmd = _compiler_probe_cache.run(compiler, "-v", config=config, cache_nonzero_exit=False)
+            if version_cmd.returncode != 0:
+                if not version_cmd.stderr:
+                    version_cmd.stderr = b"FAILED: exit code " + str(version_cmd.returncode).encode("utf-8")
+                executed_sucessfully = False
         except OSError as e:
             version_cmd = CompletedProcess([compiler, "-v"], e.errno, b"", str(e).encode("utf-8"))
             executed_sucessfully = False
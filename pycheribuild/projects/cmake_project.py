@@ -56,6 +56,7 @@ class CMakeProject(_CMakeAndMesonSharedLogic):
     make_kind: MakeCommandKind = MakeCommandKind.CMake
     _default_cmake_generator_arg: str = "-GNinja"  # We default to using the Ninja generator since it's faster
     _configure_tool_name: str = "CMake"
+    can_skip_unchanged_builds: bool = True  # all CMake options are added in setup()
     default_build_type: BuildType = BuildType.RELWITHDEBINFO
     # Some projects (e.g. LLVM) don't store the CMakeLists.txt in the project root directory.
     root_cmakelists_subdirectory: Optional[Path] = None
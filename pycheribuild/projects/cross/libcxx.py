@@ -361,8 +361,11 @@ class BuildLibCXX(_CxxRuntimeCMakeProject):
                           "-Dexecutor=" + self.commandline_to_str(executor), "test"], cwd=self.build_dir)
         else:
             # long running test -> speed up by using a kernel without invariants
+            # Let all shards share the extracted disk image and only store their own writes in a qcow2 overlay.
+            parallel_args = ["--disk-image-overlay"] if self.test_jobs > 1 else []
             self.target_info.run_cheribsd_test_script("run_libcxx_tests.py", "--parallel-jobs", self.test_jobs,
                                                       "--ssh-executor-script", self.source_dir / "utils/ssh.py",
+                                                      *parallel_args,
                                                       use_benchmark_kernel_by_default=True)
 
 
@@ -29,10 +29,13 @@
 #
 
 import io
+import json
 import os
 import shutil
 import sys
 import tempfile
+import time
+import typing
 from enum import Enum
 from pathlib import Path
 from typing import Optional
@@ -188,6 +191,10 @@ class BuildDiskImageBase(SimpleProject):
                                                   help="Overwrite an existing disk image without prompting")
         cls.no_autoboot = cls.add_bool_option("no-autoboot", default=False,
                                               help="Disable autoboot and boot menu for targets that use loader(8)")
+        cls.reuse_unchanged_image = cls.add_bool_option(
+            "reuse-unchanged-image", default=False,
+            help="Store a manifest of all inputs (METALOG, file contents and image settings) next to the image and "
+                 "skip makefs/mkimg if the existing image was built from an identical manifest")
 
     def check_system_dependencies(self) -> None:
         super().check_system_dependencies()
@@ -283,9 +290,13 @@ class BuildDiskImageBase(SimpleProject):
         assert self.tmpdir is not None
         assert self.manifest_file is not None
         # skip parsing the metalog in the git push hook since it takes a long time and isn't that useful
+        # Parsing METALOG.world is slow, so cache the result in the build directory to speed up repeated disk image
+        # builds for the same rootfs.
+        metalog_cache_dir = None if self.config.pretend else self.config.build_root / "metalog-cache" / \
+            self.rootfs_dir.name
         for metalog in self.input_metalogs:
             if metalog.exists() and not os.getenv("_TEST_SKIP_METALOG"):
-                self.mtree.load(metalog, append=True)
+                self.mtree.load(metalog, append=True, cache_dir=metalog_cache_dir)
             else:
                 self.fatal("Could not find required input mtree file", metalog)
 
@@ -752,6 +763,80 @@ class BuildDiskImageBase(SimpleProject):
             if self.config.verbose:
                 self.run_cmd(qemu_img_command, "info", self.disk_image_path)
 
+    @property
+    def disk_image_manifest_path(self) -> Path:
+        return self.disk_image_path.with_name(self.disk_image_path.name + ".manifest.json")
+
+    def _compute_disk_image_manifest(self, previous: "dict[str, typing.Any]") -> "dict[str, typing.Any]":
+        assert self.tmpdir is not None
+        tmpdir_str = str(self.tmpdir)
+
+        def normalize(s: str) -> str:
+            # The temporary directory name is different for every build
+            return s.replace(tmpdir_str, "$TMPDIR")
+
+        def file_identity(path: "Optional[Path]") -> "Optional[list]":
+            if path is None or not path.exists():
+                return None
+            st = path.stat()
+            return [os.path.realpath(str(path)), st.st_size, st.st_mtime_ns]
+
+        mtree_contents = io.StringIO()
+        self.mtree.write(mtree_contents, pretend=False)
+        # Only hash files whose size or modification time changed since the last build.
+        previous_files = previous.get("files", {})
+        files = {}
+        for _, contents in self.mtree.regular_files(self.rootfs_dir):
+            key = normalize(str(contents))
+            try:
+                st = contents.stat()
+            except OSError:
+                files[key] = None
+                continue
+            old = previous_files.get(key)
+            if old is not None and old[:2] == [st.st_size, st.st_mtime_ns]:
+                files[key] = old
+            else:
+                files[key] = [st.st_size, st.st_mtime_ns, self.sha256sum(contents)]
+        return {
+            "version": 1,
+            "settings": {
+                "target": self.target,
+                "class": type(self).__name__,
+                "rootfs_type": self.rootfs_type.value,
+                "use_qcow2": self.use_qcow2,
+                "big_endian": self.big_endian,
+                "minimum_image_size": self.minimum_image_size,
+                "makefs": file_identity(self.makefs_cmd),
+                "mkimg": file_identity(self.mkimg_cmd),
+                "passwd": file_identity(self.user_group_db_dir / "master.passwd"),
+                "group": file_identity(self.user_group_db_dir / "group"),
+            },
+            "mtree": normalize(mtree_contents.getvalue()),
+            "files": files,
+        }
+
+    def _read_disk_image_manifest(self) -> "dict[str, typing.Any]":
+        try:
+            with self.disk_image_manifest_path.open("r", encoding="utf-8") as f:
+                result = json.load(f)
+            if isinstance(result, dict) and result.get("version") == 1:
+                return result
+        except (OSError, ValueError) as e:
+            self.verbose_print("Could not read disk image manifest", self.disk_image_manifest_path, e)
+        return {}
+
+    def _existing_image_is_up_to_date(self, manifest: "dict[str, typing.Any]",
+                                      previous: "dict[str, typing.Any]") -> bool:
+        if self.with_clean or not self.disk_image_path.is_file() or not previous:
+            return False
+
+        # The per-file entries contain the modification time, so only compare the content hashes
+        def hashes(m):
+            return {k: (v[0], v[2]) if v else None for k, v in m["files"].items()}
+        return (manifest["settings"] == previous.get("settings") and manifest["mtree"] == previous.get("mtree") and
+                hashes(manifest) == hashes(previous))
+
     def copy_from_remote_host(self):
         self.info("Copying disk image instead of building it.")
         rsync_path = os.path.expandvars(self.remote_path)
@@ -775,18 +860,12 @@ class BuildDiskImageBase(SimpleProject):
             # Given a directory, derive the default file name inside it
             self.disk_image_path = _default_disk_image_name(self.config, self.disk_image_path, self)
 
-        if self.disk_image_path.is_file():
-            # only show prompt if we can actually input something to stdin
-            if not self.with_clean and not self.force_overwrite:
-                # with --clean always delete the image
-                opt = self.get_config_option_name("force_overwrite")
-                self.info("An image already exists (" + str(self.disk_image_path) + "). ", end="")
-                self.info("Note: Pass", coloured(AnsiColour.yellow, "--" + opt),
-                          coloured(AnsiColour.cyan, "to skip this prompt or add"),
-                          coloured(AnsiColour.yellow, "\"" + opt + "\": true"),
-                          coloured(AnsiColour.cyan, "to", self.config.loader.config_file_path))
-                if not self.query_yes_no("Overwrite?", default_result=True):
-                    return  # we are done here
+        # When reusing unchanged images, we only ask whether the old image should be overwritten (and delete it) once
+        # we know that it is outdated.
+        check_manifest_first = self.reuse_unchanged_image and not self.config.pretend and self.remote_path is None
+        if self.disk_image_path.is_file() and not check_manifest_first:
+            if not self._query_overwrite_existing_image():
+                return  # we are done here
             self.delete_file(self.disk_image_path)
 
         # we can only build disk images on FreeBSD, so copy the file if we aren't
@@ -839,30 +918,58 @@ class BuildDiskImageBase(SimpleProject):
                 self.add_unlisted_files_to_metalog()
             # Add/symlink GDB (if requested).
             self.add_gdb()
-            # finally create the disk image
-            self.make_disk_image()
+            if self.reuse_unchanged_image and not self.config.pretend:
+                previous_manifest = self._read_disk_image_manifest()
+                manifest = self._compute_disk_image_manifest(previous_manifest)
+                if self._existing_image_is_up_to_date(manifest, previous_manifest):
+                    self.info("Inputs for", self.disk_image_path, "are unchanged, not rebuilding disk image.")
+                    # Update the stored modification times to avoid rehashing files next time
+                    self.write_file(self.disk_image_manifest_path, json.dumps(manifest), overwrite=True,
+                                    never_print_cmd=True)
+                elif self.disk_image_path.is_file() and not self._query_overwrite_existing_image():
+                    self.info("Keeping outdated disk image", self.disk_image_path)
+                else:
+                    if self.disk_image_manifest_path.exists():
+                        self.delete_file(self.disk_image_manifest_path)
+                    if self.disk_image_path.exists():
+                        self.delete_file(self.disk_image_path)
+                    self.make_disk_image()
+                    self.write_file(self.disk_image_manifest_path, json.dumps(manifest), overwrite=True,
+                                    never_print_cmd=True)
+            else:
+                # finally create the disk image
+                self.make_disk_image()
         self.tmpdir = None
         self.manifest_file = None
 
+    def _query_overwrite_existing_image(self) -> bool:
+        if self.with_clean or self.force_overwrite:
+            return True  # with --clean always delete the image
+        # only show prompt if we can actually input something to stdin
+        opt = self.get_config_option_name("force_overwrite")
+        self.info("An image already exists (" + str(self.disk_image_path) + "). ", end="")
+        self.info("Note: Pass", coloured(AnsiColour.yellow, "--" + opt),
+                  coloured(AnsiColour.cyan, "to skip this prompt or add"),
+                  coloured(AnsiColour.yellow, "\"" + opt + "\": true"),
+                  coloured(AnsiColour.cyan, "to", self.config.loader.config_file_path))
+        return self.query_yes_no("Overwrite?", default_result=True)
+
     def add_unlisted_files_to_metalog(self):
         unlisted_files = []
-        rootfs_str = str(self.rootfs_dir)  # compat with python < 3.6
-        for root, dirnames, filenames in os.walk(rootfs_str):
-            for filename in filenames:
-                full_path = Path(root, filename)
-                target_path = os.path.relpath(str(full_path), rootfs_str)
-                added = False
-                for prefix in self.auto_prefixes:
-                    if target_path.startswith(prefix):
-                        self.mtree.add_file(full_path, target_path, print_status=self.config.verbose)
-                        added = True
-                        break
-                if added:
-                    continue
-                elif target_path not in self.mtree:
-                    # METALOG is not added to the disk image
-                    if target_path not in ("METALOG", "METALOG.kernel", "METALOG.world"):
-                        unlisted_files.append((full_path, target_path))
+        start = time.perf_counter()
+        auto_prefixes = tuple(self.auto_prefixes)
+        all_files = self.list_files_recursively(self.rootfs_dir, max_workers=self.config.make_jobs)
+        for full_path, target_path in all_files:
+            if target_path.startswith(auto_prefixes):
+                self.mtree.add_file(Path(full_path), target_path, print_status=self.config.verbose)
+            # The paths returned by list_files_recursively() are already normalized
+            elif not self.mtree.contains_normalized_path(target_path):
+                # METALOG is not added to the disk image
+                if target_path not in ("METALOG", "METALOG.kernel", "METALOG.world"):
+                    unlisted_files.append((Path(full_path), target_path))
+        self.info("Checked", len(all_files), "files in", self.rootfs_dir, "for unlisted files in",
+                  "{:.2f}s".format(time.perf_counter() - start))
+        unlisted_files.sort(key=lambda i: i[1])
         if unlisted_files:
             print("Found the following files in the rootfs that are not listed in METALOG:")
             for i in unlisted_files:
@@ -951,6 +1058,18 @@ class BuildMinimalCheriBSDDiskImage(BuildDiskImageBase):
             else:
                 self.add_file_to_image(file_path, base_directory=self.rootfs_dir)
 
+    def _query_overwrite_existing_image(self) -> bool:
+        if self.with_clean or self.force_overwrite:
+            return True  # with --clean always delete the image
+        # only show prompt if we can actually input something to stdin
+        opt = self.get_config_option_name("force_overwrite")
+        self.info("An image already exists (" + str(self.disk_image_path) + "). ", end="")
+        self.info("Note: Pass", coloured(AnsiColour.yellow, "--" + opt),
+                  coloured(AnsiColour.cyan, "to skip this prompt or add"),
+                  coloured(AnsiColour.yellow, "\"" + opt + "\": true"),
+                  coloured(AnsiColour.cyan, "to", self.config.loader.config_file_path))
+        return self.query_yes_no("Overwrite?", default_result=True)
+
     def add_unlisted_files_to_metalog(self):
         # Now add all the files from *.files to the image:
         self.verbose_print("Adding files from rootfs to minimal image:")
@@ -50,6 +50,7 @@ class MesonProject(_CMakeAndMesonSharedLogic):
     # Meson already sets PKG_CONFIG_* variables internally based on the cross toolchain
     set_pkg_config_path: bool = False
     _configure_tool_name: str = "Meson"
+    can_skip_unchanged_builds: bool = True  # configure() only adds arguments derived from the project directories
     meson_test_script_extra_args: "Sequence[str]" = tuple()  # additional arguments to pass to run_meson_tests.py
     _meson_extra_binaries = ""  # Needed for picolibc
     _meson_extra_properties = ""  # Needed for picolibc
@@ -29,7 +29,10 @@
 #
 import copy
 import datetime
+import functools
+import hashlib
 import inspect
+import json
 import os
 import re
 import shutil
@@ -72,6 +75,7 @@ from ..processutils import (
     run_command,
     ssh_host_accessible,
 )
+from ..timing import build_timings
 from ..utils import (
     AnsiColour,
     InstallInstructions,
@@ -93,6 +97,18 @@ __all__ = ["Project", "AutotoolsProject", "CheriConfig", "MakeOptions", "MakeCom
            "DefaultInstallDir", "BuildType", "SubversionRepository", "default_source_dir_in_subdir"]  # no-combine
 
 
+@functools.lru_cache(maxsize=1)
+def _cheribuild_source_fingerprint() -> str:
+    # Changes to cheribuild itself can change the build commands, so include the state of all of its source files.
+    result = hashlib.sha256()
+    package_dir = Path(__file__).parent.parent
+    for path in sorted(package_dir.rglob("*")):
+        if path.is_file() and "__pycache__" not in path.parts:
+            st = path.stat()
+            result.update(f"{path.relative_to(package_dir)}:{st.st_size}:{st.st_mtime_ns}\0".encode("utf-8"))
+    return result.hexdigest()
+
+
 def install_dir_not_specified(_: CheriConfig, project: "Project"):
     raise RuntimeError("install_dir_not_specified! dummy impl must not be called: " + str(project))
 
@@ -408,6 +424,10 @@ class Project(SimpleProject):
     default_build_tests: bool = True  # whether to build tests by default
     show_optional_tests_in_help: bool = True  # whether to show the --foo/build-tests in --help
     add_gdb_index = True  # whether to build with -Wl,--gdb-index if the linker supports it
+    # Set to True if all configure arguments are known before configure() runs, so that --skip-unchanged-builds can
+    # decide whether the build is up to date. This only applies to the class that sets it: subclasses that override
+    # configure() (and might add further arguments there) have to opt in again.
+    can_skip_unchanged_builds: bool = False
 
     @classmethod
     def dependencies(cls, config: CheriConfig) -> "list[str]":
@@ -1345,14 +1365,16 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
         """
         self.info("Stripping all ELF files in", benchmark_dir)
         self.run_cmd("du", "-sh", benchmark_dir)
+        files = []
         for root, dirnames, filenames in os.walk(str(benchmark_dir)):
             for filename in filenames:
                 file = Path(root, filename)
                 if file.suffix == ".dump":
                     # TODO: make this an error since we should have deleted them
                     self.warning("Will copy a .dump file to the FPGA:", file)
-                # Try to reduce the amount of copied data
-                self.maybe_strip_elf_file(file)
+                files.append(file)
+        # Try to reduce the amount of copied data
+        self.strip_elf_files_in_place(files)
         self.run_cmd("du", "-sh", benchmark_dir)
 
     # @cached_property is important to only compute it once since we encode seconds in the file name:
@@ -1393,6 +1415,65 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
     def _last_clean_counter_path(self) -> Path:
         return Path(self.build_dir, ".cheribuild_last_clean_counter")
 
+    def _build_fingerprint_path(self) -> Path:
+        return Path(self.build_dir, ".cheribuild_build_fingerprint")
+
+    @staticmethod
+    def _file_identity(path: Optional[Path]) -> "list":
+        if path is None:
+            return ["none"]
+        try:
+            st = os.stat(str(path))
+        except OSError:
+            return [str(path), "missing"]
+        return [os.path.realpath(str(path)), st.st_mtime_ns, st.st_size]
+
+    @classmethod
+    def _can_check_build_fingerprint(cls) -> bool:
+        for c in cls.__mro__:
+            if "can_skip_unchanged_builds" in c.__dict__:
+                return c.__dict__["can_skip_unchanged_builds"]
+            if "configure" in c.__dict__:
+                return False  # configure() was overridden after the last class that opted in
+        return False
+
+    def compute_build_fingerprint(self) -> Optional[str]:
+        """
+        :return: a hash of everything that influences the build result (source revision and local changes, build
+        configuration, compiler and recorded fingerprints of all dependencies) or None if it cannot be determined.
+        """
+        if self.repository is None:
+            return None
+        source_fingerprint = self.repository.source_fingerprint(self, src_dir=self.source_dir)
+        if source_fingerprint is None:
+            return None
+        dependency_fingerprints = OrderedDict()
+        for dep in self.cached_full_dependencies():
+            dep_project = dep.get_or_create_project(None, self.config, caller=self)
+            if not isinstance(dep_project, Project):
+                continue
+            # Use the fingerprint recorded by the last build of the dependency instead of recomputing it recursively.
+            # Dependencies are built before this target, so the file reflects what is currently installed.
+            dep_fingerprint_path = dep_project._build_fingerprint_path()
+            if not dep_fingerprint_path.is_file():
+                self.verbose_print("Cannot compute build fingerprint since dependency", dep.name, "has none")
+                return None
+            dependency_fingerprints[dep.name] = dep_fingerprint_path.read_text(encoding="utf-8").strip()
+        inputs = {
+            "cheribuild": _cheribuild_source_fingerprint(),
+            "source": source_fingerprint,
+            "configuration": self.build_configuration_suffix(),
+            "dirs": [str(self.source_dir), str(self.build_dir), str(self.install_dir)],
+            "configure_args": self.configure_args,
+            "configure_env": self.configure_environment,
+            "make_args": [self.make_args.kind.value, self.make_args._vars, self.make_args._with_options,
+                          self.make_args._flags, self.make_args.env_vars],
+            "flags": [self.COMMON_FLAGS, self.CFLAGS, self.CXXFLAGS, self.ASMFLAGS, self.LDFLAGS, self.COMMON_LDFLAGS],
+            "compilers": [self._file_identity(self.CC), self._file_identity(self.CXX)],
+            "dependencies": dependency_fingerprints,
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
     def _parse_require_clean_build_counter(self) -> Optional[int]:
         require_clean_path = Path(self.source_dir, ".require_clean_build")
         if not require_clean_path.exists():
@@ -1484,11 +1565,33 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
                                               base_project_source_dir=self._initial_source_dir,
                                               skip_submodules=self.skip_git_submodules)
         else:
-            self.update()
+            with build_timings.phase(self.target + ": update", "step"):
+                self.update()
         if not self._system_deps_checked:
             self.check_system_dependencies()
         assert self._system_deps_checked, "self._system_deps_checked must be set by now!"
 
+        build_fingerprint: Optional[str] = None
+        build_fingerprint_path = self._build_fingerprint_path()
+        if self.config.skip_unchanged_builds:
+            build_fingerprint = self.compute_build_fingerprint()
+            full_build = not (self.config.skip_configure or self.config.configure_only or self.config.skip_build or
+                              self.config.skip_install)
+            installed = install_dir_kind == DefaultInstallDir.DO_NOT_INSTALL or self.install_dir.is_dir()
+            if not self._can_check_build_fingerprint():
+                self.verbose_print("Not checking build fingerprint since configure() may add further arguments")
+            elif not installed:
+                self.verbose_print("Not checking build fingerprint since", self.install_dir, "does not exist")
+            elif (build_fingerprint is not None and full_build and not self.with_clean and not self._force_clean and
+                    not self.force_configure and build_fingerprint_path.is_file() and
+                    self.read_file(build_fingerprint_path) == build_fingerprint):
+                status_update(self.display_name, "is up to date (build fingerprint", build_fingerprint[:12],
+                              "unchanged), skipping configure/build/install")
+                return
+            # Remove the old fingerprint so that an interrupted build is never treated as up-to-date.
+            if build_fingerprint_path.exists():
+                self.delete_file(build_fingerprint_path)
+
         last_build_file = self._last_build_kind_path()
         if self.build_in_source_dir and not self.with_clean:
             if not last_build_file.exists():
@@ -1549,7 +1652,8 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
             if not self.config.skip_configure or self.config.configure_only:
                 if self.should_run_configure():
                     status_update("Configuring", self.display_name, "... ")
-                    self.configure()
+                    with build_timings.phase(self.target + ": configure", "step"):
+                        self.configure()
             if self.config.configure_only:
                 return
 
@@ -1561,7 +1665,8 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
                                    force=True)
                     # move any csetbounds stats from configuration (since they are not useful)
                 status_update("Building", self.display_name, "... ")
-                self.compile()
+                with build_timings.phase(self.target + ": build", "step"):
+                    self.compile()
 
             # Install step
             if not self.config.skip_install:
@@ -1569,9 +1674,16 @@ add_custom_target(cheribuild-full VERBATIM USES_TERMINAL COMMAND {command} {targ
                 if install_dir_kind == DefaultInstallDir.DO_NOT_INSTALL:
                     self.info("Not installing", self.target, "since install dir is set to DO_NOT_INSTALL")
                 else:
-                    self.install()
+                    with build_timings.phase(self.target + ": install", "step"):
+                        self.install()
                 if is_jenkins_build():
                     self.prepare_install_dir_for_archiving()
+                if not self._can_check_build_fingerprint() and build_fingerprint is not None:
+                    # Still record a fingerprint (including the final configure arguments) so that dependent targets
+                    # can be skipped.
+                    build_fingerprint = self.compute_build_fingerprint()
+                if build_fingerprint is not None and not self.config.skip_build:
+                    self.write_file(build_fingerprint_path, build_fingerprint, overwrite=True)
 
 
 # Shared between meson and CMake
@@ -27,7 +27,10 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
+import concurrent.futures
+import hashlib
 import os
+import re
 import shutil
 import subprocess
 import typing
@@ -37,6 +40,7 @@ from typing import Optional
 from .simple_project import SimpleProject
 from ..config.target_info import CrossCompileTarget
 from ..processutils import get_program_version, run_command
+from ..targets import target_manager
 from ..utils import AnsiColour, coloured, remove_prefix, status_update
 
 if typing.TYPE_CHECKING:
@@ -59,6 +63,13 @@ class SourceRepository(object):
     def get_real_source_dir(self, caller: SimpleProject, base_project_source_dir: Path) -> Path:
         return base_project_source_dir
 
+    def source_fingerprint(self, current_project: "Project", *, src_dir: Path) -> "Optional[str]":
+        """
+        :return: a string that changes whenever the contents of the source directory change or None if this cannot
+        be determined cheaply for this kind of repository.
+        """
+        return None
+
 
 class ExternallyManagedSourceRepository(SourceRepository):
     def ensure_cloned(self, current_project: "Project", src_dir: Path, **kwargs):
@@ -91,6 +102,12 @@ class ReuseOtherProjectRepository(SourceRepository):
             return base_project_source_dir
         return self.source_project.get_source_dir(caller, cross_target=self.repo_for_target) / self.subdirectory
 
+    def source_fingerprint(self, current_project: "Project", *, src_dir: Path) -> "Optional[str]":
+        src_proj = self.source_project.get_instance(current_project, cross_target=self.repo_for_target)
+        if src_proj.repository is None:
+            return None
+        return src_proj.repository.source_fingerprint(src_proj, src_dir=src_proj.source_dir)
+
     def update(self, current_project: "Project", *, src_dir: Path, **kwargs):
         if self.do_update:
             src_proj = self.source_project.get_instance(current_project, cross_target=self.repo_for_target)
@@ -191,15 +208,59 @@ class GitRepository(SourceRepository):
             remote_name, remote_branch = upstream.split("/", maxsplit=1)
             return GitBranchInfo(local_branch=local_branch, remote_name=remote_name, upstream_branch=remote_branch)
 
+    @staticmethod
+    def _supports_partial_clone(current_project: "Project") -> bool:
+        # Partial clone support in the git client was added in 2.19 (--filter=blob:none was added in 2.17).
+        return get_program_version(Path(shutil.which("git") or "git"), config=current_project.config) >= (2, 19)
+
+    @staticmethod
+    def _history_is_truncated(commit: str, expected_branch: str, *, src_dir: Path) -> bool:
+        """
+        :return: True if src_dir is a shallow clone and commit has not been fetched yet or the fetched history of
+        commit and expected_branch does not contain a common ancestor, i.e. we can't tell whether one contains the
+        other without fetching more history.
+        """
+        is_shallow = run_command("git", "rev-parse", "--is-shallow-repository", cwd=src_dir, capture_output=True,
+                                 print_verbose_only=True).stdout.strip()
+        if is_shallow != b"true":
+            return False
+        have_commit = run_command("git", "rev-parse", "--verify", "--quiet", commit + "^{commit}", cwd=src_dir,
+                                  capture_output=True, allow_unexpected_returncode=True, print_verbose_only=True)
+        if have_commit.returncode != 0:
+            # Only hashes can refer to commits that are missing from the history, refs such as @{upstream} can't.
+            return re.fullmatch("[0-9a-f]{7,40}", commit) is not None
+        merge_base = run_command("git", "merge-base", commit, expected_branch, cwd=src_dir, capture_output=True,
+                                 capture_error=True, allow_unexpected_returncode=True, print_verbose_only=True)
+        return merge_base.returncode == 1  # no common ancestor (128 for invalid revisions)
+
     @staticmethod
     def contains_commit(current_project: "Project", commit: str, *, src_dir: Path, expected_branch="HEAD",
                         invalid_commit_ref_result: typing.Any = False):
         if current_project.config.pretend and (not src_dir.exists() or not shutil.which("git")):
             return False
-        # Note: merge-base --is-ancestor exits with code 0/1, so we need to pass allow_unexpected_returncode
-        is_ancestor = run_command("git", "merge-base", "--is-ancestor", commit, expected_branch, cwd=src_dir,
-                                  print_verbose_only=True, capture_error=True, allow_unexpected_returncode=True,
-                                  run_in_pretend_mode=_PRETEND_RUN_GIT_COMMANDS, raise_in_pretend_mode=True)
+        # In a shallow clone the commits connecting the two revisions may not have been fetched yet, so we deepen the
+        # history a bounded number of times (64 + 512 + 4096 commits). We never fetch the full history implicitly
+        # since that can take a very long time for large repositories.
+        deepen_steps = [64, 512, 4096]
+        if getattr(current_project, "skip_update", current_project.config.skip_update):
+            deepen_steps = []  # --skip-update should not fetch anything
+        while True:
+            # Note: merge-base --is-ancestor exits with code 0/1, so we need to pass allow_unexpected_returncode
+            is_ancestor = run_command("git", "merge-base", "--is-ancestor", commit, expected_branch, cwd=src_dir,
+                                      print_verbose_only=True, capture_error=True, allow_unexpected_returncode=True,
+                                      run_in_pretend_mode=_PRETEND_RUN_GIT_COMMANDS, raise_in_pretend_mode=True)
+            if is_ancestor.returncode not in (1, 128) or current_project.config.pretend or \
+                    not GitRepository._history_is_truncated(commit, expected_branch, src_dir=src_dir):
+                break
+            if not deepen_steps:
+                current_project.warning("Cannot determine whether", expected_branch, "contains commit", commit,
+                                        "since the history of the shallow clone", src_dir, "is incomplete. Run",
+                                        coloured(AnsiColour.yellow, "git fetch --unshallow"), "in", src_dir,
+                                        "to fetch the full history.")
+                return invalid_commit_ref_result
+            deepen_by = deepen_steps.pop(0)
+            current_project.info("Fetching", deepen_by, "more commits of", src_dir, "to check for commit", commit)
+            run_command("git", "fetch", "--deepen=" + str(deepen_by), cwd=src_dir)
         if is_ancestor.returncode == 0:
             current_project.verbose_print(coloured(AnsiColour.blue, expected_branch, "contains commit", commit))
             return True
@@ -222,6 +283,33 @@ class GitRepository(SourceRepository):
             raise subprocess.CalledProcessError(is_ancestor.returncode, is_ancestor.args, output=is_ancestor.stdout,
                                                 stderr=is_ancestor.stderr)
 
+    def _update_reference_mirror(self, current_project: "Project") -> "Optional[Path]":
+        """
+        Fetch self.url into the bare repository shared by all clones (--git-reference-mirror), so that it can be used
+        as the reference repository for a new clone.
+
+        :return: the path to the mirror or None if it is not enabled or could not be updated.
+        """
+        mirror = current_project.config.git_reference_mirror
+        if mirror is None:
+            return None
+        # Every URL is a separate remote of the mirror. Tags are not fetched since they can conflict between forks.
+        remote = "mirror-" + hashlib.sha256(self.url.encode("utf-8")).hexdigest()[:16]
+        try:
+            if not (mirror / "HEAD").exists():
+                current_project.makedirs(mirror.parent)
+                current_project.run_cmd("git", "init", "--quiet", "--bare", mirror, cwd="/")
+            has_remote = run_command("git", "-C", mirror, "config", "--get", "remote." + remote + ".url",
+                                     capture_output=True, allow_unexpected_returncode=True,
+                                     print_verbose_only=True).returncode == 0
+            if not has_remote:
+                current_project.run_cmd("git", "-C", mirror, "remote", "add", "--no-tags", remote, self.url, cwd="/")
+            current_project.run_cmd("git", "-C", mirror, "fetch", "--prune", remote, cwd="/")
+        except subprocess.CalledProcessError as e:
+            current_project.warning("Could not update git reference mirror", mirror, "for", self.url, "-", e)
+            return None
+        return mirror
+
     def ensure_cloned(self, current_project: "Project", *, src_dir: Path, base_project_source_dir: Path,
                       skip_submodules=False) -> None:
         if current_project.config.skip_clone:
@@ -239,7 +327,17 @@ class GitRepository(SourceRepository):
                     default_result=True):
                 current_project.fatal("Sources for", str(base_project_source_dir), " missing!")
             clone_cmd = ["git", "clone"]
-            if current_project.config.shallow_clone and not current_project.needs_full_history:
+            reference_mirror = self._update_reference_mirror(current_project)
+            if reference_mirror is not None:
+                # All objects are already available locally, so a shallow clone would not save anything. Submodules
+                # are not part of the mirror, so don't fail if no matching alternate exists for them.
+                clone_cmd = ["git", "-c", "submodule.alternateErrorStrategy=info", "clone", "--reference-if-able",
+                             str(reference_mirror)]
+            elif current_project.config.partial_clone and self._supports_partial_clone(current_project):
+                # Fetch the full history but only download file contents on demand (requires server support, git
+                # falls back to a full clone otherwise).
+                clone_cmd.append("--filter=blob:none")
+            elif current_project.config.shallow_clone and not current_project.needs_full_history:
                 # Note: we pass --no-single-branch since otherwise git fetch will not work with branches and
                 # the solution of running  `git config remote.origin.fetch "+refs/heads/*:refs/remotes/origin/*"`
                 # is not very intuitive. This increases the amount of data fetched but increases usability
@@ -332,6 +430,66 @@ class GitRepository(SourceRepository):
             return base_project_source_dir
         return base_project_source_dir.with_name(target_override.directory_name)
 
+    def source_fingerprint(self, current_project: "Project", *, src_dir: Path) -> "Optional[str]":
+        if not (src_dir / ".git").exists():
+            return None
+        result = hashlib.sha256()
+        try:
+            # The HEAD commit plus the uncommitted changes (including submodule changes)
+            for cmd in (["rev-parse", "HEAD"], ["diff", "HEAD", "--binary", "--no-ext-diff", "--submodule=short"]):
+                result.update(run_command(["git", *cmd], cwd=src_dir, capture_output=True, print_verbose_only=True,
+                                          run_in_pretend_mode=True).stdout)
+            # For untracked files we only use the size and modification time to avoid reading the full contents
+            untracked = run_command("git", "ls-files", "-z", "--others", "--exclude-standard", cwd=src_dir,
+                                    capture_output=True, print_verbose_only=True, run_in_pretend_mode=True).stdout
+        except subprocess.CalledProcessError as e:
+            current_project.verbose_print("Could not compute source fingerprint for", src_dir, e)
+            return None
+        for name in untracked.split(b"\0"):
+            if name:
+                try:
+                    st = os.lstat(os.path.join(os.fsencode(src_dir), name))
+                    result.update(b"%s:%d:%d\0" % (name, st.st_size, st.st_mtime_ns))
+                except OSError:
+                    result.update(name + b":missing\0")
+        return result.hexdigest()
+
+    @staticmethod
+    def _upstream_commit(src_dir: Path) -> "Optional[bytes]":
+        result = run_command("git", "rev-parse", "--verify", "--quiet", "@{upstream}", cwd=src_dir, capture_output=True,
+                             capture_error=True, allow_unexpected_returncode=True, print_verbose_only=True)
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    @classmethod
+    def fetch_concurrently(cls, repositories: "list[tuple[Project, Path]]", *, max_workers: int) -> "dict[Path, bool]":
+        """
+        Run "git fetch" for all (project, source directory) pairs using up to max_workers concurrent processes, so
+        that the network round trips overlap. If the result is passed to TargetManager.add_prefetched_repositories(),
+        the following update() calls for these directories skip the fetch and only have to fast-forward/rebase the
+        repositories whose upstream branch moved.
+
+        :return: a map from source directory to whether the upstream branch moved for all successful fetches
+        """
+        def fetch(project: "Project", src_dir: Path) -> "Optional[bool]":
+            old_upstream = cls._upstream_commit(src_dir)
+            try:
+                run_command("git", "fetch", "--quiet", cwd=src_dir, capture_output=True, capture_error=True,
+                            print_verbose_only=True)
+            except subprocess.CalledProcessError as e:
+                # Let the normal update() fetch again to report the error at the right point.
+                project.warning("Could not fetch", src_dir, "-", e.stderr.decode("utf-8", errors="replace").strip())
+                return None
+            return cls._upstream_commit(src_dir) != old_upstream
+
+        result: "dict[Path, bool]" = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = {src_dir: executor.submit(fetch, project, src_dir) for project, src_dir in repositories}
+            for src_dir, future in futures.items():
+                moved = future.result()
+                if moved is not None:
+                    result[src_dir] = moved
+        return result
+
     def update(self, current_project: "Project", *, src_dir: Path, base_project_source_dir: "Optional[Path]" = None,
                revision=None, skip_submodules=False):
         self.ensure_cloned(current_project, src_dir=src_dir, base_project_source_dir=base_project_source_dir,
@@ -340,6 +498,7 @@ class GitRepository(SourceRepository):
             return
         if not src_dir.exists():
             return
+        upstream_moved = target_manager.take_prefetched_repository(src_dir)
 
         # handle repositories that have moved:
         if src_dir.exists() and self.old_urls:
@@ -360,11 +519,16 @@ class GitRepository(SourceRepository):
                         if current_project.query_yes_no("Update to correct URL?"):
                             run_command("git", "remote", "set-url", branch_info.remote_name, self.url,
                                         run_in_pretend_mode=_PRETEND_RUN_GIT_COMMANDS, cwd=src_dir)
+                            upstream_moved = None  # the concurrent fetch used the old URL
 
         # First fetch all the current upstream branch to see if we need to autostash/pull.
         # Note: "git fetch" without other arguments will fetch from the currently configured upstream.
         # If there is no upstream, it will just return immediately.
-        run_command(["git", "fetch"], cwd=src_dir)
+        if upstream_moved is None:
+            run_command(["git", "fetch"], cwd=src_dir)
+        else:
+            current_project.verbose_print("Already fetched", src_dir, "(upstream changed)" if upstream_moved else
+                                          "(upstream unchanged)")
 
         if revision is not None:
             # TODO: do some rev-parse stuff to check if we are on the right revision?
@@ -414,8 +578,8 @@ class GitRepository(SourceRepository):
             current_project.info("Skipping update: Current HEAD is up-to-date or ahead of upstream.")
             return
         elif up_to_date == "invalid":
-            # Info message was already printed.
-            current_project.info("Skipping update: no upstream configured to update from.")
+            # Info message was already printed (no upstream configured or the shallow history is incomplete).
+            current_project.info("Skipping update: could not compare the current HEAD with upstream.")
             return
         assert up_to_date is False
         current_project.verbose_print(coloured(AnsiColour.blue, "Current HEAD is behind upstream."))
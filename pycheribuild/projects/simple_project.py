@@ -27,9 +27,11 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
+import concurrent.futures
 import errno
 import functools
 import inspect
+import json
 import os
 import shlex
 import shutil
@@ -61,7 +63,8 @@ from ..processutils import (
     run_command,
     set_env,
 )
-from ..targets import MultiArchTarget, MultiArchTargetAlias, Target, target_manager
+from ..targets import DependencyGraph, MultiArchTarget, MultiArchTargetAlias, Target, target_manager
+from ..timing import build_timings
 from ..utils import (
     InstallInstructions,
     OSInfo,
@@ -71,6 +74,7 @@ from ..utils import (
     query_yes_no,
     replace_one,
     status_update,
+    warning_message,
 )
 
 __all__ = ["_cached_get_homebrew_prefix", "_clear_line_sequence", "_default_stdout_filter",  # no-combine
@@ -222,6 +226,58 @@ def _cached_get_homebrew_prefix(package: "Optional[str]", config: CheriConfig):
 _clear_line_sequence: bytes = b"\x1b[2K\r" if sys.stdout.isatty() else b"\n"
 
 
+class _StrippedElfFileCache(object):
+    """
+    Content hashes of ELF files that have been produced by a previous strip invocation. Stripping is idempotent, so
+    files with one of these hashes can be skipped. To avoid reading all files on every run, the hash of each stripped
+    file is also recorded by (st_dev, st_ino, st_size, st_mtime_ns) and files are only hashed if that key is unknown.
+    Stored in <BUILD_ROOT>/stripped-elf-files.json.
+    """
+    FORMAT_VERSION = 2
+    MAX_ENTRIES = 50000
+
+    def __init__(self, config: CheriConfig) -> None:
+        self.config = config
+        self.path = Path(config.build_root, "stripped-elf-files.json")
+        self.hashes: "dict[str, bool]" = {}  # insertion ordered to drop the oldest entries first
+        self.files: "dict[str, str]" = {}  # stat key -> content hash
+        try:
+            with self.path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == self.FORMAT_VERSION:
+                self.hashes = dict.fromkeys(data["hashes"], True)
+                self.files = dict(data["files"])
+        except (OSError, ValueError, KeyError, AttributeError, TypeError):
+            pass  # missing or corrupted cache file -> start with an empty cache
+
+    @staticmethod
+    def stat_key(st: os.stat_result) -> str:
+        return f"{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+    def is_stripped(self, st: os.stat_result) -> bool:
+        digest = self.files.get(self.stat_key(st))
+        return digest is not None and digest in self.hashes
+
+    def add(self, digest: str, st: os.stat_result) -> None:
+        self.hashes.pop(digest, None)
+        self.hashes[digest] = True
+        key = self.stat_key(st)
+        self.files.pop(key, None)
+        self.files[key] = digest
+
+    def save(self) -> None:
+        if self.config.pretend or not self.path.parent.is_dir():
+            return
+        tmpfile = self.path.with_name(self.path.name + ".tmp." + str(os.getpid()))
+        try:
+            with tmpfile.open("w", encoding="utf-8") as f:
+                json.dump({"version": self.FORMAT_VERSION, "hashes": list(self.hashes)[-self.MAX_ENTRIES:],
+                           "files": dict(list(self.files.items())[-self.MAX_ENTRIES:])}, f)
+            os.replace(str(tmpfile), str(self.path))
+        except OSError as e:
+            warning_message("Could not update stripped ELF file cache", self.path, "-", e)
+
+
 class SimpleProject(AbstractProject, metaclass=ABCMeta if typing.TYPE_CHECKING else ProjectSubclassDefinitionHook):
     _commandline_option_group: typing.Any = None
     _config_loader: ConfigLoaderBase = None
@@ -400,48 +456,13 @@ class SimpleProject(AbstractProject, metaclass=ABCMeta if typing.TYPE_CHECKING e
     @classmethod
     def _recursive_dependencies_impl(cls, config: CheriConfig, *, include_dependencies: bool,
                                      include_toolchain_dependencies: bool,
-                                     dependency_chain: "Optional[list[type[SimpleProject]]]" = None,
                                      include_sdk_dependencies: bool) -> "list[Target]":
         assert cls._xtarget is not None, cls
         if not include_dependencies:
             return []
-        if dependency_chain:
-            new_dependency_chain = dependency_chain + [cls]
-            if cls in dependency_chain:
-                cycle = new_dependency_chain[new_dependency_chain.index(cls):]
-                fatal_error("Cyclic dependency found:", " -> ".join(map(lambda c: c.target, cycle)), pretend=False)
-        else:
-            new_dependency_chain = [cls]
-        # look only in __dict__ to avoid parent class lookup
-        cache_lookup_args = (include_dependencies, include_toolchain_dependencies, include_sdk_dependencies)
-        # noinspection PyProtectedMember
-        cached_result = config._cached_deps.get(cls.target, dict()).get(cache_lookup_args, None)
-        if cached_result is not None:
-            return cached_result
-        result = []
-        for target in cls._direct_dependencies(config, include_toolchain_dependencies=include_toolchain_dependencies,
-                                               include_sdk_dependencies=include_sdk_dependencies,
-                                               explicit_dependencies_only=cls.direct_dependencies_only):
-            if config.should_skip_dependency(target.name, cls.target):
-                continue
-
-            if target not in result:
-                result.append(target)
-            if cls.direct_dependencies_only:
-                continue  # don't add recursive dependencies for e.g. "build-and-run"
-            # now recursively add the other deps:
-            recursive_deps = target.project_class._recursive_dependencies_impl(
-                config, include_dependencies=include_dependencies,
-                include_toolchain_dependencies=include_toolchain_dependencies,
-                include_sdk_dependencies=include_sdk_dependencies,
-                dependency_chain=new_dependency_chain)
-            for r in recursive_deps:
-                if r not in result:
-                    result.append(r)
-        # save the result to avoid recomputing it lots of times
-        # noinspection PyProtectedMember
-        config._cached_deps[cls.target][cache_lookup_args] = result
-        return result
+        return list(DependencyGraph.for_config(config).closure(
+            cls, config, include_toolchain_dependencies=include_toolchain_dependencies,
+            include_sdk_dependencies=include_sdk_dependencies))
 
     @classmethod
     def cached_full_dependencies(cls) -> "list[Target]":
@@ -957,6 +978,13 @@ class SimpleProject(AbstractProject, metaclass=ABCMeta if typing.TYPE_CHECKING e
         :param env the environment to pass to make
         :param stdin defaults to /dev/null, set to None to pass the current stdin.
         """
+        with build_timings.phase(self.target + ": " + logfile_name, "command", command=commandline_to_str(args)):
+            self._run_with_logfile_impl(args, logfile_name, stdout_filter=stdout_filter, cwd=cwd, env=env,
+                                        append_to_logfile=append_to_logfile, stdin=stdin)
+
+    def _run_with_logfile_impl(self, args: "typing.Sequence[str]", logfile_name: str, *, stdout_filter=None,
+                               cwd: "Optional[Path]" = None, env: "Optional[dict[str, Optional[str]]]" = None,
+                               append_to_logfile=False, stdin=subprocess.DEVNULL) -> None:
         print_command(args, cwd=cwd, env=env)
         # make sure that env is either None or a os.environ with the updated entries entries
         new_env: "Optional[dict[str, str]]" = None
@@ -1066,6 +1094,61 @@ class SimpleProject(AbstractProject, metaclass=ABCMeta if typing.TYPE_CHECKING e
             self.warning("Failed to detect file type for", file, e)
         return False
 
+    def strip_elf_files_in_place(self, files: "typing.Iterable[Path]", *, batch_size: int = 64) -> "list[Path]":
+        """
+        Runs llvm-strip on all ELF files in files (ignoring symlinks and non-ELF files). Files are stripped in batches
+        with up to --make-jobs strip processes running in parallel. Files whose contents match the result of a previous
+        strip invocation are skipped.
+        :return: the list of files that were stripped
+        """
+        cache = _StrippedElfFileCache(self.config)
+        # Keyed by (st_dev, st_ino) to avoid stripping hardlinked files twice (since that would change the file)
+        to_strip: "dict[tuple[int, int], Path]" = {}
+        cache_updated = False
+        for file in files:
+            if file.is_symlink() or not file.is_file():
+                continue
+            st = file.stat()
+            if (st.st_dev, st.st_ino) in to_strip:
+                continue
+            if cache.is_stripped(st):
+                self.verbose_print("Not stripping", file, "since it has already been stripped")
+                continue
+            try:
+                with file.open("rb") as f:
+                    if f.read(4) != b"\x7fELF":
+                        continue
+            except OSError as e:
+                self.warning("Failed to detect file type for", file, e)
+                continue
+            if not self.should_strip_elf_file_for_tarball(file):
+                continue
+            # Unknown (e.g. copied or touched) file -> fall back to comparing the contents
+            digest = self.sha256sum(file)
+            if digest in cache.hashes:
+                self.verbose_print("Not stripping", file, "since it has already been stripped")
+                cache.add(digest, st)
+                cache_updated = True
+                continue
+            to_strip[(st.st_dev, st.st_ino)] = file
+        if not to_strip:
+            if cache_updated:
+                cache.save()
+            return []
+        stripped = list(to_strip.values())
+        batches = [stripped[i:i + batch_size] for i in range(0, len(stripped), batch_size)]
+        self.verbose_print("Stripping", len(stripped), "ELF files using", len(batches), "strip invocations")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.config.make_jobs)) as executor:
+            futures = [executor.submit(run_command, [self.target_info.strip_tool, *batch], print_verbose_only=True,
+                                       config=self.config) for batch in batches]
+            for future in futures:
+                future.result()  # propagate errors
+        if not self.config.pretend:
+            for file in stripped:
+                cache.add(self.sha256sum(file), file.stat())
+            cache.save()
+        return stripped
+
     def should_strip_elf_file_for_tarball(self, f: Path) -> bool:
         if f.suffix == ".o":
             # We musn't strip crt1.o, etc. sice if we do the linker can't find essential symbols such as __start
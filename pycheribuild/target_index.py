@@ -0,0 +1,139 @@
+#
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import hashlib
+import json
+import os
+import sys
+import typing
+from pathlib import Path
+from typing import Optional
+
+__all__ = ["TargetIndex"]  # no-combine
+
+
+class TargetIndex(object):
+    """
+    A cached description of all targets (target name -> module, class, supported architectures, declared config
+    options) that is generated after all project modules have been loaded. It allows the TargetManager to only import
+    the modules for the targets that are actually used and to validate config file keys for the other targets.
+    The index is tied to a fingerprint of the cheribuild sources and is ignored (and regenerated) if any file changes.
+    """
+    FORMAT_VERSION = 1
+    source_dir: Path = Path(__file__).resolve().parent
+
+    # Values for the "kind" field of an entry:
+    TARGET = "target"
+    MULTIARCH_ALIAS = "multiarch-alias"
+    ALIAS = "alias"
+    DEPRECATED_ALIAS = "deprecated-alias"
+
+    def __init__(self, targets: "dict[str, dict[str, typing.Any]]",
+                 config_only_targets: "dict[str, dict[str, typing.Any]]", option_aliases: "dict[str, str]") -> None:
+        # Every entry has the keys "module", "class", "kind", "architectures", "hybrid" and "options", where "options"
+        # is the list of config option names without the "<target>/" prefix.
+        self.targets = targets
+        # Targets such as "cheribsd" that don't have a default architecture and only exist for the fallback options.
+        self.config_only_targets = config_only_targets
+        # Alternative config file keys (old target names, short option names) -> name of the target declaring them.
+        self.option_aliases = option_aliases
+        self._option_sets: "dict[str, frozenset[str]]" = {}
+
+    @staticmethod
+    def cache_file_path(name: str) -> Path:
+        cache_dir = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        # Include the checkout path in the name, so that multiple cheribuild checkouts don't keep replacing the index.
+        checkout_hash = hashlib.sha256(str(TargetIndex.source_dir).encode("utf-8")).hexdigest()[:16]
+        return Path(cache_dir, "cheribuild", name + "-" + checkout_hash + ".json")
+
+    @staticmethod
+    def default_path() -> Path:
+        return TargetIndex.cache_file_path("target-index")
+
+    @staticmethod
+    def write_cache_file(path: Path, contents: str) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so that concurrent cheribuild invocations never see a partial file.
+        tmp_path = path.with_name(path.name + "." + str(os.getpid()) + ".tmp")
+        try:
+            tmp_path.write_text(contents, encoding="utf-8")
+            os.replace(str(tmp_path), str(path))
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    @classmethod
+    def source_fingerprint(cls) -> str:
+        # Checking size+mtime of all source files only takes a few milliseconds, whereas reading them would not.
+        h = hashlib.sha256(sys.version.encode("utf-8"))
+        for path in sorted(cls.source_dir.rglob("*.py")):
+            st = path.stat()
+            h.update("\0{}\0{}\0{}".format(path.relative_to(cls.source_dir), st.st_size, st.st_mtime_ns).encode())
+        return h.hexdigest()
+
+    @classmethod
+    def load(cls, path: "Optional[Path]" = None) -> "Optional[TargetIndex]":
+        """:return: the index stored in path or None if it does not exist or is out of date."""
+        if path is None:
+            path = cls.default_path()
+        try:
+            with path.open("r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get("version") != cls.FORMAT_VERSION or \
+                data.get("fingerprint") != cls.source_fingerprint():
+            return None
+        return cls(data["targets"], data["config_only_targets"], data["option_aliases"])
+
+    def save(self, path: "Optional[Path]" = None) -> None:
+        if path is None:
+            path = self.default_path()
+        data = {"version": self.FORMAT_VERSION, "fingerprint": self.source_fingerprint(), "targets": self.targets,
+                "config_only_targets": self.config_only_targets, "option_aliases": self.option_aliases}
+        self.write_cache_file(path, json.dumps(data, separators=(",", ":")))
+
+    def find_entry(self, target_name: str) -> "Optional[dict[str, typing.Any]]":
+        result = self.targets.get(target_name)
+        if result is None:
+            result = self.config_only_targets.get(target_name)
+        return result
+
+    def module_for_target(self, target_name: str) -> Optional[str]:
+        entry = self.find_entry(target_name)
+        return entry["module"] if entry is not None else None
+
+    def target_declaring_option(self, option_name: str) -> Optional[str]:
+        """:return: the target that declares the config option option_name (including alternative names) or None."""
+        if option_name in self.option_aliases:
+            return self.option_aliases[option_name]
+        target_name, _, suffix = option_name.partition("/")
+        entry = self.find_entry(target_name)
+        if entry is None:
+            return None
+        options = self._option_sets.get(target_name)
+        if options is None:
+            options = frozenset(entry["options"])
+            self._option_sets[target_name] = options
+        return target_name if suffix in options else None
@@ -27,16 +27,25 @@
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
 #
+import heapq
+import importlib
+import multiprocessing
+import multiprocessing.connection
 import os
+import subprocess
 import sys
+import threading
 import time
 import typing
 from collections import OrderedDict
+from pathlib import Path
 from typing import Callable, Optional, Union
 
 from .config.chericonfig import CheriConfig
 from .config.target_info import AbstractProject, CrossCompileTarget
-from .processutils import set_env
+from .processutils import _compiler_probe_cache, commandline_to_str, set_env
+from .target_index import TargetIndex
+from .timing import build_timings
 from .utils import (
     AnsiColour,
     add_error_context,
@@ -49,6 +58,7 @@ from .utils import (
 )
 
 if typing.TYPE_CHECKING:  # no-combine
+    from .config.config_loader_base import ConfigOptionBase  # no-combine
     from .projects.simple_project import SimpleProject  # no-combine
 
 
@@ -142,7 +152,8 @@ class Target(object):
     def _do_run(self, config, msg: str, func: "Callable[[SimpleProject], typing.Any]"):
         # instantiate the project and run it
         starttime = time.time()
-        with add_error_context(coloured(AnsiColour.yellow, "(in target ", self.name, ")", sep="")):
+        with add_error_context(coloured(AnsiColour.yellow, "(in target ", self.name, ")", sep="")), \
+                build_timings.phase(self.name, "target", action=msg):
             project = self.get_or_create_project(self.project_class.get_crosscompile_target(), config, None)
             new_env = {"PATH": project.config.dollar_path_with_other_tools}
             if project.config.clang_colour_diags:
@@ -187,37 +198,15 @@ class Target(object):
         self._creating_project = False
         self._project_class.targets_reset()
 
-    # noinspection PyProtectedMember
-    def __lt__(self, other: "Target"):
-        # print(self, "__lt__", other)
-        # if this target is one of the dependencies order it before
-        other_deps = other.project_class.cached_full_dependencies()
-        # print("other deps:", other_deps)
-        if self in other_deps:
-            # print(self, "is in", other, "deps -> is less")
-            return True
-        # and if it is the other way around we are not less
-        if other in self.project_class.cached_full_dependencies():
-            # print(other, "is in", self, "deps -> is greater")
-            return False
-        if other.name.startswith("run") and not self.name.startswith("run"):
-            return True  # run must be executed last
-        elif self.name.startswith("run"):
-            return False
-        if other.name.startswith("disk-image") and not self.name.startswith("disk-image"):
-            return True  # disk-image should be done just before run
-        elif self.name.startswith("disk-image"):
-            return False
-        # print(self, "is not in", other, "deps -> is not less")
-        # otherwise just keep everything in order
-        return False
-        # This was previously done
-        # ownDeps = self.project_class.all_dependency_names()
-        # if len(ownDeps) < len(other_deps):
-        #     return True
-        # if len(ownDeps) > len(other_deps):
-        #     return False
-        # return self.name < other.name  # not a dep and number of deps is the same -> compare name
+    @property
+    def sort_priority(self) -> int:
+        # Used to order targets that do not depend on each other: run must be executed last and disk-image should be
+        # done just before run. Everything else keeps the order in which it was passed.
+        if self.name.startswith("run"):
+            return 2
+        if self.name.startswith("disk-image"):
+            return 1
+        return 0
 
     def __repr__(self) -> str:
         return "<Target " + self.name + ">"
@@ -366,10 +355,83 @@ class DeprecatedTargetAlias(SimpleTargetAlias):
         return self._real_target
 
 
+class DependencyGraph(object):
+    """
+    Memoized recursive dependencies of all targets for a given CheriConfig. The closure for each target is computed
+    once per (include_toolchain_dependencies, include_sdk_dependencies) combination and reused by all targets that
+    depend on it. Results are stored as ordered sets (dicts with None values) to avoid quadratic duplicate checks.
+    """
+
+    def __init__(self) -> None:
+        self._direct_deps: "dict[tuple[str, bool, bool, bool], list[Target]]" = {}
+        self._closures: "dict[tuple[str, bool, bool], dict[Target, None]]" = {}
+        self._in_progress: "list[type[SimpleProject]]" = []
+
+    @staticmethod
+    def for_config(config: CheriConfig) -> "DependencyGraph":
+        # noinspection PyProtectedMember
+        if config._dependency_graph is None:
+            config._dependency_graph = DependencyGraph()
+        return config._dependency_graph
+
+    # noinspection PyProtectedMember
+    def direct_dependencies(self, project_class: "type[SimpleProject]", config: CheriConfig, *,
+                            include_toolchain_dependencies: bool, include_sdk_dependencies: bool,
+                            explicit_dependencies_only: bool) -> "list[Target]":
+        key = (project_class.target, include_toolchain_dependencies, include_sdk_dependencies,
+               explicit_dependencies_only)
+        result = self._direct_deps.get(key)
+        if result is None:
+            result = list(project_class._direct_dependencies(
+                config, include_toolchain_dependencies=include_toolchain_dependencies,
+                include_sdk_dependencies=include_sdk_dependencies,
+                explicit_dependencies_only=explicit_dependencies_only))
+            self._direct_deps[key] = result
+        return result
+
+    def closure(self, project_class: "type[SimpleProject]", config: CheriConfig, *,
+                include_toolchain_dependencies: bool, include_sdk_dependencies: bool) -> "dict[Target, None]":
+        key = (project_class.target, include_toolchain_dependencies, include_sdk_dependencies)
+        result = self._closures.get(key)
+        if result is not None:
+            return result
+        if project_class in self._in_progress:
+            cycle = self._in_progress[self._in_progress.index(project_class):] + [project_class]
+            fatal_error("Cyclic dependency found:", " -> ".join(map(lambda c: c.target, cycle)), pretend=False)
+        self._in_progress.append(project_class)
+        try:
+            result = OrderedDict()
+            for target in self.direct_dependencies(project_class, config,
+                                                   include_toolchain_dependencies=include_toolchain_dependencies,
+                                                   include_sdk_dependencies=include_sdk_dependencies,
+                                                   explicit_dependencies_only=project_class.direct_dependencies_only):
+                if config.should_skip_dependency(target.name, project_class.target):
+                    continue
+                result[target] = None
+                if project_class.direct_dependencies_only:
+                    continue  # don't add recursive dependencies for e.g. "build-and-run"
+                # Existing keys keep their position, so this matches appending all new recursive dependencies.
+                result.update(self.closure(target.project_class, config,
+                                           include_toolchain_dependencies=include_toolchain_dependencies,
+                                           include_sdk_dependencies=include_sdk_dependencies))
+        finally:
+            self._in_progress.pop()
+        self._closures[key] = result
+        return result
+
+
 class TargetManager(object):
     def __init__(self) -> None:
         self._all_targets: "dict[str, Target]" = {}
         self._targets_for_command_line_options_only: "dict[str, MultiArchTargetAlias]" = {}
+        self._targets_with_options: "set[str]" = set()
+        self._command_line_options_registered = False
+        # If set, project modules are only imported once one of their targets is used (see use_target_index()).
+        self._target_index: Optional[TargetIndex] = None
+        self._all_targets_loaded = False
+        # Source directories fetched by _fetch_git_repositories() -> whether the upstream branch moved.
+        # GitRepository.update() consumes these entries instead of running "git fetch" again.
+        self._prefetched_repositories: "dict[Path, bool]" = {}
 
     def add_target_for_config_options_only(self, target: MultiArchTargetAlias) -> None:
         # TODO remove this ugly hack
@@ -391,43 +453,174 @@ class TargetManager(object):
         # this cannot be done in the Project metaclass as otherwise we get
         # RuntimeError: super(): empty __class__ cell
         # https://stackoverflow.com/questions/13126727/how-is-super-in-python-3-implemented/28605694#28605694
-        for tgt in self._all_targets.values():
-            if not isinstance(tgt, SimpleTargetAlias):
+        # Note: this can be called again after loading further project modules and will only register the options for
+        # the targets that were added since the last call.
+        for tgt in list(self._all_targets.values()):
+            if not isinstance(tgt, SimpleTargetAlias) and tgt.name not in self._targets_with_options:
+                self._targets_with_options.add(tgt.name)
                 tgt.project_class.setup_config_options()
         # Ugly hack to keep registering the command line arguments for the fallback option name: for example,
         # cherisd-mips64-hybrid/foo loads the value from cheribsd/foo if it's not found.
-        for tgt in self._targets_for_command_line_options_only.values():
-            tgt.project_class.setup_config_options()
+        for tgt in list(self._targets_for_command_line_options_only.values()):
+            if tgt.name not in self._targets_with_options:
+                self._targets_with_options.add(tgt.name)
+                tgt.project_class.setup_config_options()
+        self._command_line_options_registered = True
+
+    def use_target_index(self, index: TargetIndex) -> None:
+        """
+        Only import project modules once one of their targets is needed instead of importing all of them upfront.
+        Targets that are referenced by name will be loaded on demand (e.g. when resolving dependencies).
+        """
+        self._target_index = index
+
+    @property
+    def _loading_on_demand(self) -> bool:
+        return self._target_index is not None and not self._all_targets_loaded
+
+    def _targets_added(self) -> None:
+        # Targets that are loaded after the command line options have been registered should still get their options.
+        if self._command_line_options_registered:
+            self.register_command_line_options()
+
+    def load_all_targets(self) -> None:
+        if self._all_targets_loaded:
+            return
+        self._all_targets_loaded = True
+        if __package__:  # all projects are already included in the combined single-file cheribuild.py
+            for package in (__package__ + ".projects", __package__ + ".projects.cross"):
+                for module in importlib.import_module(package).__all__:
+                    importlib.import_module(package + "." + module)
+        self._targets_added()
+
+    def _load_target_on_demand(self, name: str) -> bool:
+        """:return: True if the index knows about target name and the module defining it has been imported."""
+        if not self._loading_on_demand:
+            return False
+        assert self._target_index is not None
+        module = self._target_index.module_for_target(name)
+        if module is None:
+            return False
+        importlib.import_module(module)
+        if name not in self._all_targets and name not in self._targets_for_command_line_options_only:
+            # Should not happen since the index is regenerated when any file changes, but fall back to loading all
+            # projects if the target was not defined in the expected module.
+            self.load_all_targets()
+        self._targets_added()
+        return True
+
+    def load_targets_referenced_by(self, args: "typing.Iterable[str]") -> None:
+        """
+        Load the targets named in args (a list of command line arguments) as well as the targets that declare any of
+        the options in args (e.g. --qemu/no-use-lto), so that their options can be parsed.
+        """
+        if not self._loading_on_demand:
+            return
+        for arg in args:
+            for word in arg.lstrip("-").split("=", 1):
+                name = word.partition("/")[0]
+                if name not in self._all_targets and name not in self._targets_for_command_line_options_only:
+                    self._load_target_on_demand(name)
+
+    def is_declared_target_option(self, name: str) -> bool:
+        """:return: True if name is an option of a target that has not been loaded yet."""
+        if not self._loading_on_demand:
+            return False
+        assert self._target_index is not None
+        return self._target_index.target_declaring_option(name) is not None
+
+    def create_target_index(self, options: "typing.Iterable[ConfigOptionBase]") -> TargetIndex:
+        """Create the index from all currently loaded targets and their registered config options"""
+        options_by_class: "dict[type, list[str]]" = {}
+        option_aliases: "dict[str, str]" = {}
+        for option in options:
+            # noinspection PyProtectedMember
+            owning_class = option._owning_class
+            if owning_class is None:
+                continue  # options of the global CheriConfig are always available
+            target_name, _, suffix = option.full_option_name.partition("/")
+            options_by_class.setdefault(owning_class, []).append(suffix)
+            alternative_names = list(option.alias_names or [])
+            if option.shortname and len(option.shortname) > 1:
+                alternative_names.append(option.shortname.lstrip("-"))
+            for alias in alternative_names:
+                option_aliases[alias] = target_name
+
+        def index_entry(target: Target, kind: str, config_only=False) -> "dict[str, typing.Any]":
+            if isinstance(target, MultiArchTargetAlias):
+                architectures = [t.target_arch.generic_target_suffix for t in target.derived_targets]
+            else:
+                architectures = [target.xtarget.generic_target_suffix]
+            project_class = target.project_class
+            is_alias = isinstance(target, SimpleTargetAlias)
+            return {"module": project_class.__module__, "class": project_class.__name__, "kind": kind,
+                    "architectures": architectures, "hybrid": not config_only and self._is_hybrid_target(target),
+                    "options": [] if is_alias else options_by_class.get(project_class, [])}
+
+        targets: "dict[str, dict[str, typing.Any]]" = {}
+        for name, tgt in self._all_targets.items():
+            if isinstance(tgt, DeprecatedTargetAlias):
+                targets[name] = index_entry(tgt, TargetIndex.DEPRECATED_ALIAS)
+            elif isinstance(tgt, SimpleTargetAlias):
+                targets[name] = index_entry(tgt, TargetIndex.ALIAS)
+            elif isinstance(tgt, MultiArchTargetAlias):
+                targets[name] = index_entry(tgt, TargetIndex.MULTIARCH_ALIAS)
+            else:
+                targets[name] = index_entry(tgt, TargetIndex.TARGET)
+        config_only_targets = {name: index_entry(tgt, TargetIndex.MULTIARCH_ALIAS, config_only=True) for name, tgt in
+                               self._targets_for_command_line_options_only.items()}
+        return TargetIndex(targets, config_only_targets, option_aliases)
+
+    @staticmethod
+    def _is_hybrid_target(target: Target) -> bool:
+        xtarget = target.xtarget
+        # NB: We allow hybrid for baremetal targets (for now...)
+        return (xtarget.get_rootfs_target().is_cheri_hybrid() and not xtarget.target_info_cls.is_baremetal()
+                and not xtarget.is_native())
 
     @staticmethod
     def target_disabled_reason(target: Target, config: CheriConfig) -> Optional[str]:
-        if not config.enable_hybrid_targets:
-            xtarget = target.xtarget
-            # NB: We allow hybrid for baremetal targets (for now...)
-            if (xtarget.get_rootfs_target().is_cheri_hybrid() and not xtarget.target_info_cls.is_baremetal()
-                    and not xtarget.is_native()):
-                return target.name + " is a hybrid target, which should not be used unless you know what you're " + \
-                       "doing. If you are still sure you want to build this, use --enable-hybrid-targets."
+        if not config.enable_hybrid_targets and TargetManager._is_hybrid_target(target):
+            return target.name + " is a hybrid target, which should not be used unless you know what you're " + \
+                   "doing. If you are still sure you want to build this, use --enable-hybrid-targets."
         return None
 
     def enabled_target_items(self, config: Optional[CheriConfig]):
+        self.load_all_targets()
         items = self._all_targets.items()
         if config is not None:
             items = filter(lambda item: not self.target_disabled_reason(item[1], config), items)
         return items
 
-    def target_names(self, config: Optional[CheriConfig]):
+    def _enabled_index_entries(self, config: Optional[CheriConfig]) -> "typing.Iterator[tuple[str, str]]":
+        # Returns the same names as enabled_target_items() (along with the kind of target), but uses the target index
+        # if not all targets have been loaded.
+        if self._loading_on_demand:
+            assert self._target_index is not None
+            for name, entry in self._target_index.targets.items():
+                if config is None or config.enable_hybrid_targets or not entry["hybrid"]:
+                    yield name, entry["kind"]
+            return
         for name, value in self.enabled_target_items(config):
+            if isinstance(value, DeprecatedTargetAlias):
+                yield name, TargetIndex.DEPRECATED_ALIAS
+            elif isinstance(value, _TargetAliasBase):
+                yield name, TargetIndex.ALIAS
+            else:
+                yield name, TargetIndex.TARGET
+
+    def target_names(self, config: Optional[CheriConfig]):
+        for name, _ in self._enabled_index_entries(config):
             yield name
 
     def non_alias_target_names(self, config: Optional[CheriConfig]) -> "typing.Iterator[str]":
-        for name, value in self.enabled_target_items(config):
-            if not isinstance(value, _TargetAliasBase):
+        for name, kind in self._enabled_index_entries(config):
+            if kind == TargetIndex.TARGET:
                 yield name
 
     def non_deprecated_target_names(self, config: Optional[CheriConfig]) -> "typing.Iterator[str]":
-        for name, value in self.enabled_target_items(config):
-            if not isinstance(value, DeprecatedTargetAlias):
+        for name, kind in self._enabled_index_entries(config):
+            if kind != TargetIndex.DEPRECATED_ALIAS:
                 yield name
 
     def targets(self, config: Optional[CheriConfig]) -> "typing.Iterator[Target]":
@@ -436,6 +629,8 @@ class TargetManager(object):
 
     def get_target_raw(self, name: str) -> Target:
         # return the actual target without resolving MultiArchTargetAlias
+        if name not in self._all_targets and name not in self._targets_for_command_line_options_only:
+            self._load_target_on_demand(name)
         try:
             return self._all_targets[name]
         except KeyError:
@@ -451,12 +646,44 @@ class TargetManager(object):
         # print(" ->", target)
         return target
 
+    @staticmethod
+    def _dependency_index(targets: "list[Target]") -> "dict[Target, set[Target]]":
+        # Note: this requires the full dependency cache to be initialized for all targets
+        all_targets = set(targets)
+        result: "dict[Target, set[Target]]" = OrderedDict()
+        for target in targets:
+            deps = all_targets.intersection(target.project_class.cached_full_dependencies())
+            deps.discard(target)
+            result[target] = deps
+        return result
+
     @staticmethod
     def sort_in_dependency_order(targets: "typing.Iterable[Target]") -> "list[Target]":
-        # pythons sorted() is guaranteed to be stable:
-        sorted_targets = list(sorted(targets))
         # remove duplicates (insert into an orderdict to keep order
-        return list(OrderedDict((x, True) for x in sorted_targets).keys())
+        unique_targets = list(OrderedDict((x, True) for x in targets).keys())
+        deps_index = TargetManager._dependency_index(unique_targets)
+        needed_by: "dict[Target, list[Target]]" = {t: [] for t in unique_targets}
+        for target, deps in deps_index.items():
+            for dep in deps:
+                needed_by[dep].append(target)
+        # Kahn's algorithm: out of all targets whose dependencies have already been added pick the one with the lowest
+        # sort_priority and use the original position as a tie-breaker to keep the order stable.
+        position = {t: i for i, t in enumerate(unique_targets)}
+        remaining_deps = {t: len(deps) for t, deps in deps_index.items()}
+        ready = [(t.sort_priority, position[t], t) for t in unique_targets if not remaining_deps[t]]
+        heapq.heapify(ready)
+        result: "list[Target]" = []
+        while ready:
+            target = heapq.heappop(ready)[2]
+            result.append(target)
+            for other in needed_by[target]:
+                remaining_deps[other] -= 1
+                if not remaining_deps[other]:
+                    heapq.heappush(ready, (other.sort_priority, position[other], other))
+        if len(result) != len(unique_targets):
+            fatal_error("Cyclic dependency found between targets:",
+                        ", ".join(t.name for t in unique_targets if remaining_deps[t]), pretend=False)
+        return result
 
     def get_all_targets(self, explicit_targets: "list[Target]", config: CheriConfig) -> "list[Target]":
         chosen_targets: "list[Target]" = []
@@ -471,7 +698,7 @@ class TargetManager(object):
                 if dep not in chosen_targets:
                     chosen_targets.append(dep)
         for t in chosen_targets:
-            # Initialize the full dependency cache so that sort() works (otherwise we'd have to pass config to __lt__).
+            # Initialize the full dependency cache so that sort_in_dependency_order() can build the dependency index.
             t.cache_dependencies(config)
         sort = self.sort_in_dependency_order(chosen_targets)
         if config.start_with is not None or config.start_after is not None:
@@ -495,18 +722,167 @@ class TargetManager(object):
     def run(self, config: CheriConfig, chosen_targets=None) -> None:
         if chosen_targets is None:
             chosen_targets = self.get_all_chosen_targets(config)
+        build_timings.enabled = config.timing_trace is not None and not config.pretend
+        try:
+            self._run(config, chosen_targets)
+        finally:
+            if config.timing_trace is not None and not config.pretend:
+                build_timings.write(config.timing_trace)
+                status_update("Wrote build timings to", config.timing_trace)
+
+    def _run(self, config: CheriConfig, chosen_targets: "list[Target]") -> None:
         with set_env(PATH=config.dollar_path_with_other_tools,
                      CLANG_FORCE_COLOR_DIAGNOSTICS="always" if config.clang_colour_diags else None,
                      config=config):
             for target in chosen_targets:
                 target.check_system_deps(config)
+            if config.fetch_concurrently and not config.pretend:
+                self._fetch_git_repositories(config, chosen_targets)
             # all dependencies exist -> run the targets
-            for target in chosen_targets:
-                target.execute(config)
+            if config.parallel_targets > 1 and len(chosen_targets) > 1 and not config.pretend:
+                self._execute_in_parallel(config, chosen_targets)
+            else:
+                for target in chosen_targets:
+                    target.execute(config)
+
+    def add_prefetched_repositories(self, fetched: "dict[Path, bool]") -> None:
+        self._prefetched_repositories.update(fetched)
+
+    def take_prefetched_repository(self, source_dir: Path) -> "Optional[bool]":
+        """
+        :return: whether the upstream branch of source_dir moved if it has already been fetched (the entry is removed
+        so that later updates fetch again) or None if "git fetch" still needs to be run.
+        """
+        return self._prefetched_repositories.pop(source_dir, None)
+
+    # noinspection PyProtectedMember
+    def _fetch_git_repositories(self, config: CheriConfig, chosen_targets: "list[Target]") -> None:
+        """
+        Fetch all existing git checkouts of the chosen targets concurrently before building, so that the update step
+        of each target only has to fast-forward the repositories that changed instead of waiting for the network.
+        """
+        from .projects.repository import GitRepository
+        repositories: "dict[Path, SimpleProject]" = {}
+        for target in chosen_targets:
+            if target._completed:
+                continue
+            project = target._get_or_create_project_no_setup(None, config, None)
+            repository = getattr(project, "repository", None)
+            if not isinstance(repository, GitRepository) or project.skip_update:
+                continue
+            source_dir = project.source_dir
+            if isinstance(source_dir, Path) and (source_dir / ".git").exists():
+                repositories.setdefault(source_dir, project)
+        if len(repositories) < 2:
+            return  # nothing to overlap
+        starttime = time.time()
+        with build_timings.phase("fetch git repositories", "step", repositories=len(repositories)):
+            fetched = GitRepository.fetch_concurrently([(p, d) for d, p in repositories.items()],
+                                                       max_workers=config.make_jobs)
+        self.add_prefetched_repositories(fetched)
+        status_update("Fetched", len(fetched), "git repositories in", round(time.time() - starttime, 2), "seconds,",
+                      sum(fetched.values()), "of them have upstream changes")
+
+    @staticmethod
+    def dependency_graph(sorted_targets: "list[Target]", config: CheriConfig) -> "dict[Target, set[Target]]":
+        """
+        Returns a map from each target to the subset of sorted_targets that must have been executed before it.
+        In addition to the real dependencies, run-* and disk-image-* targets wait for all targets that were sorted
+        before them to match the ordering of the sequential execution.
+        """
+        for target in sorted_targets:
+            target.cache_dependencies(config)
+        result = TargetManager._dependency_index(sorted_targets)
+        for i, target in enumerate(sorted_targets):
+            if target.sort_priority > 0:
+                result[target].update(sorted_targets[:i])
+        return result
+
+    @staticmethod
+    def split_jobs(total_jobs: int, available_jobs: int, num_to_start: int, *, num_running: int, num_pending: int,
+                   parallel_targets: int) -> "list[int]":
+        """
+        :return: the number of jobs for each of the num_to_start targets that are being started now.
+        If there are further pending targets that cannot be started yet, every target only gets its fair share of
+        --make-jobs and the remaining jobs are held back for the targets that become ready later. Otherwise, all
+        available jobs are handed out.
+        """
+        if num_to_start <= 0:
+            return []
+        assert num_to_start <= available_jobs
+        if num_pending == num_to_start:
+            jobs_per_target, extra_jobs = divmod(available_jobs, num_to_start)
+            return [jobs_per_target + (1 if i < extra_jobs else 0) for i in range(num_to_start)]
+        fair_share = max(1, total_jobs // min(parallel_targets, num_running + num_pending))
+        result = []
+        for i in range(num_to_start):
+            # Leave at least one job for each of the other targets that are being started now.
+            jobs = min(fair_share, available_jobs - (num_to_start - i - 1))
+            result.append(jobs)
+            available_jobs -= jobs
+        return result
+
+    def _execute_in_parallel(self, config: CheriConfig, chosen_targets: "list[Target]") -> None:
+        graph = self.dependency_graph(chosen_targets, config)
+        pending = list(chosen_targets)
+        completed: "set[Target]" = set()
+        running: "dict[int, tuple[Target, multiprocessing.Process, int, threading.Thread]]" = {}
+        failed: "list[Target]" = []
+        available_jobs = config.make_jobs
+        # Use fork() so that the child inherits the already initialized projects and does not have to re-import them.
+        # This also ensures that the set_env() calls inside the child do not affect the other running targets.
+        mp_context = multiprocessing.get_context("fork")
+        output_lock = threading.Lock()
+        while pending or running:
+            if not failed:
+                ready = [t for t in pending if graph[t].issubset(completed)]
+                # Never start more targets than there are jobs left, so that the total stays within --make-jobs.
+                num_to_start = min(len(ready), config.parallel_targets - len(running), available_jobs)
+                job_counts = self.split_jobs(config.make_jobs, available_jobs, num_to_start,
+                                             num_running=len(running), num_pending=len(pending),
+                                             parallel_targets=config.parallel_targets)
+                for target, jobs in zip(ready, job_counts):
+                    available_jobs -= jobs
+                    status_update("Starting target", target.name, "with", jobs, "jobs (" + str(len(running) + 1),
+                                  "of at most", config.parallel_targets, "running targets)")
+                    read_fd, write_fd = os.pipe()
+                    process = mp_context.Process(target=_execute_target_in_child,
+                                                 args=(target, config, jobs, write_fd),
+                                                 name="cheribuild-" + target.name)
+                    # The output forwarding threads only write to stdout while holding output_lock, so holding it
+                    # while forking ensures that the child does not inherit a locked stdout buffer.
+                    with output_lock:
+                        process.start()
+                    os.close(write_fd)
+                    output_thread = threading.Thread(target=_forward_child_output,
+                                                     args=(read_fd, target.name, output_lock), daemon=True)
+                    output_thread.start()
+                    running[process.sentinel] = (target, process, jobs, output_thread)
+                    pending.remove(target)
+            if not running:
+                assert failed or not pending, "No runnable targets left: " + str(pending)
+                break
+            for sentinel in multiprocessing.connection.wait(list(running.keys())):
+                target, process, jobs, output_thread = running.pop(sentinel)
+                process.join()
+                output_thread.join()
+                if config.timing_trace is not None:
+                    build_timings.merge_child_events(config.timing_trace, process.pid)
+                available_jobs += jobs
+                if process.exitcode == 0:
+                    target._completed = True
+                    completed.add(target)
+                else:
+                    warning_message("Target", target.name, "failed with exit code", process.exitcode)
+                    failed.append(target)
+        if failed:
+            fatal_error("The following targets failed:", ", ".join(t.name for t in failed),
+                        "\nNot started:", ", ".join(t.name for t in pending) if pending else "<none>", pretend=False)
 
     def get_all_chosen_targets(self, config) -> "list[Target]":
         # check that all target dependencies are correct:
         if os.getenv("CHERIBUILD_DEBUG"):
+            self.load_all_targets()
             for t in self._all_targets.values():
                 if isinstance(t, MultiArchTargetAlias):
                     continue
@@ -521,6 +897,8 @@ class TargetManager(object):
         # assert self._all_targets["sdk"] > self._all_targets["sdk-sysroot"]
         explicitly_chosen_targets: "list[Target]" = []
         for target_name in config.targets:
+            if target_name not in self._all_targets:
+                self._load_target_on_demand(target_name)
             if target_name not in self._all_targets:
                 # See if it was a target alias without a default
                 if target_name in self._targets_for_command_line_options_only:
@@ -552,4 +930,44 @@ class TargetManager(object):
             i.reset()
 
 
+def _forward_child_output(read_fd: int, target_name: str, output_lock: threading.Lock) -> None:
+    prefix = coloured(AnsiColour.cyan, "[" + target_name + "] ").encode("utf-8")
+    with os.fdopen(read_fd, "rb") as stream:
+        for line in stream:
+            with output_lock:
+                sys.stdout.buffer.write(prefix + line)
+                sys.stdout.buffer.flush()
+
+
+def _execute_target_in_child(target: Target, config: CheriConfig, make_jobs: int, output_fd: int) -> None:
+    # Targets running concurrently must not prompt for input: read from /dev/null so that query_yes_no() returns the
+    # default result. All output goes through a pipe to the parent which prefixes each line with the target name.
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    sys.stdin = sys.__stdin__ = open(0, "r", closefd=False)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(output_fd, 1)
+    os.dup2(output_fd, 2)
+    os.close(output_fd)
+    sys.stdout.reconfigure(line_buffering=True)
+    sys.stderr.reconfigure(line_buffering=True)
+    config.make_jobs = make_jobs
+    build_timings.reset()  # only report the events of this child to the parent process
+    try:
+        target.execute(config)
+    except subprocess.CalledProcessError as err:
+        fatal_error("Command ", "`" + commandline_to_str(err.cmd) + "` failed with non-zero exit code ",
+                    err.returncode, " (in target ", target.name, ")", sep="", exit_code=err.returncode or 1,
+                    pretend=False)
+    finally:
+        if config.timing_trace is not None:
+            build_timings.write_child_events(config.timing_trace)
+        # multiprocessing children exit via os._exit() without running the atexit handlers.
+        _compiler_probe_cache.save()
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
 target_manager: TargetManager = TargetManager()
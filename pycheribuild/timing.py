@@ -0,0 +1,130 @@
+#
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+#
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+import typing
+from pathlib import Path
+
+__all__ = ["BuildTimings", "build_timings"]  # no-combine
+
+
+class BuildTimings(object):
+    """
+    Records the wall time, child CPU time, peak child RSS and exit status of build phases (targets, update/configure/
+    build/install steps and individual commands). The result can be written as a Chrome trace file that can be
+    loaded in chrome://tracing or https://ui.perfetto.dev.
+    """
+
+    def __init__(self) -> None:
+        self.events: "list[dict[str, typing.Any]]" = []
+        self.enabled = False  # Only record events if --timing-trace was passed
+        self._lock = threading.Lock()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.events.clear()
+
+    @contextlib.contextmanager
+    def phase(self, name: str, category: str, **args) -> "typing.Iterator[dict[str, typing.Any]]":
+        """
+        Context manager that records one phase. The yielded dict can be used to add additional arguments to the event.
+        """
+        extra_args: "dict[str, typing.Any]" = dict(args)
+        if not self.enabled:
+            yield extra_args
+            return
+        start = time.time()
+        # RUSAGE_CHILDREN is per-process, so a phase running in a worker thread would also include the children of all
+        # other threads. Only report the child resource usage for phases running on the main thread.
+        start_usage = resource.getrusage(resource.RUSAGE_CHILDREN) if _is_main_thread() else None
+        status = "success"
+        try:
+            yield extra_args
+        except subprocess.CalledProcessError as e:
+            status = "exit code " + str(e.returncode)
+            raise
+        except BaseException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            end = time.time()
+            extra_args.update(status=status, wall_time=round(end - start, 6))
+            if start_usage is not None:
+                end_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+                extra_args.update(
+                    children_user_time=round(end_usage.ru_utime - start_usage.ru_utime, 6),
+                    children_system_time=round(end_usage.ru_stime - start_usage.ru_stime, 6),
+                    # ru_maxrss is the peak RSS of the largest child that has been waited for so far (in KiB on Linux
+                    # and bytes on macOS), so only report it if it increased during this phase.
+                    children_max_rss=end_usage.ru_maxrss if end_usage.ru_maxrss > start_usage.ru_maxrss else None,
+                )
+            event = {"name": name, "cat": category, "ph": "X", "ts": int(start * 1000000),
+                     "dur": int((end - start) * 1000000), "pid": os.getpid(), "tid": threading.get_ident(),
+                     "args": extra_args}
+            with self._lock:
+                self.events.append(event)
+
+    def to_chrome_trace(self) -> "dict[str, typing.Any]":
+        with self._lock:
+            return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def write(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("w", encoding="utf-8") as f:
+            json.dump(self.to_chrome_trace(), f, indent=1)
+
+    # Targets executed with --parallel-targets run in a forked child process, these helpers are used to pass the
+    # events recorded in the child process back to the parent.
+    @staticmethod
+    def _child_events_path(path: Path, pid: int) -> Path:
+        return path.with_name(path.name + "." + str(pid) + ".part")
+
+    def write_child_events(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._child_events_path(path, os.getpid()).open("w", encoding="utf-8") as f:
+            json.dump(self.events, f)
+
+    def merge_child_events(self, path: Path, pid: int) -> None:
+        child_events = self._child_events_path(path, pid)
+        try:
+            with child_events.open("r", encoding="utf-8") as f:
+                events = json.load(f)
+            child_events.unlink()
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            self.events.extend(e for e in events if e.get("pid") == pid)
+
+
+def _is_main_thread() -> bool:
+    return threading.current_thread() is threading.main_thread()
+
+
+build_timings = BuildTimings()
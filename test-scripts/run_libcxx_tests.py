@@ -34,10 +34,12 @@ import atexit
 import datetime
 import os
 import signal
+import subprocess
 import sys
 import tempfile
 import time
 import traceback
+from collections import deque
 from multiprocessing import Barrier, Process, Queue
 from pathlib import Path
 from queue import Empty
@@ -55,7 +57,8 @@ def add_cmdline_args(parser: argparse.ArgumentParser):
                                                 allow_multiprocessing=True)
 
 
-def run_shard(q: Queue, barrier: Barrier, num, total, ssh_port_queue, kernel, disk_image, build_dir):
+def run_shard(q: Queue, barrier: Barrier, num, total, ssh_port_queue, kernel, disk_image, build_dir,
+              work_queue: "Optional[Queue]" = None):
     sys.argv.append("--internal-num-shards=" + str(total))
     sys.argv.append("--internal-shard=" + str(num))
     if kernel is not None:
@@ -69,7 +72,7 @@ def run_shard(q: Queue, barrier: Barrier, num, total, ssh_port_queue, kernel, di
     boot_cheribsd.QEMU_LOGFILE = Path(build_dir, "shard-" + str(num) + ".log")
     boot_cheribsd.info("writing CheriBSD output to ", boot_cheribsd.QEMU_LOGFILE)
     try:
-        libcxx_main(barrier=barrier, mp_queue=q, ssh_port_queue=ssh_port_queue, shard_num=num)
+        libcxx_main(barrier=barrier, mp_queue=q, ssh_port_queue=ssh_port_queue, shard_num=num, work_queue=work_queue)
         boot_cheribsd.success("====> Job ", num, " completed")
     except Exception as e:
         boot_cheribsd.failure("Job ", num, " failed: ", e, exit=False)
@@ -77,7 +80,8 @@ def run_shard(q: Queue, barrier: Barrier, num, total, ssh_port_queue, kernel, di
 
 
 def libcxx_main(barrier: "Optional[Barrier]" = None, mp_queue: "Optional[Queue]" = None,
-                ssh_port_queue: "Optional[Queue]" = None, shard_num: "Optional[int]" = None):
+                ssh_port_queue: "Optional[Queue]" = None, shard_num: "Optional[int]" = None,
+                work_queue: "Optional[Queue]" = None):
     def set_cmdline_args(args: argparse.Namespace):
         boot_cheribsd.info("Setting args:", args)
         if mp_queue:
@@ -97,7 +101,7 @@ def libcxx_main(barrier: "Optional[Barrier]" = None, mp_queue: "Optional[Queue]"
             # TODO: do we need lit_extra_args=["-Denable_filesystem=False"]?
             # Some of the tests might fail on a SMBFS directory.
             return run_remote_lit_test.run_remote_lit_tests("libcxx", qemu, args, tempdir, mp_q=mp_queue,
-                                                            barrier=barrier)
+                                                            barrier=barrier, work_queue=work_queue)
 
     try:
         run_tests_main(test_function=run_libcxx_tests, need_ssh=True,  # we need ssh running to execute the tests
@@ -120,6 +124,72 @@ class LitShardProcess(Process):
     error_message = ""
 
 
+class DynamicTestScheduler(object):
+    """
+    Hands out batches of tests to shards that request more work (instead of using lit's static --num-shards split).
+    If a shard fails while running a batch, that batch is given to another shard. Batches that also fail on the second
+    attempt (e.g. because one of the tests crashes CheriBSD) are given up on and reported as lost.
+    """
+
+    def __init__(self, tests: "list[str]", batch_size: int, work_queues: "list[Queue]"):
+        self.work_queues = work_queues
+        self.pending: "deque[tuple[int, list[str]]]" = deque(
+            (i, tests[start:start + batch_size]) for i, start in enumerate(range(0, len(tests), batch_size)))
+        self.in_flight: "dict[int, tuple[int, list[str]]]" = {}  # shard number -> batch
+        self.idle_shards: "list[int]" = []
+        self.retried_batches: "set[int]" = set()
+        self.lost_batches: "list[tuple[int, list[str]]]" = []
+
+    def request_tests(self, shard: int) -> None:
+        # A shard only asks for more work once its previous batch has completed.
+        self.in_flight.pop(shard, None)
+        self.idle_shards.append(shard)
+        self._dispatch()
+
+    def shard_failed(self, shard: int) -> None:
+        if shard in self.idle_shards:
+            self.idle_shards.remove(shard)
+        batch = self.in_flight.pop(shard, None)
+        if batch is not None:
+            if batch[0] in self.retried_batches:
+                boot_cheribsd.failure("Batch ", batch[0], " failed twice, giving up on ", len(batch[1]), " tests",
+                                      exit=False)
+                self.lost_batches.append(batch)
+            else:
+                boot_cheribsd.info("Redistributing batch ", batch[0], " from failed shard ", shard)
+                self.retried_batches.add(batch[0])
+                self.pending.appendleft(batch)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self.idle_shards and self.pending:
+            shard = self.idle_shards.pop(0)
+            batch = self.pending.popleft()
+            self.in_flight[shard] = batch
+            self.work_queues[shard - 1].put(batch)
+        # Idle shards have to wait while other shards are still running tests since those might crash and we would
+        # then have to redistribute their batch. Once everything has completed tell all idle shards to exit.
+        if not self.pending and not self.in_flight:
+            for shard in self.idle_shards:
+                self.work_queues[shard - 1].put(None)
+            self.idle_shards.clear()
+
+    def unfinished_tests(self) -> "list[str]":
+        batches = self.lost_batches + list(self.pending) + list(self.in_flight.values())
+        return [test for _, tests in batches for test in tests]
+
+
+def discover_lit_tests(args: argparse.Namespace) -> "list[str]":
+    llvm_lit_path = args.llvm_lit_path or str(Path(args.build_dir, "bin/llvm-lit"))
+    lit_cmd = [sys.executable, llvm_lit_path, "--show-tests", "test"]
+    boot_cheribsd.print_cmd(lit_cmd, cwd=args.build_dir)
+    if args.pretend:
+        return []
+    output = subprocess.check_output(lit_cmd, cwd=args.build_dir, universal_newlines=True)
+    # The tests are listed as "  <suite> :: <path>" after the "-- Available Tests --" header.
+    return [line.strip() for line in output.splitlines() if line.startswith("  ") and " :: " in line]
+
+
 def run_parallel(args: argparse.Namespace):
     if args.pretend:
         boot_cheribsd.PRETEND = True
@@ -132,6 +202,20 @@ def run_parallel(args: argparse.Namespace):
     mp_q = Queue()
     ssh_port_queue = Queue()
     processes: "list[LitShardProcess]" = []
+    scheduler: "Optional[DynamicTestScheduler]" = None
+    work_queues: "list[Optional[Queue]]" = [None] * args.parallel_jobs
+    if args.dynamic_scheduling:
+        if args.dynamic_batch_size < 1:
+            boot_cheribsd.failure("Invalid batch size: ", args.dynamic_batch_size, exit=True)
+        tests = discover_lit_tests(args)
+        if args.xunit_output:
+            # Don't merge stale results from a previous run
+            xunit_file = Path(args.xunit_output).absolute()
+            for stale_file in xunit_file.parent.glob("batch-*-" + xunit_file.name):
+                stale_file.unlink()
+        work_queues = [Queue() for _ in range(args.parallel_jobs)]
+        scheduler = DynamicTestScheduler(tests, args.dynamic_batch_size, work_queues)
+        boot_cheribsd.success("Distributing ", len(tests), " tests in ", len(scheduler.pending), " batches")
     # Extract the kernel + disk image in the main process to avoid race condition:
     kernel_path = boot_cheribsd.maybe_decompress(Path(args.kernel), True, True, args,
                                                  what="kernel") if args.kernel else None
@@ -142,7 +226,7 @@ def run_parallel(args: argparse.Namespace):
         boot_cheribsd.info(args)
         p = LitShardProcess(target=run_shard, args=(
             mp_q, mp_barrier, shard_num, args.parallel_jobs, ssh_port_queue, kernel_path, disk_image_path,
-            args.build_dir))
+            args.build_dir, work_queues[i]))
         p.stage = run_remote_lit_test.MultiprocessStages.FINDING_SSH_PORT
         p.daemon = True  # kill process on parent exit
         p.name = "<LIBCXX test shard " + str(shard_num) + ">"
@@ -151,7 +235,7 @@ def run_parallel(args: argparse.Namespace):
         atexit.register(p.terminate)
     dump_processes(processes)
     try:
-        return run_parallel_impl(args, processes, mp_q, mp_barrier, ssh_port_queue)
+        return run_parallel_impl(args, processes, mp_q, mp_barrier, ssh_port_queue, scheduler)
     except BaseException as e:
         boot_cheribsd.info("Got error while running run_parallel_impl (", type(e), "): ", e)
         raise
@@ -163,11 +247,27 @@ def run_parallel(args: argparse.Namespace):
             result = junitparser.JUnitXml()
             xunit_file = Path(args.xunit_output).absolute()
             dump_processes(processes)
+            if scheduler is not None:
+                for batch_file in sorted(xunit_file.parent.glob("batch-*-" + xunit_file.name)):
+                    result += junitparser.JUnitXml.fromfile(str(batch_file))
+                unfinished_tests = scheduler.unfinished_tests()
+                if unfinished_tests:
+                    error_msg = "ERROR: " + str(len(unfinished_tests)) + " tests were not run:\n" + "\n".join(
+                        unfinished_tests)
+                    boot_cheribsd.failure(error_msg, exit=False)
+                    error_suite = junitparser.TestSuite(name="unfinished-tests")
+                    error_case = junitparser.TestCase(name="tests-not-run")
+                    error_case.classname = "unfinished-tests"
+                    error_case.result = junitparser.Error(message=error_msg)
+                    error_suite.add_testcase(error_case)
+                    result.add_testsuite(error_suite)
             for i in range(args.parallel_jobs):
                 shard_num = i + 1
                 shard_file = xunit_file.with_name("shard-" + str(shard_num) + "-" + xunit_file.name)
                 mp_debug(args, processes[i], processes[i].stage)
-                if shard_file.exists():
+                if scheduler is not None:
+                    pass  # With dynamic scheduling the results are written per batch instead (and merged above)
+                elif shard_file.exists():
                     result += junitparser.JUnitXml.fromfile(str(shard_file))
                 else:
                     error_msg = "ERROR: could not find JUnit XML " + str(shard_file) + " for shard " + str(shard_num)
@@ -232,7 +332,7 @@ def dump_processes(processes: "list[LitShardProcess]"):
 
 def run_parallel_impl(args: argparse.Namespace, processes: "list[LitShardProcess]", mp_q: Queue,
                       mp_barrier: Barrier,
-                      ssh_port_queue: Queue):
+                      ssh_port_queue: Queue, scheduler: "Optional[DynamicTestScheduler]" = None):
     timed_out = False
     starttime = datetime.datetime.now()
     ssh_ports = []  # check that we don't have multiple parallel jobs trying to use the same port
@@ -320,6 +420,9 @@ def run_parallel_impl(args: argparse.Namespace, processes: "list[LitShardProcess
                         boot_cheribsd.success("Barrier has been released, tests should run now.")
                 # assert target_process.stage < shard_result[2], "STAGE WENT BACKWARDS?"
                 target_process.stage = shard_result[2]
+            elif shard_result[0] == run_remote_lit_test.REQUEST_TESTS and scheduler is not None:
+                mp_debug(args, "===> Shard ", shard_result[1], " requested more tests")
+                scheduler.request_tests(shard_result[1])
             elif shard_result[0] == run_remote_lit_test.FAILURE:
                 previous_stage = target_process.stage
                 target_process.stage = run_remote_lit_test.MultiprocessStages.FAILED
@@ -331,6 +434,11 @@ def run_parallel_impl(args: argparse.Namespace, processes: "list[LitShardProcess
                                           previous_stage, " -> Aborting all other shards", exit=False)
                     timed_out = True
                     break
+                elif scheduler is not None:
+                    # The remaining shards can take over the tests of the failed one.
+                    boot_cheribsd.failure("===> ERROR: Shard ", shard_result[1], " failed while running tests: ",
+                                          shard_result[2], exit=False)
+                    scheduler.shard_failed(shard_result[1])
                 else:
                     boot_cheribsd.failure("===> ERROR: Shard ", shard_result[1], " failed while running tests: ",
                                           shard_result[2], exit=True)
@@ -345,6 +453,8 @@ def run_parallel_impl(args: argparse.Namespace, processes: "list[LitShardProcess
                         mp_debug(args, "Already retried read after finding dead process", p)
                         boot_cheribsd.failure("===> ERROR: shard ", p, " died without sending a message!", exit=False)
                         remaining_processes.remove(p)
+                        if scheduler is not None:
+                            scheduler.shard_failed(processes.index(p) + 1)
                     else:
                         # Try to read from the queue one more time to see if we missed a message
                         retrying_queue_read = True
@@ -36,8 +36,7 @@ def run_libffi_tests(qemu: boot_cheribsd.QemuCheriBSDInstance, args: argparse.Na
     boot_cheribsd.info("Running libffi tests")
     print(args)
     # copy the shared libraries to the host and link to /usr/lib so that the tests can run:
-    for i in Path(args.build_dir, ".libs").glob("libffi.so*"):
-        qemu.scp_to_guest(i, str(Path("/tmp", i.name)))
+    qemu.scp_files_to_guest(sorted(Path(args.build_dir, ".libs").glob("libffi.so*")), "/tmp/")
     qemu.checked_run("ln -sf /tmp/libffi.so* /usr/lib")
     Path(args.build_dir, "site.exp").write_text(f"""
 if ![info exists boards_dir] {{
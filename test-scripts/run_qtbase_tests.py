@@ -84,6 +84,10 @@ def copy_qt_libs_to_tmpfs_and_set_libpath(qemu: boot_cheribsd.QemuCheriBSDInstan
     # Copy the libraries to tmpfs to avoid long loading times over smbfs
     qemu.checked_run("mkdir /tmp/qt-libs")
     num_libs = 0
+    libs_to_copy: "list[Path]" = []
+    # Waiting for the shell prompt after every command on the serial console is slow, so run all of them in a single
+    # SSH session instead.
+    commands: "list[str]" = []
     for lib in sorted(Path(args.build_dir, "lib").glob("*.so*")):
         if lib.name.endswith(".debug"):
             continue  # don't copy the debug info files, they are huge
@@ -93,13 +97,18 @@ def copy_qt_libs_to_tmpfs_and_set_libpath(qemu: boot_cheribsd.QemuCheriBSDInstan
             if os.path.pathsep in linkpath:
                 boot_cheribsd.failure("Unexpected link path for ", lib.absolute(), ": ", linkpath, exit=False)
                 continue
-            qemu.checked_run("ln -sfn {} /tmp/qt-libs/{}".format(linkpath, lib.name))
+            commands.append("ln -sfn {} /tmp/qt-libs/{}".format(linkpath, lib.name))
         else:
             if args.copy_libraries_to_tmpfs_using_scp:
-                qemu.scp_to_guest(lib, "/tmp/qt-libs/" + lib.name)
+                libs_to_copy.append(lib)
             else:
-                qemu.checked_run("cp -fav /build/lib/{} /tmp/qt-libs/".format(lib.name))
+                commands.append("cp -fav /build/lib/{} /tmp/qt-libs/".format(lib.name))
             num_libs += 1
+    if commands:
+        qemu.run_commands_via_ssh(commands)
+    if libs_to_copy:
+        # Copy all libraries with a single scp command to avoid the per-invocation overhead
+        qemu.scp_files_to_guest(libs_to_copy, "/tmp/qt-libs/")
     boot_cheribsd.success("Copied ", num_libs, " files to tmpfs")
     boot_cheribsd.prepend_ld_library_path(qemu, "/tmp/qt-libs")
 
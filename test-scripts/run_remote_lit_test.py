@@ -33,6 +33,7 @@ import argparse
 import datetime
 import multiprocessing
 import os
+import re
 import subprocess
 import sys
 import threading
@@ -44,9 +45,11 @@ from typing import Optional
 from run_tests_common import boot_cheribsd, commandline_to_str, pexpect
 
 KERNEL_PANIC = False
+QEMU_EXITED = False
 COMPLETED = "COMPLETED"
 NEXT_STAGE = "NEXT_STAGE"
 FAILURE = "FAILURE"
+REQUEST_TESTS = "REQUEST_TESTS"
 
 
 class MultiprocessStages(Enum):
@@ -74,6 +77,12 @@ def add_common_cmdline_args(parser: argparse.ArgumentParser, default_xunit_outpu
         parser.add_argument("--multiprocessing-debug", action="store_true")
         parser.add_argument("--parallel-jobs", metavar="N", type=int,
                             help="Split up the testsuite into N parallel jobs")
+        parser.add_argument("--dynamic-scheduling", action="store_true",
+                            help="Instead of statically splitting the testsuite into N parts, hand out small batches "
+                                 "of tests to whichever job is idle (and re-run the tests of jobs that crashed)")
+        parser.add_argument("--dynamic-batch-size", metavar="N", type=int, default=10,
+                            help="Number of tests per batch when using --dynamic-scheduling. Every batch starts a "
+                                 "separate llvm-lit invocation, so small batches add noticeable overhead.")
         parser.add_argument("--internal-num-shards", type=int, help=argparse.SUPPRESS)
         parser.add_argument("--internal-shard", type=int, help=argparse.SUPPRESS)
 
@@ -128,15 +137,55 @@ def flush_thread(f, qemu: boot_cheribsd.QemuCheriBSDInstance, should_exit_event:
         elif i == 2:
             boot_cheribsd.failure("GOT QEMU EOF!", exit=False)
             # QEMU exited?
+            global QEMU_EXITED
+            QEMU_EXITED = True
             break
     # One final expect to flush the buffer:
     qemu.expect([pexpect.TIMEOUT, pexpect.EOF], timeout=1)
     boot_cheribsd.success("QEMU output flushing thread terminated.")
 
 
+def lit_filter_regex(tests: "list[str]") -> str:
+    # lit matches --filter against the full test name ("suite :: path")
+    return "^(" + "|".join(re.escape(test) for test in tests) + ")$"
+
+
+def run_lit_test_batches(lit_cmd: "list[str]", args: argparse.Namespace, work_queue: multiprocessing.Queue,
+                         mp_q: multiprocessing.Queue, xunit_file: "Optional[Path]", cwd: Path,
+                         qemu: boot_cheribsd.CheriBSDInstance) -> bool:
+    """Keep requesting batches of tests from the main process and run them until there is no work left"""
+    all_passed = True
+    while True:
+        # If the guest is gone every further batch would fail immediately. Raise an error instead so that the main
+        # process hands out the current batch (and all remaining ones) to the other shards.
+        if KERNEL_PANIC:
+            raise RuntimeError("Kernel panic while running tests")
+        if QEMU_EXITED or (not boot_cheribsd.PRETEND and not qemu.isalive()):
+            raise RuntimeError("QEMU exited while running tests")
+        mp_q.put((REQUEST_TESTS, args.internal_shard))
+        batch = work_queue.get()
+        if batch is None:
+            return all_passed
+        batch_id, tests = batch
+        batch_cmd = lit_cmd + ["--filter=" + lit_filter_regex(tests)]
+        if xunit_file:
+            batch_cmd += ["--xunit-xml-output",
+                          str(xunit_file.with_name("batch-" + str(batch_id) + "-" + xunit_file.name))]
+        boot_cheribsd.info("Running batch ", batch_id, " (", len(tests), " tests)")
+        try:
+            boot_cheribsd.run_host_command(batch_cmd, cwd=str(cwd))
+        except subprocess.CalledProcessError as e:
+            # Should only ever return 1 (otherwise something else went wrong!)
+            if e.returncode != 1:
+                raise
+            boot_cheribsd.failure("SHARD", args.internal_shard, ": SOME TESTS FAILED in batch ", batch_id, exit=False)
+            all_passed = False
+
+
 def run_remote_lit_tests(testsuite: str, qemu: boot_cheribsd.CheriBSDInstance, args: argparse.Namespace, tempdir: str,
                          mp_q: multiprocessing.Queue = None, barrier: multiprocessing.Barrier = None,
-                         llvm_lit_path: "Optional[str]" = None, lit_extra_args: list = None) -> bool:
+                         llvm_lit_path: "Optional[str]" = None, lit_extra_args: list = None,
+                         work_queue: "Optional[multiprocessing.Queue]" = None) -> bool:
     try:
         import psutil  # noqa: F401
     except ImportError:
@@ -145,7 +194,8 @@ def run_remote_lit_tests(testsuite: str, qemu: boot_cheribsd.CheriBSDInstance, a
         if mp_q:
             assert barrier is not None
         result = run_remote_lit_tests_impl(testsuite=testsuite, qemu=qemu, args=args, tempdir=tempdir, barrier=barrier,
-                                           mp_q=mp_q, llvm_lit_path=llvm_lit_path, lit_extra_args=lit_extra_args)
+                                           mp_q=mp_q, llvm_lit_path=llvm_lit_path, lit_extra_args=lit_extra_args,
+                                           work_queue=work_queue)
         if mp_q:
             mp_q.put((COMPLETED, args.internal_shard))
         return result
@@ -159,7 +209,8 @@ def run_remote_lit_tests(testsuite: str, qemu: boot_cheribsd.CheriBSDInstance, a
 
 def run_remote_lit_tests_impl(testsuite: str, qemu: boot_cheribsd.CheriBSDInstance, args: argparse.Namespace,
                               tempdir: str, mp_q: multiprocessing.Queue = None, barrier: multiprocessing.Barrier = None,
-                              llvm_lit_path: "Optional[str]" = None, lit_extra_args: list = None) -> bool:
+                              llvm_lit_path: "Optional[str]" = None, lit_extra_args: list = None,
+                              work_queue: "Optional[multiprocessing.Queue]" = None) -> bool:
     qemu.EXIT_ON_KERNEL_PANIC = False  # since we run multiple threads we shouldn't use sys.exit()
     boot_cheribsd.info("PID of QEMU: ", qemu.pid)
 
@@ -174,6 +225,7 @@ def run_remote_lit_tests_impl(testsuite: str, qemu: boot_cheribsd.CheriBSDInstan
     port = args.ssh_port
     user = "root"  # TODO: run these tests as non-root!
     test_build_dir = Path(args.build_dir)
+    assert isinstance(qemu, boot_cheribsd.QemuCheriBSDInstance)
     # TODO: move this to boot_cheribsd.py
     config_contents = """
 Host cheribsd-test-instance
@@ -185,18 +237,15 @@ Host cheribsd-test-instance
         UserKnownHostsFile /dev/null
         StrictHostKeyChecking no
         NoHostAuthenticationForLocalhost yes
-        # faster connection by reusing the existing one:
-        ControlPath {home}/.ssh/controlmasters/%r@%h:%p
+        # faster connection by reusing the QEMU instance's control master connection:
+        ControlPath {control_path}
         # ConnectTimeout 20
         # ConnectionAttempts 2
-        ControlMaster auto
-""".format(user=user, port=port, ssh_key=Path(args.ssh_key).with_suffix(""), home=Path.home())
-    config_contents += "        ControlPersist {control_persist}\n"
+        ControlMaster no
+""".format(user=user, port=port, ssh_key=Path(args.ssh_key).with_suffix(""), control_path=qemu.ssh_master.control_path)
     # print("Writing ssh config: ", config_contents)
     with Path(tempdir, "config").open("w") as c:
-        # Keep socket open for 10 min (600) or indefinitely (yes)
-        c.write(config_contents.format(control_persist="yes"))
-    Path(Path.home(), ".ssh/controlmasters").mkdir(exist_ok=True)
+        c.write(config_contents)
     boot_cheribsd.run_host_command(["cat", str(Path(tempdir, "config"))])
 
     # Check that the config file works:
@@ -209,22 +258,14 @@ Host cheribsd-test-instance
         connection_time = (datetime.datetime.utcnow() - connection_test_start).total_seconds()
         boot_cheribsd.success(prefix, " successful after ", connection_time, " seconds")
 
-    check_ssh_connection("First SSH connection")
-    controlmaster_running = False
-    try:
-        # Check that controlmaster worked by running ssh -O check
-        boot_cheribsd.info("Checking if SSH control master is working.")
-        boot_cheribsd.run_host_command(
-            ["ssh", "-F", str(Path(tempdir, "config")), "cheribsd-test-instance", "-p", str(port), "-O", "check"],
-            cwd=str(test_build_dir))
-        check_ssh_connection("Second SSH connection (with controlmaster)")
-        controlmaster_running = True
-    except subprocess.CalledProcessError:
-        boot_cheribsd.failure(
-            "WARNING: Could not connect to ControlMaster SSH connection. Running tests will be slower", exit=False)
-        with Path(tempdir, "config").open("w") as c:
-            c.write(config_contents.format(control_persist="no"))
-        check_ssh_connection("Second SSH connection (without controlmaster)")
+    boot_cheribsd.info("Starting SSH control master connection.")
+    if qemu.ssh_master.start():
+        check_ssh_connection("SSH connection (with controlmaster)")
+    else:
+        if not args.pretend:
+            boot_cheribsd.failure(
+                "WARNING: Could not connect to ControlMaster SSH connection. Running tests will be slower", exit=False)
+        check_ssh_connection("SSH connection (without controlmaster)")
 
     if args.pretend:
         time.sleep(2.5)
@@ -258,16 +299,19 @@ Host cheribsd-test-instance
     lit_cmd.append("--timeout=120")  # 2 minutes max per test (in case there is an infinite loop)
     xunit_file: "Optional[Path]" = None
     if args.xunit_output:
-        lit_cmd.append("--xunit-xml-output")
         xunit_file = Path(args.xunit_output).absolute()
-        if args.internal_shard:
-            xunit_file = xunit_file.with_name("shard-" + str(args.internal_shard) + "-" + xunit_file.name)
-        lit_cmd.append(str(xunit_file))
+        # With dynamic scheduling every batch of tests writes its own XML file
+        if work_queue is None:
+            if args.internal_shard:
+                xunit_file = xunit_file.with_name("shard-" + str(args.internal_shard) + "-" + xunit_file.name)
+            lit_cmd.append("--xunit-xml-output")
+            lit_cmd.append(str(xunit_file))
     qemu_logfile = qemu.logfile
     if args.internal_shard:
-        assert args.internal_num_shards, "Invalid call!"
-        lit_cmd.append("--num-shards=" + str(args.internal_num_shards))
-        lit_cmd.append("--run-shard=" + str(args.internal_shard))
+        if work_queue is None:
+            assert args.internal_num_shards, "Invalid call!"
+            lit_cmd.append("--num-shards=" + str(args.internal_num_shards))
+            lit_cmd.append("--run-shard=" + str(args.internal_shard))
         if xunit_file:
             assert qemu_logfile is not None, "Should have a valid logfile when running multiple shards"
             boot_cheribsd.success("Writing QEMU output to ", qemu_logfile)
@@ -282,7 +326,11 @@ Host cheribsd-test-instance
     shard_prefix = "SHARD" + str(args.internal_shard) + ": " if args.internal_shard else ""
     try:
         boot_cheribsd.success("Starting llvm-lit: cd ", test_build_dir, " && ", " ".join(lit_cmd))
-        boot_cheribsd.run_host_command(lit_cmd, cwd=str(test_build_dir))
+        if work_queue is not None:
+            if not run_lit_test_batches(lit_cmd, args, work_queue, mp_q, xunit_file, test_build_dir, qemu):
+                return False
+        else:
+            boot_cheribsd.run_host_command(lit_cmd, cwd=str(test_build_dir))
         # lit_proc = pexpect.spawnu(lit_cmd[0], lit_cmd[1:], echo=True, timeout=60, cwd=str(test_build_dir))
         # TODO: get stderr!!
         # while lit_proc.isalive():
@@ -310,14 +358,9 @@ Host cheribsd-test-instance
     finally:
         if qemu_logfile:
             qemu_logfile.flush()
-        if controlmaster_running:
+        if qemu.ssh_master.running:
             boot_cheribsd.info("Terminating SSH controlmaster")
-            try:
-                boot_cheribsd.run_host_command(
-                    ["ssh", "-F", str(Path(tempdir, "config")), "cheribsd-test-instance", "-p", str(port), "-O",
-                     "exit"], cwd=str(test_build_dir))
-            except subprocess.CalledProcessError:
-                boot_cheribsd.failure("Could not close SSH controlmaster connection.", exit=False)
+            qemu.ssh_master.stop()
         qemu.flush_interval = 0.1
         should_exit_event.set()
         t.join(timeout=30)
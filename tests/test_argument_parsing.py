@@ -1,5 +1,5 @@
-import collections
 import inspect
+import os
 import re
 import sys
 import tempfile
@@ -13,6 +13,7 @@ import pytest
 
 # First thing we need to do is set up the config loader (before importing anything else!)
 # We can't do from pycheribuild.configloader import ConfigLoader here because that will only update the local copy
+from pycheribuild.completion import CompletionIndex
 from pycheribuild.config.compilation_targets import CompilationTargets, FreeBSDTargetInfo
 from pycheribuild.config.defaultconfig import DefaultCheriConfig
 from pycheribuild.config.loader import ConfigLoaderBase, ConfigOptionBase, JsonAndCommandLineConfigOption
@@ -35,6 +36,7 @@ from pycheribuild.projects.run_qemu import LaunchCheriBSD
 
 # Override the default config loader:
 from pycheribuild.projects.simple_project import SimpleProject
+from pycheribuild.target_index import TargetIndex
 from pycheribuild.targets import MultiArchTargetAlias, Target, target_manager
 
 Target.instantiating_targets_should_warn = False
@@ -59,7 +61,7 @@ def _parse_arguments(args: "list[str]", *, config_file=Path("/this/does/not/exis
                      allow_unknown_options=False) -> DefaultCheriConfig:
     assert isinstance(args, list)
     assert all(isinstance(arg, str) for arg in args), "Invalid argv " + str(args)
-    ConfigLoaderBase._cheri_config._cached_deps = collections.defaultdict(dict)
+    ConfigLoaderBase._cheri_config._dependency_graph = None
     assert isinstance(ConfigLoaderBase._cheri_config, DefaultCheriConfig)
     target_manager.reset()
     ConfigLoaderBase._cheri_config.loader._config_path = config_file
@@ -210,6 +212,108 @@ def test_per_project_override():
         assert project.extra_files_dir == Path("/y/extra-files")
 
 
+# noinspection PyProtectedMember
+def test_disk_image_manifest(tmp_path):
+    config = _parse_arguments(["--disk-image/reuse-unchanged-image", "--disk-image/path=" + str(tmp_path / "img")])
+    project = BuildCheriBSDDiskImage.get_instance(None, config, cross_target=CompilationTargets.CHERIBSD_RISCV_PURECAP)
+    assert project.reuse_unchanged_image
+    assert project.disk_image_manifest_path == tmp_path / "img.manifest.json"
+    project.tmpdir = tmp_path / "tmp"
+    rc_conf = project.tmpdir / "etc/rc.conf"
+    rc_conf.parent.mkdir(parents=True)
+    rc_conf.write_text("hostname=foo\n")
+    project.mtree.add_file(rc_conf, "etc/rc.conf", print_status=False)
+    first = project._compute_disk_image_manifest({})
+    assert list(first["files"].keys()) == ["$TMPDIR/etc/rc.conf"]
+    # No image exists yet -> must be rebuilt
+    assert not project._existing_image_is_up_to_date(first, first)
+    (tmp_path / "img").write_bytes(b"image")
+    assert project._existing_image_is_up_to_date(first, first)
+    # Rewriting the same contents changes the mtime, but the image can still be reused
+    rc_conf.write_text("hostname=foo\n")
+    os.utime(str(rc_conf), ns=(0, 12345))
+    assert project._existing_image_is_up_to_date(project._compute_disk_image_manifest(first), first)
+    rc_conf.write_text("hostname=bar\n")
+    assert not project._existing_image_is_up_to_date(project._compute_disk_image_manifest(first), first)
+
+
+def test_target_index(tmp_path):
+    config = _parse_arguments([])
+    index = target_manager.create_target_index(config.loader.options.values())
+    assert index.module_for_target("qemu") == "pycheribuild.projects.build_qemu"
+    assert index.module_for_target("cheribsd-riscv64-purecap") == "pycheribuild.projects.cross.cheribsd"
+    assert index.targets["llvm"]["kind"] == TargetIndex.MULTIARCH_ALIAS
+    assert "native" in index.targets["llvm"]["architectures"]
+    assert index.targets["sail-from-opam"]["kind"] == TargetIndex.DEPRECATED_ALIAS
+    assert index.targets["cheribsd-riscv64-hybrid"]["hybrid"]
+    assert not index.targets["cheribsd-riscv64-purecap"]["hybrid"]
+    # "cheribsd" only exists for the fallback config options
+    assert "cheribsd" not in index.targets and index.module_for_target("cheribsd") is not None
+    assert index.target_declaring_option("qemu/use-lto") == "qemu"
+    assert index.target_declaring_option("cheribsd/build-options") == "cheribsd"
+    assert index.target_declaring_option("qemu/does-not-exist") is None
+    assert index.target_declaring_option("does-not-exist/use-lto") is None
+    assert list(index.targets) == list(target_manager.target_names(None))
+    index.save(tmp_path / "index.json")
+    loaded = TargetIndex.load(tmp_path / "index.json")
+    assert loaded is not None and loaded.targets == index.targets
+    # The index must be regenerated if any of the source files changes
+    old_fingerprint = TargetIndex.source_fingerprint()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(TargetIndex, "source_dir", tmp_path)
+        assert TargetIndex.source_fingerprint() != old_fingerprint
+        assert TargetIndex.load(tmp_path / "index.json") is None
+    assert TargetIndex.load(tmp_path / "index.json") is not None
+
+
+def test_option_values_are_cached():
+    config = _parse_arguments(["--cheribsd/source-directory=/foo"])
+    loader = config.loader
+    # Options with a None value must also only be resolved once
+    assert config.cheri_cap_table_abi is None
+    resolutions = loader.option_resolution_count
+    assert config.cheri_cap_table_abi is None
+    assert loader.option_resolution_count == resolutions
+    project = _get_cheribsd_instance("cheribsd-riscv64-purecap", config)
+    assert project.source_dir == Path("/foo")
+    resolutions = loader.option_resolution_count
+    assert project.source_dir == Path("/foo")
+    assert loader.option_resolution_count == resolutions
+    # The cached values must be discarded when reloading the config
+    config = _parse_arguments(["--cheribsd/source-directory=/bar"])
+    assert _get_cheribsd_instance("cheribsd-riscv64-purecap", config).source_dir == Path("/bar")
+    # Whether the value is the default is cached together with the value
+    option = inspect.getattr_static(config, "use_minimal_benchmark_kernel")
+    with pytest.raises(AssertionError, match="Must load value"):
+        option.is_default_value(config)
+    assert config.use_minimal_benchmark_kernel is False
+    assert option.is_default_value(config)
+    config = _parse_arguments(["--use-minimal-benchmark-kernel"])
+    assert config.use_minimal_benchmark_kernel is True
+    assert not option.is_default_value(config)
+
+
+def test_completion_index(tmp_path):
+    config = _parse_arguments([])
+    # noinspection PyUnresolvedReferences
+    index = config.loader.create_completion_index(sorted(target_manager.non_deprecated_target_names(None)))
+    index.save(tmp_path / "completion.json")
+    assert CompletionIndex.is_up_to_date(tmp_path / "completion.json")
+    loaded = CompletionIndex.load(tmp_path / "completion.json")
+    assert loaded is not None and loaded.targets == index.targets
+    for idx in (index, loaded):
+        assert "qemu" in idx.completions([], "qem")
+        assert "sail-from-opam" not in idx.completions([], "sail")
+        assert idx.completions(["-d"], "--qemu/use-l") == ["--qemu/use-lto"]
+        assert idx.completions(["--qemu/use-lto"], "--qemu/use-l") == []
+        assert "--qemu/no-use-lto" in idx.completions([], "--qemu/no-")
+        assert "-d" in idx.completions([], "-")
+        # Option values can only be completed by argparse/argcomplete
+        assert idx.completions(["--source-root"], "") is None
+        assert idx.completions(["--qemu/use-lto"], "cheri") is not None
+    assert loaded.options == index.options
+
+
 @pytest.mark.parametrize("target_name,resolved_target", [
     pytest.param("llvm", "llvm-native"),
     pytest.param("gdb", "gdb-native"),
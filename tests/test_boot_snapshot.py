@@ -0,0 +1,130 @@
+import re
+import shlex
+import sys
+from pathlib import Path
+
+sys.path.insert(1, str(Path(__file__).parent.parent / "test-scripts"))
+
+# noinspection PyUnresolvedReferences
+import run_tests_common  # noqa: E402,F401 (adds pexpect to sys.path)
+from pycheribuild.boot_cheribsd import BootSnapshot  # noqa: E402
+
+
+def _fake_qemu_img(tmp_path: Path) -> Path:
+    qemu_img = tmp_path / "qemu-img"
+    qemu_img.write_text("#!/bin/sh\necho \"$@\" >> " + str(tmp_path / "qemu-img.log") + "\n"
+                        "for last; do :; done\ntouch \"$last\"\n")
+    qemu_img.chmod(0o755)
+    return qemu_img
+
+
+class FakeMonitor:
+    """Emulates the QEMU monitor commands used by BootSnapshot.save()"""
+
+    def __init__(self, vmstate="vmstate"):
+        self.commands = []
+        self.before = ""
+        self.vmstate = vmstate
+
+    def send(self, data):
+        pass
+
+    def sendline(self, line=""):
+        self.commands.append(line)
+        self.before = ""
+        match = re.fullmatch(r'migrate -d "exec:cat > (.+)"', line)
+        if match:
+            Path(shlex.split(match.group(1))[0]).write_text(self.vmstate)
+        elif line == "info migrate":
+            self.before = "Migration status: completed"
+
+    def expect_exact(self, *args, **kwargs):
+        return 0
+
+    def expect_prompt(self, *args, **kwargs):
+        pass
+
+    def run(self, cmd, **kwargs):
+        self.commands.append(cmd)
+
+
+def test_boot_snapshot_fingerprint(tmp_path: Path):
+    kernel = tmp_path / "kernel"
+    kernel.write_text("kernel")
+    fingerprint = BootSnapshot.fingerprint(["qemu", "-m", "2048"], kernel, None, extra=["a"])
+    assert BootSnapshot.fingerprint(["qemu", "-m", "2048"], kernel, None, extra=["a"]) == fingerprint
+    assert BootSnapshot.fingerprint(["qemu", "-m", "4096"], kernel, None, extra=["a"]) != fingerprint
+    assert BootSnapshot.fingerprint(["qemu", "-m", "2048"], kernel, None, extra=["b"]) != fingerprint
+    kernel.write_text("modified kernel")
+    assert BootSnapshot.fingerprint(["qemu", "-m", "2048"], kernel, None, extra=["a"]) != fingerprint
+
+
+def test_boot_snapshot_save_and_restore(tmp_path: Path):
+    qemu_img = _fake_qemu_img(tmp_path)
+    disk_image = tmp_path / "disk.img"
+    disk_image.write_bytes(b"\0" * 512)
+    cache = tmp_path / "cache"
+    cache.mkdir()
+
+    # The first run boots normally with an overlay on top of the disk image and saves the VM state afterwards.
+    snapshot = BootSnapshot(cache, qemu_img, "1" * 64, disk_image)
+    assert not snapshot.restoring
+    snapshot.prepare()
+    assert snapshot.run_image is not None and snapshot.run_image.parent == cache
+    assert snapshot.qemu_args() == []
+    assert "-b " + str(disk_image) + " " + str(snapshot.run_image) in (tmp_path / "qemu-img.log").read_text()
+    monitor = FakeMonitor()
+    # noinspection PyTypeChecker
+    snapshot.save(monitor)
+    assert monitor.commands[-2] == "cont"
+    assert snapshot.vmstate.read_text() == "vmstate"
+    assert snapshot.disk_layer is not None and snapshot.disk_layer.exists()
+    assert not list(cache.glob("*.tmp"))
+    assert sorted(p.name for p in cache.glob("boot-*")) == ["boot-" + "1" * 32]
+
+    # Later runs restore the VM state with -incoming and only create a new overlay on top of the cached disk layer.
+    restored = BootSnapshot(cache, qemu_img, "1" * 64, disk_image)
+    assert restored.restoring
+    restored.prepare()
+    assert restored.run_image != snapshot.run_image
+    assert "-b " + str(restored.disk_layer) + " " + str(restored.run_image) in (tmp_path / "qemu-img.log").read_text()
+    assert restored.qemu_args() == ["-incoming", "exec:cat " + shlex.quote(str(restored.vmstate))]
+    monitor = FakeMonitor()
+    # noinspection PyTypeChecker
+    restored.restore(monitor)
+    assert monitor.commands[0] == "" and monitor.commands[1].startswith("date -u -f %s ")
+
+    # A different fingerprint does not find the snapshot and MFS root kernels don't need a disk layer.
+    other = BootSnapshot(cache, qemu_img, "2" * 64, None)
+    assert not other.restoring and other.disk_layer is None
+    other.prepare()
+    assert other.run_image is None
+    # noinspection PyTypeChecker
+    other.save(FakeMonitor())
+    assert other.vmstate.exists()
+    assert BootSnapshot(cache, qemu_img, "2" * 64, None).restoring
+
+
+def test_boot_snapshot_concurrent_save(tmp_path: Path):
+    qemu_img = _fake_qemu_img(tmp_path)
+    disk_image = tmp_path / "disk.img"
+    disk_image.write_bytes(b"\0" * 512)
+    cache = tmp_path / "cache"
+    cache.mkdir()
+    # Two shards boot at the same time on a cold cache and both try to save the snapshot.
+    first = BootSnapshot(cache, qemu_img, "3" * 64, disk_image)
+    second = BootSnapshot(cache, qemu_img, "3" * 64, disk_image)
+    first.prepare()
+    second.prepare()
+    assert not first.restoring and not second.restoring
+    first.run_image.write_text("first disk")
+    second.run_image.write_text("second disk")
+    # noinspection PyTypeChecker
+    first.save(FakeMonitor("first vmstate"))
+    # noinspection PyTypeChecker
+    second.save(FakeMonitor("second vmstate"))
+    # The published VM state and disk layer must always come from the same saver.
+    assert first.vmstate.read_text() == "first vmstate"
+    assert first.disk_layer.read_text() == "first disk"
+    assert not list(cache.glob("*.tmp"))
+    assert BootSnapshot(cache, qemu_img, "3" * 64, disk_image).restoring
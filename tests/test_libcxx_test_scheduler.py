@@ -0,0 +1,90 @@
+import argparse
+import sys
+from pathlib import Path
+from queue import Empty, Queue
+
+import pytest
+
+sys.path.insert(1, str(Path(__file__).parent.parent / "test-scripts"))
+
+# noinspection PyUnresolvedReferences
+import run_remote_lit_test  # noqa: E402
+# noinspection PyUnresolvedReferences
+from run_libcxx_tests import DynamicTestScheduler  # noqa: E402
+
+
+def _get(queue: Queue):
+    try:
+        return queue.get_nowait()
+    except Empty:
+        return "<empty>"
+
+
+def test_dispatch_in_batches():
+    queues = [Queue(), Queue()]
+    scheduler = DynamicTestScheduler(["t1", "t2", "t3", "t4", "t5"], 2, queues)
+    assert len(scheduler.pending) == 3
+    scheduler.request_tests(1)
+    scheduler.request_tests(2)
+    assert _get(queues[0]) == (0, ["t1", "t2"])
+    assert _get(queues[1]) == (1, ["t3", "t4"])
+    assert scheduler.unfinished_tests() == ["t5", "t1", "t2", "t3", "t4"]
+    scheduler.request_tests(2)
+    assert _get(queues[1]) == (2, ["t5"])
+    # Idle shards have to wait until all other batches have completed since those might still be redistributed
+    scheduler.request_tests(2)
+    assert _get(queues[1]) == "<empty>"
+    assert scheduler.unfinished_tests() == ["t1", "t2"]
+    scheduler.request_tests(1)
+    assert _get(queues[0]) is None
+    assert _get(queues[1]) is None
+    assert scheduler.unfinished_tests() == []
+
+
+def test_redistribute_after_shard_failure():
+    queues = [Queue(), Queue()]
+    scheduler = DynamicTestScheduler(["t1", "t2", "t3"], 2, queues)
+    scheduler.request_tests(1)
+    scheduler.request_tests(2)
+    assert _get(queues[0]) == (0, ["t1", "t2"])
+    assert _get(queues[1]) == (1, ["t3"])
+    scheduler.shard_failed(1)
+    assert scheduler.unfinished_tests() == ["t1", "t2", "t3"]
+    scheduler.request_tests(2)
+    assert _get(queues[1]) == (0, ["t1", "t2"])
+    # A batch that fails a second time is given up on
+    scheduler.shard_failed(2)
+    assert scheduler.lost_batches == [(0, ["t1", "t2"])]
+    assert scheduler.unfinished_tests() == ["t1", "t2"]
+    assert not scheduler.pending and not scheduler.in_flight
+
+
+def test_dead_shard_does_not_consume_remaining_batches(tmp_path: Path):
+    queues = [Queue(), Queue()]
+    scheduler = DynamicTestScheduler(["t1", "t2", "t3", "t4"], 1, queues)
+
+    class FakeMainProcessQueue:
+        def put(self, message):
+            assert message[0] == run_remote_lit_test.REQUEST_TESTS
+            scheduler.request_tests(message[1])
+
+    class FakeQemu:
+        checks = 0
+
+        def isalive(self):
+            # QEMU exits while the first batch is running
+            self.checks += 1
+            return self.checks == 1
+
+    with pytest.raises(RuntimeError, match="QEMU exited"):
+        # noinspection PyTypeChecker
+        run_remote_lit_test.run_lit_test_batches(["true"], argparse.Namespace(internal_shard=1), queues[0],
+                                                 FakeMainProcessQueue(), None, tmp_path, FakeQemu())
+    # The shard only received the first batch and didn't request any further work after QEMU exited
+    assert _get(queues[0]) == "<empty>"
+    assert scheduler.in_flight == {1: (0, ["t1"])}
+    # The main process notices the failure and hands out the in-flight batch to another shard
+    scheduler.shard_failed(1)
+    assert scheduler.unfinished_tests() == ["t1", "t2", "t3", "t4"]
+    scheduler.request_tests(2)
+    assert _get(queues[1]) == (0, ["t1"])
@@ -1,5 +1,6 @@
 import io
 import os
+import pickle
 import sys
 import tempfile
 
@@ -12,7 +13,8 @@ except ImportError:
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).parent.parent))
-from pycheribuild.mtree import MtreeFile  # noqa: E402
+from pycheribuild.filesystemutils import FileSystemUtils  # noqa: E402
+from pycheribuild.mtree import MtreeEntry, MtreeFile  # noqa: E402
 
 HAVE_LCHMOD = True
 if "_TEST_SKIP_METALOG" in os.environ:
@@ -195,6 +197,112 @@ def test_normalize_paths_loaded_from_file():
     assert len(mtree._mtree) == 6
 
 
+def test_load_with_cache(tmp_path: Path):
+    metalog = tmp_path / "METALOG.world"
+    metalog.write_text("#mtree 2.0\n. type=dir uname=root gname=wheel mode=0755\n"
+                       "./bin type=dir uname=root gname=wheel mode=0755\n"
+                       "./bin/sh type=file uname=root gname=wheel mode=0555 size=1234 time=1.0\n# END\n")
+    cache_dir = tmp_path / "cache"
+    expected = _get_as_str(MtreeFile(file=metalog, verbose=False))
+    mtree = MtreeFile(verbose=False)
+    mtree.load(metalog, append=False, cache_dir=cache_dir)
+    assert (cache_dir / "METALOG.world.parsed-cache").exists()
+    assert expected == _get_as_str(mtree)
+    # Replace the file with one that cannot be parsed but keep size and mtime -> the cache should be used
+    st = metalog.stat()
+    metalog.write_text(metalog.read_text().replace("./bin", "*bin*"))
+    os.utime(str(metalog), ns=(st.st_atime_ns, st.st_mtime_ns))
+    mtree.load(metalog, append=False, cache_dir=cache_dir)
+    assert expected == _get_as_str(mtree)
+    # If only the mtime changed the contents are hashed and the cache header is updated with the new mtime
+    metalog.write_text(metalog.read_text().replace("*bin*", "./bin"))
+    os.utime(str(metalog), ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+    mtree.load(metalog, append=False, cache_dir=cache_dir)
+    assert expected == _get_as_str(mtree)
+    with (cache_dir / "METALOG.world.parsed-cache").open("rb") as f:
+        assert pickle.load(f)["mtime_ns"] == st.st_mtime_ns + 1000
+    # Changing the contents (and mtime) must invalidate the cache
+    metalog.write_text(metalog.read_text().replace("./bin", "./sbin"))
+    mtree.load(metalog, append=False, cache_dir=cache_dir)
+    assert "./sbin/sh type=file" in _get_as_str(mtree)
+    assert "./bin/sh" not in _get_as_str(mtree)
+
+
+def test_list_files_recursively(tmp_path: Path):
+    for d in ("bin", "usr/local/bin", "usr/lib/empty", "etc"):
+        (tmp_path / d).mkdir(parents=True)
+    for f in ("METALOG", "bin/sh", "usr/local/bin/bash", "etc/rc.conf"):
+        _create_file(tmp_path, f, 0o644)
+    (tmp_path / "usr/lib/libc.so").symlink_to("libc.so.7")  # dangling symlink
+    (tmp_path / "sys").symlink_to("usr/local")  # symlinks to directories are skipped (like os.walk())
+    (tmp_path / "usr/local/libdir").symlink_to("../lib")
+    expected = []
+    for root, dirnames, filenames in os.walk(str(tmp_path)):
+        for name in filenames:
+            expected.append((os.path.join(root, name), os.path.relpath(os.path.join(root, name), str(tmp_path))))
+    result = FileSystemUtils.list_files_recursively(tmp_path, max_workers=2)
+    assert sorted(result) == sorted(expected)
+    assert len(result) == 5
+    mtree = MtreeFile(verbose=False)
+    mtree.add_file(tmp_path / "bin/sh", "bin/sh", print_status=False)
+    assert mtree.contains_normalized_path("bin/sh")
+    assert mtree.contains_normalized_path("bin")
+    assert not mtree.contains_normalized_path("etc/rc.conf")
+
+
+def test_parse_escapes_and_directives():
+    file = io.StringIO(r"""#mtree 2.0
+/set type=file uname=root gname=wheel mode=0444
+. type=dir mode=0755
+./with\sspace size=1
+./with\040octal\303\244 size=2 link='quoted value'
+./back\\slash mode=0755 time=1.0 tags=package=runtime
+/unset mode
+./no-mode type=link link=foo
+/unset all
+./bad-line type
+./usr type=dir uname=root gname=wheel mode=0755
+# END
+""")
+    entries = list(MtreeEntry.iter_entries(file))
+    assert [e.path for e in entries] == [".", "./with space", "./with octal\u00e4", "./back\\slash", "./no-mode",
+                                         "./usr"]
+    assert entries[0].attributes == {"type": "dir", "uname": "root", "gname": "wheel", "mode": "0755"}
+    assert entries[1].attributes == {"type": "file", "uname": "root", "gname": "wheel", "mode": "0444", "size": "1"}
+    assert entries[2].attributes["link"] == "quoted value"
+    assert entries[3].attributes["mode"] == "0755" and "time" not in entries[3].attributes
+    assert entries[4].attributes == {"type": "link", "uname": "root", "gname": "wheel", "link": "foo"}
+    assert entries[5].attributes == {"type": "dir", "uname": "root", "gname": "wheel", "mode": "0755"}
+    # Check that writing the entries and parsing them again results in the same paths and attributes
+    for e in entries:
+        parsed = MtreeEntry.parse(str(e))
+        assert (parsed.path, parsed.attributes) == (e.path, e.attributes)
+
+
+def test_parse_quoted_values(tmp_path: Path):
+    entry = MtreeEntry.parse(r"""./quotes type=file link="a \"b\" \\ \c $d" uname='it'"'"'s'""")
+    assert entry.attributes["link"] == r'a "b" \ \c $d'
+    assert entry.attributes["uname"] == "it's"
+    for value in ("it's", 'double "quotes"', "back\\slash", "$dollar `backtick`", "tab\tand space "):
+        e = MtreeEntry("./file", {"type": "file", "link": value})
+        parsed = MtreeEntry.parse(str(e))
+        assert (parsed.path, parsed.attributes) == (e.path, e.attributes)
+    with pytest.raises(ValueError, match="No closing quotation"):
+        MtreeEntry.parse('./file link="unterminated\\"')
+    # parse_all_dirs_in_mtree() only tokenizes lines that could be a directory
+    mtree_file = tmp_path / "METALOG"
+    mtree_file.write_text("""#mtree 2.0
+./file type=file mode=0644 link="not a dir"
+./dir type=dir mode=0755
+./not-a-dir type=link link="./dir type=dir"
+/set type=dir
+./implicit-dir mode=0755
+/unset type
+./unknown mode=0755
+""")
+    assert [e.path for e in MtreeEntry.parse_all_dirs_in_mtree(mtree_file)] == ["./dir", "./implicit-dir"]
+
+
 def test_contents_root():
     # When parsing the cheribsdbox mtree we want to convert relative paths to absolute ones
     file = """#mtree 2.0
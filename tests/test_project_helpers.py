@@ -1,12 +1,20 @@
+import json
+import os
 import re
+import shutil
+import subprocess
+import threading
 from pathlib import Path
 
 import pytest
 
+from pycheribuild import processutils
 from pycheribuild.config.target_info import BasicCompilationTargets, DefaultInstallDir
 from pycheribuild.projects.cmake_project import CMakeProject
-from pycheribuild.projects.repository import ExternallyManagedSourceRepository
+from pycheribuild.projects.project import Project
+from pycheribuild.projects.repository import ExternallyManagedSourceRepository, GitRepository
 from pycheribuild.targets import target_manager
+from pycheribuild.timing import BuildTimings
 from .setup_mock_chericonfig import CheriConfig, setup_mock_chericonfig
 
 
@@ -45,3 +53,334 @@ def test_add_cmake_option():
         add_options_test([], BYTE_OPTION=b"abc")
     with pytest.raises(TypeError, match=re.escape("Unsupported type <class 'tuple'>: ('abc',)")):
         add_options_test([], TUPLE_OPTION=("abc",))
+
+
+def test_compiler_probe_cache(tmp_path: Path):
+    counter = tmp_path / "invocations"
+    fake_clang = tmp_path / "bin" / "clang"
+    fake_clang.parent.mkdir()
+    fake_clang.write_text("#!/bin/sh\necho invoked >> " + str(counter) + "\n"
+                          "echo 'clang version 13.0.0' >&2\necho 'Target: x86_64-unknown-linux-gnu' >&2\n"
+                          "case \"$*\" in *-Wunknown-flag*) exit 1 ;; esac\n")
+    fake_clang.chmod(0o755)
+    (tmp_path / "build").mkdir()
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    config.verbose = False
+
+    def num_invocations():
+        return len(counter.read_text().splitlines()) if counter.exists() else 0
+
+    # noinspection PyProtectedMember
+    def probe():
+        processutils._cached_compiler_infos.clear()
+        info = processutils.get_compiler_info(fake_clang, config=config)
+        assert info.compiler == "clang" and info.version == (13, 0, 0)
+        assert info.supports_warning_flag("-Wall")
+        assert not info.supports_warning_flag("-Wunknown-flag")
+
+    probe()
+    assert num_invocations() == 3
+    # The cache file is only written at exit
+    assert not (tmp_path / "build/compiler-probe-cache.json").exists()
+    processutils._compiler_probe_cache.save()
+    assert (tmp_path / "build/compiler-probe-cache.json").exists()
+    # A new process (simulated by using a new cache instance) should not need to run the compiler again
+    processutils._compiler_probe_cache = processutils._CompilerProbeCache()
+    probe()
+    assert num_invocations() == 3
+    # Symlinks to the same binary (e.g. clang++ -> clang) must not share results since the driver mode can differ
+    (tmp_path / "bin/clang++").symlink_to("clang")
+    processutils._compiler_probe_cache.run(tmp_path / "bin/clang++", "-v", config=config)
+    assert num_invocations() == 4
+    # Results from concurrent instances are merged when saving
+    other_instance = processutils._CompilerProbeCache()
+    other_instance.run(fake_clang, "-Wextra", config=config)
+    assert num_invocations() == 5
+    processutils._compiler_probe_cache.save()
+    other_instance.save()
+    processutils._compiler_probe_cache = processutils._CompilerProbeCache()
+    processutils._compiler_probe_cache.run(tmp_path / "bin/clang++", "-v", config=config)
+    processutils._compiler_probe_cache.run(fake_clang, "-Wextra", config=config)
+    assert num_invocations() == 5
+    # But changing the compiler binary should invalidate the cached results
+    with fake_clang.open("a") as f:
+        f.write("# modified\n")
+    probe()
+    assert num_invocations() == 8
+
+
+def test_git_source_fingerprint(tmp_path: Path):
+    class TestFingerprintProject(CMakeProject):
+        target = "fake-fingerprint-project"
+        repository = GitRepository("https://example.org/fake.git")
+        default_install_dir = DefaultInstallDir.DO_NOT_INSTALL
+
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    TestFingerprintProject.setup_config_options()
+    project = TestFingerprintProject(config, crosscompile_target=BasicCompilationTargets.NATIVE_NON_PURECAP)
+    src = tmp_path / "src"
+    src.mkdir()
+    assert project.repository.source_fingerprint(project, src_dir=src) is None
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.org"]
+    subprocess.check_call(git + ["init", "-q"], cwd=src)
+    (src / "file.c").write_text("int x;\n")
+    subprocess.check_call(git + ["add", "file.c"], cwd=src)
+    subprocess.check_call(git + ["commit", "-q", "-m", "initial"], cwd=src)
+    clean = project.repository.source_fingerprint(project, src_dir=src)
+    assert clean is not None
+    assert project.repository.source_fingerprint(project, src_dir=src) == clean
+    # Uncommitted changes and untracked files must change the fingerprint
+    (src / "file.c").write_text("int y;\n")
+    modified = project.repository.source_fingerprint(project, src_dir=src)
+    assert modified != clean
+    (src / "new.c").write_text("int z;\n")
+    assert project.repository.source_fingerprint(project, src_dir=src) not in (clean, modified)
+    (src / "new.c").unlink()
+    (src / "file.c").write_text("int x;\n")
+    assert project.repository.source_fingerprint(project, src_dir=src) == clean
+
+
+def test_skip_unchanged_builds_opt_in():
+    class TestCMakeFingerprintProject(CMakeProject):
+        target = "fake-cmake-fingerprint-project"
+        repository = ExternallyManagedSourceRepository()
+        default_install_dir = DefaultInstallDir.DO_NOT_INSTALL
+
+    class TestConfigureOverrideProject(TestCMakeFingerprintProject):
+        target = "fake-configure-override-project"
+
+        def configure(self, **kwargs):
+            self.add_cmake_options(DEPENDS_ON_SOURCES=True)
+            super().configure(**kwargs)
+
+    class TestConfigureOptInProject(TestConfigureOverrideProject):
+        target = "fake-configure-opt-in-project"
+        can_skip_unchanged_builds = True
+
+    assert not Project._can_check_build_fingerprint()
+    assert TestCMakeFingerprintProject._can_check_build_fingerprint()
+    # Arguments added by an overridden configure() are not known before the up-to-date check
+    assert not TestConfigureOverrideProject._can_check_build_fingerprint()
+    assert TestConfigureOptInProject._can_check_build_fingerprint()
+
+
+def test_git_fetch_concurrently(tmp_path: Path):
+    class TestFetchProject(CMakeProject):
+        target = "fake-fetch-project"
+        repository = GitRepository("https://example.org/fake.git")
+        default_install_dir = DefaultInstallDir.DO_NOT_INSTALL
+
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    config.verbose = False
+    config.skip_update = False
+    TestFetchProject.setup_config_options()
+    project = TestFetchProject(config, crosscompile_target=BasicCompilationTargets.NATIVE_NON_PURECAP)
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.org"]
+
+    def commit(repo: Path, message: str):
+        (repo / "file.txt").write_text(message + "\n")
+        subprocess.check_call(git + ["add", "file.txt"], cwd=repo)
+        subprocess.check_call(git + ["commit", "-q", "-m", message], cwd=repo)
+        subprocess.check_call(git + ["push", "-q", "origin", "HEAD"], cwd=repo)
+
+    def head(repo: Path) -> bytes:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo).strip()
+
+    # Two clones of local bare repositories, only the first one gets a new upstream commit
+    clones = []
+    for name in ("moved", "unchanged"):
+        subprocess.check_call(git + ["init", "-q", "--bare", str(tmp_path / (name + ".git"))])
+        subprocess.check_call(git + ["clone", "-q", str(tmp_path / (name + ".git")), str(tmp_path / name)])
+        commit(tmp_path / name, "initial")
+        clones.append(tmp_path / name)
+    subprocess.check_call(git + ["clone", "-q", str(tmp_path / "moved.git"), str(tmp_path / "other")])
+    commit(tmp_path / "other", "second")
+    old_head = head(clones[0])
+
+    fetched = GitRepository.fetch_concurrently([(project, d) for d in clones], max_workers=2)
+    assert fetched == {clones[0]: True, clones[1]: False}
+    assert head(clones[0]) == old_head, "fetching must not touch the working tree"
+    # The update step uses the already fetched upstream branch and fast-forwards the clone
+    target_manager.add_prefetched_repositories(fetched)
+    for clone in clones:
+        project.repository.update(project, src_dir=clone, skip_submodules=True)
+    assert head(clones[0]) == head(tmp_path / "other")
+    assert target_manager.take_prefetched_repository(clones[0]) is None
+    assert target_manager.take_prefetched_repository(clones[1]) is None
+
+
+def test_git_reference_mirror(tmp_path: Path):
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.org"]
+    # An upstream repository and a fork of it with one additional commit
+    work = tmp_path / "work"
+    subprocess.check_call(git + ["init", "-q", str(work)])
+    for i in range(3):
+        (work / "file.txt").write_text(str(i) + "\n")
+        subprocess.check_call(git + ["add", "file.txt"], cwd=work)
+        subprocess.check_call(git + ["commit", "-q", "-m", str(i)], cwd=work)
+    subprocess.check_call(git + ["clone", "-q", "--bare", str(work), str(tmp_path / "upstream.git")])
+    subprocess.check_call(git + ["commit", "-q", "--allow-empty", "-m", "fork"], cwd=work)
+    subprocess.check_call(git + ["clone", "-q", "--bare", str(work), str(tmp_path / "fork.git")])
+
+    class TestUpstreamProject(CMakeProject):
+        target = "fake-mirror-upstream"
+        repository = GitRepository("file://" + str(tmp_path / "upstream.git"))
+        default_install_dir = DefaultInstallDir.DO_NOT_INSTALL
+
+    class TestForkProject(TestUpstreamProject):
+        target = "fake-mirror-fork"
+        repository = GitRepository("file://" + str(tmp_path / "fork.git"))
+
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    config.verbose = False
+    config.skip_clone = False
+    config.git_reference_mirror = tmp_path / "mirror.git"
+    for cls in (TestUpstreamProject, TestForkProject):
+        cls.setup_config_options()
+        project = cls(config, crosscompile_target=BasicCompilationTargets.NATIVE_NON_PURECAP)
+        src = tmp_path / cls.target
+        project.repository.ensure_cloned(project, src_dir=src, base_project_source_dir=src, skip_submodules=True)
+        assert (src / ".git/objects/info/alternates").read_text().strip() == str(tmp_path / "mirror.git/objects")
+        # All objects come from the mirror, nothing is stored in the checkout itself.
+        count = subprocess.check_output(["git", "count-objects", "-v"], cwd=src).decode("utf-8").splitlines()
+        assert "count: 0" in count and "in-pack: 0" in count
+        assert subprocess.check_output(["git", "log", "--format=%s", "-1"], cwd=src).strip() == (
+            b"fork" if cls is TestForkProject else b"2")
+
+
+def test_git_partial_and_shallow_clone(tmp_path: Path):
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.org"]
+    work = tmp_path / "work"
+    subprocess.check_call(git + ["init", "-q", str(work)])
+    commits = []
+    for i in range(100):
+        (work / "file.txt").write_text(str(i) + "\n")
+        subprocess.check_call(git + ["add", "file.txt"], cwd=work)
+        subprocess.check_call(git + ["commit", "-q", "-m", str(i)], cwd=work)
+        commits.append(subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=work).strip().decode("utf-8"))
+    subprocess.check_call(git + ["clone", "-q", "--bare", str(work), str(tmp_path / "upstream.git")])
+    subprocess.check_call(["git", "config", "uploadpack.allowFilter", "true"], cwd=tmp_path / "upstream.git")
+
+    class TestCloneProject(CMakeProject):
+        target = "fake-partial-clone"
+        repository = GitRepository("file://" + str(tmp_path / "upstream.git"))
+        default_install_dir = DefaultInstallDir.DO_NOT_INSTALL
+
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    config.verbose = False
+    config.skip_clone = False
+    config.shallow_clone = True
+    TestCloneProject.setup_config_options()
+    project = TestCloneProject(config, crosscompile_target=BasicCompilationTargets.NATIVE_NON_PURECAP)
+
+    def num_commits(src: Path) -> int:
+        return int(subprocess.check_output(["git", "rev-list", "--count", "HEAD"], cwd=src))
+
+    # --partial-clone takes precedence over --shallow-clone and keeps the full history
+    config.partial_clone = True
+    partial = tmp_path / "partial"
+    project.repository.ensure_cloned(project, src_dir=partial, base_project_source_dir=partial, skip_submodules=True)
+    assert subprocess.check_output(["git", "config", "remote.origin.partialclonefilter"], cwd=partial) == b"blob:none\n"
+    assert num_commits(partial) == 100
+    assert project.repository.contains_commit(project, commits[0], src_dir=partial) is True
+
+    # Shallow clones fetch a bounded amount of additional history if they can't answer contains_commit()
+    config.partial_clone = False
+    shallow = tmp_path / "shallow"
+    project.repository.ensure_cloned(project, src_dir=shallow, base_project_source_dir=shallow, skip_submodules=True)
+    assert num_commits(shallow) == 1
+    assert project.repository.contains_commit(project, "@{upstream}", src_dir=shallow) is True
+    assert num_commits(shallow) == 1, "should not deepen if the answer is known"
+    # With --skip-update nothing is fetched and the result is unknown
+    project.skip_update = True
+    assert project.repository.contains_commit(project, commits[50], src_dir=shallow,
+                                              invalid_commit_ref_result="invalid") == "invalid"
+    assert num_commits(shallow) == 1
+    project.skip_update = False
+    assert project.repository.contains_commit(project, commits[50], src_dir=shallow) is True
+    assert 50 <= num_commits(shallow) < 100
+    assert project.repository.contains_commit(project, "0" * 40, src_dir=shallow) is False
+    assert num_commits(shallow) == 100
+
+
+def test_strip_elf_files_in_place(tmp_path: Path, monkeypatch):
+    class TestStripProject(CMakeProject):
+        target = "fake-strip-project"
+        repository = ExternallyManagedSourceRepository()
+        default_install_dir = DefaultInstallDir.DO_NOT_INSTALL
+
+    log = tmp_path / "strip-invocations"
+    fake_strip = tmp_path / "llvm-strip"
+    fake_strip.write_text("#!/bin/sh\necho \"$#\" >> " + str(log) + "\n"
+                          "for f in \"$@\"; do printf '\\177ELFstripped' > \"$f\"; done\n")
+    fake_strip.chmod(0o755)
+    (tmp_path / "build").mkdir()
+    config = setup_mock_chericonfig(tmp_path, pretend=False)
+    config.make_jobs = 2
+    TestStripProject.setup_config_options()
+    project = TestStripProject(config, crosscompile_target=BasicCompilationTargets.NATIVE_NON_PURECAP)
+    monkeypatch.setattr(type(project.target_info), "strip_tool", property(lambda _: fake_strip))
+    files = tmp_path / "files"
+    files.mkdir()
+    for i in range(5):
+        (files / ("prog" + str(i))).write_bytes(b"\x7fELF unstripped " + bytes([i]))
+    (files / "crt1.o").write_bytes(b"\x7fELF object file")
+    (files / "script.sh").write_text("#!/bin/sh\n")
+    (files / "link").symlink_to("prog0")
+    os.link(str(files / "prog1"), str(files / "prog1-hardlink"))  # must only be stripped once
+    hashed_files = []
+    sha256sum = project.sha256sum
+    monkeypatch.setattr(project, "sha256sum", lambda f: hashed_files.append(f.name) or sha256sum(f))
+    stripped = project.strip_elf_files_in_place(sorted(files.iterdir()), batch_size=2)
+    assert sorted(f.name for f in stripped) == ["prog0", "prog1", "prog2", "prog3", "prog4"]
+    assert sorted(log.read_text().split()) == ["1", "2", "2"]
+    assert (files / "crt1.o").read_bytes() == b"\x7fELF object file"
+    # Every file is hashed once before and once after stripping
+    assert sorted(hashed_files) == sorted([f.name for f in stripped] * 2)
+    # Already stripped files should not be passed to llvm-strip again and unchanged files are not read again
+    hashed_files.clear()
+    (files / "prog5").write_bytes(b"\x7fELF new file")
+    assert project.strip_elf_files_in_place(sorted(files.iterdir())) == [files / "prog5"]
+    assert sorted(log.read_text().split()) == ["1", "1", "2", "2"]
+    assert hashed_files == ["prog5", "prog5"]
+    # Copies of stripped files are recognized by their contents
+    hashed_files.clear()
+    shutil.copy2(str(files / "prog0"), str(files / "prog0-copy"))
+    assert project.strip_elf_files_in_place(sorted(files.iterdir())) == []
+    assert hashed_files == ["prog0-copy"]
+    hashed_files.clear()
+    assert project.strip_elf_files_in_place(sorted(files.iterdir())) == []
+    assert hashed_files == []
+    assert sorted(log.read_text().split()) == ["1", "1", "2", "2"]
+
+
+def test_build_timings(tmp_path: Path):
+    timings = BuildTimings()
+    with timings.phase("disabled", "target"):
+        pass
+    assert timings.events == [], "nothing should be recorded without --timing-trace"
+    timings.enabled = True
+    with timings.phase("outer", "target"):
+        with timings.phase("inner", "step", extra=1) as args:
+            args["more"] = "x"
+        with pytest.raises(subprocess.CalledProcessError):
+            with timings.phase("failing", "command"):
+                subprocess.run(["sh", "-c", "exit 3"], check=True)
+    inner, failing, outer = timings.events
+    assert inner["name"] == "inner" and inner["cat"] == "step" and inner["ph"] == "X"
+    assert inner["args"]["extra"] == 1 and inner["args"]["more"] == "x" and inner["args"]["status"] == "success"
+    assert failing["args"]["status"] == "exit code 3"
+    assert outer["ts"] <= inner["ts"] and outer["dur"] >= inner["dur"]
+    timings.write(tmp_path / "trace.json")
+    assert json.loads((tmp_path / "trace.json").read_text())["traceEvents"][2]["name"] == "outer"
+    assert "children_user_time" in outer["args"]
+
+    # RUSAGE_CHILDREN is per-process, so phases on other threads must not report it
+    def run_in_thread():
+        with timings.phase("thread", "command"):
+            pass
+
+    thread = threading.Thread(target=run_in_thread)
+    thread.start()
+    thread.join()
+    assert timings.events[-1]["name"] == "thread" and "children_user_time" not in timings.events[-1]["args"]
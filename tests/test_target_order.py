@@ -30,7 +30,7 @@ from pycheribuild.projects.run_qemu import BuildAll, BuildAndRunCheriBSD, Launch
 from pycheribuild.projects.sdk import BuildCheriBSDSdk, BuildSdk
 from pycheribuild.projects.simple_project import SimpleProject
 from pycheribuild.projects.spike import RunCheriSpikeBase
-from pycheribuild.targets import Target, target_manager
+from pycheribuild.targets import DependencyGraph, Target, TargetManager, target_manager
 from .setup_mock_chericonfig import CheriConfig, setup_mock_chericonfig
 
 
@@ -313,6 +313,48 @@ def test_riscv():
         "disk-image-riscv64", "run-riscv64"]
 
 
+def test_reverse_order_is_sorted_topologically():
+    expected = ["qemu", "llvm-native", "cheribsd-riscv64", "gmp-riscv64", "gdb-riscv64", "disk-image-riscv64",
+                "run-riscv64"]
+    assert _sort_targets(list(reversed(expected))) == ["llvm-native", "cheribsd-riscv64", "gmp-riscv64",
+                                                       "gdb-riscv64", "qemu", "disk-image-riscv64", "run-riscv64"]
+
+
+def test_dependency_graph_is_memoized():
+    config = setup_mock_chericonfig(Path("/this/path/does/not/exist"))
+    target_manager.reset()
+    graph = DependencyGraph.for_config(config)
+    assert DependencyGraph.for_config(config) is graph
+    gdb_cls = target_manager.get_target_raw("gdb-riscv64").project_class
+    gmp_cls = target_manager.get_target_raw("gmp-riscv64").project_class
+    closure = graph.closure(gdb_cls, config, include_toolchain_dependencies=True, include_sdk_dependencies=True)
+    assert [t.name for t in closure] == ["gmp-riscv64", "llvm-native", "cheribsd-riscv64"]
+    assert graph.closure(gdb_cls, config, include_toolchain_dependencies=True, include_sdk_dependencies=True) is closure
+    # The closure of the dependencies has been computed as part of the gdb closure:
+    assert [t.name for t in graph._closures[(gmp_cls.target, True, True)]] == ["llvm-native", "cheribsd-riscv64"]
+
+
+def test_parallel_dependency_graph():
+    config = setup_mock_chericonfig(Path("/this/path/does/not/exist"))
+    config.include_dependencies = True
+    target_manager.reset()
+    run_target = target_manager.get_target("run-riscv64", None, config, caller="test")
+    chosen = target_manager.get_all_targets([run_target], config)
+    graph = target_manager.dependency_graph(chosen, config)
+    graph = {t.name: sorted(d.name for d in deps) for t, deps in graph.items()}
+    assert graph == {
+        "qemu": [],
+        "llvm-native": [],
+        "cheribsd-riscv64": ["llvm-native"],
+        "gmp-riscv64": ["cheribsd-riscv64", "llvm-native"],
+        "gdb-riscv64": ["cheribsd-riscv64", "gmp-riscv64", "llvm-native"],
+        # disk-image and run targets must wait for all previous targets
+        "disk-image-riscv64": ["cheribsd-riscv64", "gdb-riscv64", "gmp-riscv64", "llvm-native", "qemu"],
+        "run-riscv64": ["cheribsd-riscv64", "disk-image-riscv64", "gdb-riscv64", "gmp-riscv64", "llvm-native",
+                        "qemu"],
+    }
+
+
 # Check that libcxx deps with skip sdk pick the matching -native/-mips versions
 # Also the libcxx target should resolve to libcxx-riscv64-purecap:
 @pytest.mark.parametrize("suffix,expected_suffix", [
@@ -462,3 +504,15 @@ def test_toolchain_dependencies(xtarget: CrossCompileTarget, expected: "list[str
         assert len(expected) == 1
         compiler_target = target_manager.get_target_raw(expected[0])
         assert compiler_target.get_real_target(CompilationTargets.NATIVE, config) == compiler_target
+
+
+def test_parallel_jobs_split():
+    # Targets that become ready later still get a fair share of the jobs.
+    assert TargetManager.split_jobs(16, 16, 1, num_running=0, num_pending=4, parallel_targets=4) == [4]
+    assert TargetManager.split_jobs(16, 12, 2, num_running=1, num_pending=3, parallel_targets=4) == [4, 4]
+    # Once no other targets are pending, all remaining jobs are handed out.
+    assert TargetManager.split_jobs(16, 12, 1, num_running=1, num_pending=1, parallel_targets=4) == [12]
+    assert TargetManager.split_jobs(16, 7, 2, num_running=1, num_pending=2, parallel_targets=4) == [4, 3]
+    # There is always at least one job per started target.
+    assert TargetManager.split_jobs(2, 2, 2, num_running=0, num_pending=5, parallel_targets=4) == [1, 1]
+    assert TargetManager.split_jobs(8, 0, 0, num_running=4, num_pending=2, parallel_targets=4) == []